@@ -18,14 +18,17 @@ class TableGraphLabelConverter(object):
             self._index[char] = i
 
     def encode(self, texts):
-        """Support batch or single str."""
-        result_texts = []
+        """Support batch or single str.
+        返回整个batch所有文本补齐后的下标[text_num, max_length]和每个文本的长度[text_num]，空文本当成一个空格
+        """
+        text_index_list, text_length_list = [], []
         for batch_text in texts:
             for text in batch_text:
                 if len(text) == 0:
                     text = " "
-                text_index_list = [self._index.get(char, 0) for char in text]
-                text_index_list = torch.from_numpy(np.array(text_index_list)).to(torch.int)
-                result_texts.append(text_index_list)
-
-        return result_texts
+                text_index_list.extend([self._index.get(char, 0) for char in text])
+                text_length_list.append(len(text))
+        text_length = np.array(text_length_list, dtype=np.int64)
+        text_index = np.zeros((len(text_length), text_length.max(initial=1)), dtype=np.int64)
+        text_index[np.arange(text_index.shape[1]) < text_length[:, None]] = text_index_list
+        return torch.from_numpy(text_index), torch.from_numpy(text_length)
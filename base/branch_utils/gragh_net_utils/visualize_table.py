@@ -61,7 +61,7 @@ def _generate_layout_graph(result_data, cell_box, transform_cell_box, origin_img
         # cv2.rectangle(cls_debug_img, lu_points, rd_points, class_color_list[node_pred[i]], 1)
     # cv2.imwrite(os.path.join(save_dir, file_name + '_cls.jpg'), cls_debug_img)
 
-    pair_cell = result_data['pair_cell']
+    pair_cell = result_data['pair_cell'].cpu().numpy()
     if len(pair_cell) > 0:
         pair_cell_img = copy.deepcopy(cls_debug_img)
         pair_cell_pred = list(map(int, result_data['pair_cell_pred'].cpu().numpy().tolist()))
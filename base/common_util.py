@@ -6,6 +6,8 @@ import os
 import glob
 import codecs
 import json
+import hashlib
+import pickle
 from natsort import natsorted
 from base.driver import logger, PROJECT_ROOT_PATH
 
@@ -60,6 +62,42 @@ def search_file_from_dir(file_dir, file_path_pref_list, base_pref="", exts=["pdf
                         file_path_pref_list.append(file_path)
 
 
+def get_file_path_index(folder_path, ext=None, cache_dir=None):
+    """
+    一次os.walk扫描目录，返回目录下所有指定后缀文件的绝对路径集合，用来代替逐个文件os.path.exists
+    :param folder_path: 文件夹名称
+    :param ext: 文件后缀列表(不带点)，None表示全部文件
+    :param cache_dir: 不为空时把扫描结果缓存到磁盘，所有子目录的mtime都没变时直接读缓存
+    :return: 文件路径的set
+    """
+    folder_path = os.path.abspath(folder_path)
+    cache_path = None
+    if cache_dir:
+        cache_key = hashlib.md5('{}|{}'.format(folder_path, sorted(ext) if ext else None).encode('utf-8')).hexdigest()
+        cache_path = os.path.join(cache_dir, 'file_index_{}.pkl'.format(cache_key))
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                cache_data = pickle.load(f)
+            # 目录里增删文件会改变该目录的mtime，只需要stat目录
+            if all(os.path.isdir(dir_path) and os.stat(dir_path).st_mtime_ns == mtime
+                   for dir_path, mtime in cache_data['dir_mtime'].items()):
+                return set(os.path.join(folder_path, file_path) for file_path in cache_data['file_path_list'])
+    logger.info("begin to index files from:{}".format(folder_path))
+    dir_mtime, file_path_list = {}, []
+    for root, _, files in os.walk(folder_path, followlinks=True):
+        dir_mtime[root] = os.stat(root).st_mtime_ns
+        for file in files:
+            if ext is None or file.rsplit('.')[-1].lower() in ext:
+                file_path_list.append(os.path.relpath(os.path.join(root, file), folder_path))
+    if cache_path is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_cache_path = '{}.tmp{}'.format(cache_path, os.getpid())
+        with open(tmp_cache_path, 'wb') as f:
+            pickle.dump({'dir_mtime': dir_mtime, 'file_path_list': file_path_list}, f)
+        os.replace(tmp_cache_path, cache_path)
+    return set(os.path.join(folder_path, file_path) for file_path in file_path_list)
+
+
 def get_absolute_file_path(file_path):
     if file_path.startswith("/"):
         return file_path
@@ -1,4 +1,6 @@
 import math
+import time
+
 import torch
 from copy import deepcopy
 import torch.nn as nn
@@ -54,3 +56,74 @@ class ModelEMA:
         # Update EMA attributes
         copy_attr(self.ema, model, include, exclude)
 
+
+
+def move_to_device(data, device, non_blocking=False):
+    # Move every tensor inside (nested) dicts/lists/tuples to device, other values are returned as is
+    if isinstance(data, torch.Tensor):
+        return data.to(device, non_blocking=non_blocking)
+    if isinstance(data, dict):
+        return {key: move_to_device(value, device, non_blocking) for key, value in data.items()}
+    if isinstance(data, (list, tuple)):
+        return type(data)(move_to_device(value, device, non_blocking) for value in data)
+    return data
+
+
+def record_stream(data, stream):
+    # Mark tensors allocated on a side stream as used by stream, so the caching allocator does not reuse them too early
+    if isinstance(data, torch.Tensor):
+        if data.is_cuda:
+            data.record_stream(stream)
+    elif isinstance(data, dict):
+        for value in data.values():
+            record_stream(value, stream)
+    elif isinstance(data, (list, tuple)):
+        for value in data:
+            record_stream(value, stream)
+
+
+class DevicePrefetcher:
+    """ Wraps a data loader and copies the next batch to the GPU on a side CUDA stream while the current step runs.
+    The copy is only truly asynchronous when the data loader uses pin_memory. Non-CUDA devices get the batches as is.
+    data_time is the wait for the batch last returned by __next__ (its data loader fetch plus the stream handoff),
+    so a loader stall for batch k+1 is not charged to step k; it is None when batches are passed through.
+    """
+
+    def __init__(self, data_loader, device):
+        self.data_loader = data_loader
+        self.device = torch.device(device)
+        self.data_time = None
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        self.data_time = None
+        if self.device.type != 'cuda':
+            return iter(self.data_loader)
+        self._stream = torch.cuda.Stream(self.device)
+        self._data_iter = iter(self.data_loader)
+        self._next_batch, self._next_load_time = self._preload()
+        return self
+
+    def __next__(self):
+        if self._next_batch is None:
+            raise StopIteration
+        start = time.time()
+        current_stream = torch.cuda.current_stream(self.device)
+        current_stream.wait_stream(self._stream)
+        batch = self._next_batch
+        record_stream(batch, current_stream)
+        self.data_time = self._next_load_time + time.time() - start
+        self._next_batch, self._next_load_time = self._preload()
+        return batch
+
+    def _preload(self):
+        start = time.time()
+        try:
+            batch = next(self._data_iter)
+        except StopIteration:
+            return None, 0
+        load_time = time.time() - start
+        with torch.cuda.stream(self._stream):
+            return move_to_device(batch, self.device, non_blocking=True), load_time
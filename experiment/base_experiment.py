@@ -13,17 +13,17 @@ import itertools
 import mydatasets
 from torch import autocast
 from base.driver import logger
-from base.torch_utils.torch_util import ModelEMA
+from base.torch_utils.torch_util import ModelEMA, DevicePrefetcher
 from loss import get_criterion
 from metrics import get_metric
 from mydatasets import get_dataset
 from networks import get_network
 from accelerate import Accelerator
 from contextlib import contextmanager, nullcontext
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, IterableDataset
 from base.common_util import save_params
 
-from metrics.meter import AverageMeter
+from metrics.meter import AverageMeter, TensorAverageMeter
 from torch.utils.tensorboard import SummaryWriter
 from base.driver import log_formatter, PROJECT_ROOT_PATH
 from base.torch_utils.dl_util import get_optimizer, get_scheduler, get_scheduler2, seed_all, get_grad_norm
@@ -95,8 +95,15 @@ class BaseExperiment(object):
     def train(self, **kwargs):
         # 大致模板
         batch_time = AverageMeter()
-        loss_meter = AverageMeter()
+        data_time = AverageMeter()
+        # loss在device上累加，打印日志时才同步
+        loss_meter = TensorAverageMeter()
+        loss_term_meters = {}
         norm_meter = AverageMeter()
+        # device_prefetch时在单独的CUDA stream上提前把下一个batch拷到GPU
+        train_data_loader = self.train_data_loader
+        if self.args.datasets.train.get("device_prefetch", False):
+            train_data_loader = DevicePrefetcher(self.train_data_loader, self.args.device.device_id)
         # ADD resume从对应的epoch，step开始训练
         global_step = self.args.trainer.start_epoch * len(self.train_data_loader)
         global_eval_step = 0
@@ -104,11 +111,20 @@ class BaseExperiment(object):
         self.evaluate(simple_eval_flag=True)  # ADD 在开始训练的时候，先eval一下；防止因为eval写错了，导致之前train的时间都白费了
         for epoch in range(self.args.trainer.start_epoch, self.args.trainer.epochs):
             self.model.zero_grad(set_to_none=True)
-            for i, batch in enumerate(self.train_data_loader):
+            if hasattr(self.train_data_loader.batch_sampler, "set_epoch"):
+                self.train_data_loader.batch_sampler.set_epoch(epoch)
+            if hasattr(self.train_data_loader.dataset, "set_epoch"):
+                self.train_data_loader.dataset.set_epoch(epoch)
+            end = time.time()
+            for i, batch in enumerate(train_data_loader):
                 if global_step <= self.args.trainer.start_global_step:
                     global_step += 1
+                    end = time.time()
                     continue
                 start = time.time()
+                # 等data loader出batch的时间，device_prefetch时由prefetcher记录当前batch自己的等待时间
+                wait_time = getattr(train_data_loader, "data_time", None)
+                data_time.update(wait_time if wait_time is not None else start - end)
                 self.model.train()
                 ni = i + len(self.train_data_loader) * epoch  # number integrated batches (since train start)
                 # ADD 训练时with gradient_accumulate_scope
@@ -122,12 +138,17 @@ class BaseExperiment(object):
                         norm_meter.update(grad_norm)
                         if not self.args.trainer.scheduler_by_epoch:
                             self._step_scheduler(global_step)
-                loss_meter.update(result['loss'].item(), self.args.datasets.train.batch_size)
+                loss_meter.update(result['loss'], self.args.datasets.train.batch_size)
+                # 各项loss的大小，_step_forward返回loss_terms时记录
+                for name, loss_term in result.get('loss_terms', {}).items():
+                    loss_term_meters.setdefault(name, TensorAverageMeter()).update(loss_term)
                 batch_time.update(time.time() - start)
                 global_step += 1
                 global_eval_step = self._print_step_log(epoch, global_step, global_eval_step, loss_meter, norm_meter,
-                                                        batch_time, ni)
+                                                        batch_time, ni, data_time=data_time,
+                                                        loss_term_meters=loss_term_meters)
                 self._display_images(batch, result, global_step=global_step, if_train=True)
+                end = time.time()
             if self.args.trainer.scheduler_by_epoch:
                 self._step_scheduler(global_step)
             global_eval_step = self._print_epoch_log(epoch, global_step, global_eval_step, loss_meter, ni)
@@ -376,8 +397,9 @@ class BaseExperiment(object):
         # ADD scale lr
         if optimizer_args["scale_lr"]:
             num_process = 1 if self.accelerator is None else self.accelerator.num_processes
+            batch_size = self.train_data_loader.batch_size or self.args.datasets.train.batch_size
             optimizer_args['lr'] = optimizer_args['lr'] * self.args.trainer.grad_accumulate * \
-                                   self.train_data_loader.batch_size * num_process
+                                   batch_size * num_process
         self.optimizer = get_optimizer(self.model, **optimizer_args)
 
     def _init_scheduler(self, trainer_args, **kwargs):
@@ -512,7 +534,19 @@ class BaseExperiment(object):
             shuffle = data_loader_args.get("shuffle", True)
         else:
             shuffle = data_loader_args.get("shuffle", False)
-        pin_memory = data_loader_args.get("shuffle", False)
+        # 默认在GPU上训练时pin memory，配合non_blocking拷贝
+        pin_memory = data_loader_args.get("pin_memory", torch.device(self.args.device.device_id).type == "cuda")
+        if isinstance(dataset, IterableDataset):
+            # 流式dataset自己用shuffle buffer打乱
+            shuffle = False
+            if hasattr(dataset, "set_data_loader_args"):
+                # 流式dataset按worker数和batch_size切分样本，__len__和实际输出的batch数一致
+                dataset.set_data_loader_args(num_workers, batch_size)
+        loader_kwargs = {}
+        if num_workers > 0:
+            # persistent_workers时worker和里面的label缓存、spacy模型跨epoch复用；prefetch_factor是每个worker预取的batch数
+            loader_kwargs["persistent_workers"] = data_loader_args.get("persistent_workers", False)
+            loader_kwargs["prefetch_factor"] = data_loader_args.get("prefetch_factor", 2)
 
         collate_fn_args = data_loader_args.get("collate_fn")
         if collate_fn_args.get("type") is None:
@@ -520,19 +554,57 @@ class BaseExperiment(object):
         else:
             collate_fn_type = collate_fn_args.get("type")
             collate_fn = getattr(mydatasets, collate_fn_type)(batch_size=batch_size, **collate_fn_args)
+        batch_sampler_args = data_loader_args.get("batch_sampler")
+        if batch_sampler_args:
+            # 按样本大小组batch，batch_size不再生效
+            batch_sampler = self._get_batch_sampler(dataset, batch_sampler_args, shuffle, phase)
+            data_loader = DataLoader(dataset,
+                                     batch_sampler=batch_sampler,
+                                     num_workers=num_workers,
+                                     pin_memory=pin_memory,
+                                     collate_fn=collate_fn,
+                                     **loader_kwargs)
+            logger.info("use data loader with batch_sampler:{},num_workers:{},pin_memory:{},{}".format(
+                batch_sampler_args, num_workers, pin_memory, loader_kwargs))
+            return data_loader
         data_loader = DataLoader(dataset,
                                  shuffle=shuffle,
                                  num_workers=num_workers,
                                  pin_memory=pin_memory,
                                  collate_fn=collate_fn,
-                                 batch_size=batch_size)
-        logger.info("use data loader with batch_size:{},num_workers:{}".format(batch_size, num_workers))
+                                 batch_size=batch_size,
+                                 **loader_kwargs)
+        logger.info("use data loader with batch_size:{},num_workers:{},pin_memory:{},{}".format(
+            batch_size, num_workers, pin_memory, loader_kwargs))
 
         return data_loader
 
+    def _get_batch_sampler(self, dataset, batch_sampler_args, shuffle, phase="train"):
+        # 训练时多卡由batch sampler自己按rank切分，prepare_accelerator时不再交给accelerate切分
+        num_replicas, rank = 1, 0
+        if phase == "train" and self.accelerator is not None:
+            num_replicas, rank = self.accelerator.num_processes, self.accelerator.process_index
+        batch_sampler_type = batch_sampler_args.get("type")
+        # 配置里的shuffle、seed等覆盖默认值
+        sampler_kwargs = dict(shuffle=shuffle,
+                              seed=self.args.trainer.get("random_seed", 0),
+                              num_replicas=num_replicas,
+                              rank=rank)
+        sampler_kwargs.update(batch_sampler_args)
+        return getattr(mydatasets, batch_sampler_type)(dataset.get_box_num_list(), **sampler_kwargs)
+
     # 初始化 accelerator
     def prepare_accelerator(self):
         if self.accelerator is not None:
+            if self.args.trainer.get("distributed_eval", False) and hasattr(self, "eval_data_loader"):
+                # 每个进程只eval一部分数据，metric在eval结束时all_reduce
+                self.eval_data_loader = self.accelerator.prepare(self.eval_data_loader)
+            if hasattr(self.train_data_loader.batch_sampler, "num_replicas") or \
+                    hasattr(self.train_data_loader.dataset, "num_replicas"):
+                # batch sampler或者流式dataset已经按rank切分过了
+                self.model, self.optimizer, self.scheduler = self.accelerator.prepare(
+                    self.model, self.optimizer, self.scheduler)
+                return
             self.model, self.optimizer, self.train_data_loader, self.scheduler = self.accelerator.prepare(
                 self.model, self.optimizer, self.train_data_loader, self.scheduler)
 
@@ -548,6 +620,24 @@ class BaseExperiment(object):
         save_params(self.args.trainer.save_dir, json.loads(json.dumps(args)), 'model_args.yaml')
         return os.path.join(self.args.trainer.save_dir, 'model_args.yaml')
 
+    def _get_step_log_extra(self, message, global_step, **kwargs):
+        '''训练日志里追加data loader等待时间和各loss项，同时写到tensorboard'''
+        data_time = kwargs.get('data_time')
+        loss_term_meters = kwargs.get('loss_term_meters', {})
+        if data_time is not None:
+            message += "(data_wait_time: {:.5f}s, data_wait_average_time: {:.5f}s)".format(data_time.val,
+                                                                                          data_time.avg)
+        if loss_term_meters:
+            message += "(loss_terms: {})".format(
+                ", ".join("{}: {:.5f}".format(name, meter.avg) for name, meter in loss_term_meters.items()))
+        if self.writer is not None:
+            if data_time is not None:
+                self.writer.add_scalar("{}_train/data_wait_time".format(self.experiment_name), data_time.val,
+                                       global_step)
+            for name, meter in loss_term_meters.items():
+                self.writer.add_scalar("{}_train/{}".format(self.experiment_name, name), meter.val, global_step)
+        return message
+
     def _print_step_log(self, epoch, global_step, global_eval_step, loss_meter, norm_meter, batch_time, ni, **kwargs):
         current_lr = self._get_current_lr(ni, global_step)
         if self.args.device.is_master and self.args.trainer.print_freq > 0 and global_step % self.args.trainer.print_freq == 0:
@@ -557,6 +647,7 @@ class BaseExperiment(object):
                 format(self.experiment_name, epoch, global_step, current_lr,
                        loss_meter.val, loss_meter.avg, batch_time.val, batch_time.avg, norm_meter.avg,
                        norm_meter.val)
+            message = self._get_step_log_extra(message, global_step, **kwargs)
             logger.info(message)
             if self.writer is not None:
                 self.writer.add_scalar("{}_train/lr".format(self.experiment_name), current_lr, global_step)
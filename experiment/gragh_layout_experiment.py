@@ -18,8 +18,9 @@ from base.branch_utils.gragh_net_utils.visualize_table import visualize_img
 from base.common_util import get_file_path_list
 from base.driver import logger
 from experiment.base_experiment import BaseExperiment
-from metrics.meter import AverageMeter
-from mydatasets.gragh_net.graph_collate import graph_get_pad_transform, variety_cell, graph_get_resize_transform
+from metrics.meter import AverageMeter, TensorAverageMeter
+from mydatasets.gragh_net.graph_collate import graph_get_pad_transform, variety_cell, graph_get_resize_transform, \
+    normalize_image
 from post_process import get_post_processor
 
 
@@ -97,6 +98,8 @@ class GraphLayoutExperiment(BaseExperiment):
                         self.args.predictor.cut_ratio,
                         self.args.predictor.variety_ratio,
                         self.args.predictor.deleted_ratio,
+                        # 每张图都用同一个seed，预测时的增强结果可复现
+                        rng=np.random.default_rng(self.args.predictor.get('aug_seed', 1)),
                     )
                     transform_cell_box, text = transform_cell_boxes[0], transform_texts[0]
                 transform_cell_boxes = [
@@ -147,7 +150,7 @@ class GraphLayoutExperiment(BaseExperiment):
             eval_model.half()
         eval_model.eval()
         batch_time = AverageMeter()
-        loss_meter = AverageMeter()
+        loss_meter = TensorAverageMeter()
         norm_meter = AverageMeter()
         eval_metric = self._init_metric()
         simple_eval_flag = kwargs.get('simple_eval_flag', False)
@@ -159,7 +162,7 @@ class GraphLayoutExperiment(BaseExperiment):
             start = time.time()
             batch_size = self.args.datasets.train.batch_size
             result = self._step_forward(batch, is_train=False, eval_model=eval_model)
-            loss_meter.update(result['loss'].item(), batch_size)
+            loss_meter.update(result['loss'], batch_size)
             norm_meter.update(0)
             batch_time.update(time.time() - start)
             eval_metric.add_label(result['outputs']['pair_cell_pred'], result['outputs']['pair_cell_target'],
@@ -168,6 +171,8 @@ class GraphLayoutExperiment(BaseExperiment):
             if self.args.device.is_master and self.args.trainer.eval_print_freq > 0 and global_eval_step % self.args.trainer.eval_print_freq == 0:
                 self._print_eval_log(global_eval_step, loss_meter, eval_metric)
             self._display_images(batch, result, global_step=global_eval_step, if_train=False)
+        if self.args.trainer.get("distributed_eval", False):
+            eval_metric.all_reduce(self.accelerator)
         acc = self._print_eval_log(global_eval_step, loss_meter, eval_metric)
         eval_model.float()
         return {'acc': acc, 'global_eval_step': global_eval_step}
@@ -180,6 +185,9 @@ class GraphLayoutExperiment(BaseExperiment):
         linkings = batch.get("linkings")
         cell_boxes = [cell_box.to(self.args.device.device_id) for cell_box in cell_boxes]
         images = images.to(self.args.device.device_id)
+        if images.dtype == torch.uint8:
+            # collate输出的是uint8图片，在GPU上归一化
+            images = normalize_image(images)
         encode_texts = batch.get("encode_texts", None)
         if self.label_converter:
             texts = batch.get("texts", None)
@@ -199,8 +207,11 @@ class GraphLayoutExperiment(BaseExperiment):
                 label_index = self.args.model.class_list.index(label)
                 cls_targets.append(label_index)
         cls_targets = torch.from_numpy(np.array(cls_targets)).to(self.args.device.device_id)
+        # eval时criterion不更新训练用的统计量(比如类别频率的滑动平均)
+        self.criterion.train(is_train)
         losses = self.criterion(outputs, cls_targets)
-        return {'loss': losses['loss'], 'outputs': outputs, 'cls_targets': cls_targets}
+        loss_terms = {name: loss.detach() for name, loss in losses.items() if name != 'loss' and torch.is_tensor(loss)}
+        return {'loss': losses['loss'], 'loss_terms': loss_terms, 'outputs': outputs, 'cls_targets': cls_targets}
 
     # config的联动关系可以写在这个函数中
     def _init_config(self, config):
@@ -212,6 +223,18 @@ class GraphLayoutExperiment(BaseExperiment):
             config['datasets']['eval']['collate_fn']['width'] = config['model']['width']
             config['datasets']['train']['collate_fn']['height'] = config['model']['height']
             config['datasets']['eval']['collate_fn']['height'] = config['model']['height']
+            # draft_decode_flag打开时dataset按模型输入尺寸降分辨率解码
+            config['datasets']['train']['dataset']['width'] = config['model']['width']
+            config['datasets']['train']['dataset']['height'] = config['model']['height']
+            # bucket sampler按采样策略估计每个box的候选pair数：KNN每个节点最多k个邻居，
+            # Custom/CustomTree每个节点最多选7个(左右各1、上下各2、正下方1)，其他策略按全连接算
+            batch_sampler_args = config['datasets']['train'].get('batch_sampler')
+            if batch_sampler_args and batch_sampler_args.get('pair_num_per_box') is None:
+                sampling_strategy = config['model'].get('sampling_strategy')
+                if sampling_strategy == 'KNN':
+                    batch_sampler_args['pair_num_per_box'] = config['model']['k_nearest_num']
+                elif sampling_strategy in ['Custom', 'CustomTree']:
+                    batch_sampler_args['pair_num_per_box'] = 7
         if 'predictor' in config:
             config['predictor']['width'] = config['model']['width']
             config['predictor']['height'] = config['model']['height']
@@ -277,6 +300,7 @@ class GraphLayoutExperiment(BaseExperiment):
                 format(self.experiment_name, epoch, global_step, current_lr,
                        loss_meter.val, loss_meter.avg, batch_time.val, batch_time.avg, norm_meter.avg,
                        norm_meter.val)
+            message = self._get_step_log_extra(message, global_step, **kwargs)
             logger.info(message)
             if self.writer is not None:
                 self.writer.add_scalar("{}_train/lr".format(self.experiment_name), current_lr, global_step)
@@ -1,40 +1,70 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+from torch.utils.checkpoint import checkpoint
 
 
 class LayoutContrastiveLoss(nn.Module):
     """
    Vanilla Contrastive loss, also called InfoNceLoss as in SimCLR paper
+   Computed blockwise over tiles of tile_size rows, so only [tile_size, N] similarities exist at a time
+   (the tiles are recomputed in backward); masks are built per tile on device from labels or row weights
    """
 
-    def __init__(self, batch_size, temperature=0.5):
+    def __init__(self, batch_size=None, temperature=0.5, tile_size=1024):
         super().__init__()
         self.batch_size = batch_size
         self.temperature = temperature
-        self.mask = (~torch.eye(batch_size, batch_size, dtype=bool)).float()
-
-    def calc_similarity_batch(self, a, b):
-        return F.cosine_similarity(a.unsqueeze(1), b.unsqueeze(0), dim=2)
+        self.tile_size = tile_size
 
-    def forward(self, proj_1, proj_2, mask):
+    def forward(self, proj_1, proj_2, mask=None, row_weight=None, labels=None):
         """
        proj_1 and proj_2 are batched embeddings [batch, embedding_dim]
        where corresponding indices are pairs
        z_i, z_j in the SimCLR paper
+       The pairs that enter the loss are given by one of: a dense [batch, batch] mask,
+       row_weight [batch] (every pair of a row gets the row's weight), or labels [batch] (pairs with different labels)
        """
         z_i = F.normalize(proj_1, p=2, dim=1)
         z_j = F.normalize(proj_2, p=2, dim=1)
-
-        similarity_matrix = self.calc_similarity_batch(z_i, z_j)
-
-        nominator = torch.exp(similarity_matrix / self.temperature)
-
-        denominator = self.mask.to(similarity_matrix.device) * torch.exp(similarity_matrix / self.temperature)
-
-        all_losses = -torch.log(nominator / torch.sum(denominator, dim=1)) * mask.to(similarity_matrix.device)
-        loss = torch.sum(all_losses) / self.batch_size
-        return loss
+        node_num = z_i.shape[0]
+        batch_size = self.batch_size or node_num
+        # 原来的-log(nominator / sum(denominator, dim=1))是按列广播的，pair(a, b)除的是第b行的分母，
+        # 所以第b行分母的权重是mask第b列的和
+        if mask is not None:
+            mask = mask.to(z_i.device, z_i.dtype)
+            denominator_weight = mask.sum(dim=0)
+        elif labels is not None:
+            denominator_weight = (node_num - torch.bincount(labels)[labels]).to(z_i.dtype)
+        else:
+            row_weight = row_weight.to(z_i.dtype)
+            denominator_weight = row_weight.sum().expand(node_num)
+        loss = z_i.new_zeros(())
+        for start in range(0, node_num, self.tile_size):
+            end = min(start + self.tile_size, node_num)
+            tile_args = (z_i[start:end], z_j, start, denominator_weight[start:end],
+                         mask[start:end] if mask is not None else None, row_weight, labels)
+            if torch.is_grad_enabled():
+                # backward时重新算这个tile的相似度，不保存[tile_size, N]的中间结果
+                loss = loss + checkpoint(self._tile_loss, *tile_args, use_reentrant=False)
+            else:
+                loss = loss + self._tile_loss(*tile_args)
+        return loss / batch_size
+
+    def _tile_loss(self, z_tile, z_j, start, denominator_weight, tile_mask, row_weight, labels):
+        tile_num = z_tile.shape[0]
+        logits = z_tile @ z_j.T / self.temperature
+        row_index = torch.arange(start, start + tile_num, device=z_tile.device)
+        # 分母不含自己：log sum_{c != b} exp(s_bc / t)
+        diag = row_index.unsqueeze(1) == torch.arange(z_j.shape[0], device=z_tile.device).unsqueeze(0)
+        log_denominator = torch.logsumexp(logits.masked_fill(diag, float('-inf')), dim=1)
+        loss = (denominator_weight * log_denominator).sum()
+        if tile_mask is None and labels is not None:
+            tile_mask = (labels[start:start + tile_num].unsqueeze(1) != labels.unsqueeze(0)).to(logits.dtype)
+        if tile_mask is None:
+            # 整行同一个权重，不用展开成[tile_size, N]
+            return loss - (row_weight[start:start + tile_num] * logits.sum(dim=1)).sum()
+        return loss - (tile_mask * logits).sum()
 
 
 class ContrastiveLoss(nn.Module):
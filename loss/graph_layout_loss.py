@@ -1,9 +1,10 @@
+from functools import partial
+
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
-from sklearn.utils import class_weight
 
 # https://github.com/clcarwin/focal_loss_pytorch/blob/master/focalloss.py
 from torch.nn import CrossEntropyLoss
@@ -29,60 +30,76 @@ class GraphLayoutLoss(nn.Module):
         self.loss_weight = loss_weight
         self.num_classes = kwargs.get('num_classes')
         self.class_weight_flag = kwargs.get('class_weight_flag', False)
+        # class_weight_flag时类别频率的滑动平均系数，0表示只用当前batch的频率
+        self.class_weight_momentum = kwargs.get('class_weight_momentum', 0)
+        self.register_buffer('edge_class_freq', torch.zeros(2), persistent=False)
+        self.register_buffer('node_class_freq', torch.zeros(self.num_classes or 0), persistent=False)
+        self.register_buffer('class_freq_step', torch.zeros(()), persistent=False)
         self.node_contrastive_loss_flag = kwargs.get('node_contrastive_loss_flag', False)
         self.edge_contrastive_loss_flag = kwargs.get('edge_contrastive_loss_flag', False)
+        # 对比loss按contrastive_tile_size行一块算，显存O(N * tile)
+        self.contrastive_loss = LayoutContrastiveLoss(tile_size=kwargs.get('contrastive_tile_size', 1024))
+
+    def get_balanced_weight(self, target, class_freq, num_classes):
+        '''
+        在device上用bincount算sklearn里balanced的类别权重n_samples / (n_classes * count)，即1 / (n_classes * 频率)，
+        class_weight_momentum > 0时训练step(self.training为True)的频率用跨step的滑动平均(带偏差修正)，batch小时权重更稳定，
+        eval时criterion要切到eval()，不更新滑动平均；
+        没出现的类别权重为0，不影响加权平均的loss
+        '''
+        freq = torch.bincount(target, minlength=num_classes).float()
+        freq = freq / freq.sum().clamp(min=1)
+        if self.class_weight_momentum > 0 and self.training:
+            class_freq.mul_(self.class_weight_momentum).add_(freq, alpha=1 - self.class_weight_momentum)
+            freq = class_freq / (1 - self.class_weight_momentum ** self.class_freq_step)
+        return torch.where(freq > 0, 1 / (num_classes * freq).clamp(min=1e-12), torch.zeros_like(freq))
+
+    @staticmethod
+    def get_detached_ratio(numerator, denominator):
+        '''
+        动态平衡两项loss的权重numerator / denominator，detach后当常数用，和原来的float(...cpu())梯度一样，
+        但留在device上，不用每个step同步
+        '''
+        return (numerator / denominator).detach()
 
     def forward(self, outputs, cls_targets):
         losses = {}
+        device = outputs['pair_cell_target'].device
+        if self.class_freq_step.device != device:
+            self.to(device)
         if self.class_weight_flag:
-            try:
-                w = class_weight.compute_class_weight(
-                    class_weight='balanced',
-                    classes=range(2),
-                    # classes=np.unique(outputs['pair_cell_target'].cpu().numpy()),
-                    y=outputs['pair_cell_target'].cpu().numpy())
-                edge_loss = torch.nn.CrossEntropyLoss(
-                    weight=torch.tensor(w, dtype=torch.float32).to(outputs['pair_cell_target'].device))
-            except:
-                edge_loss = self.edge_loss
-                # print("ERROR-Pair:", outputs['pair_cell_target'].cpu().numpy())
-            try:
-                w = class_weight.compute_class_weight(
-                    class_weight='balanced',
-                    classes=range(self.num_classes),
-                    # classes=np.unique(cls_targets.cpu().numpy()),
-                    y=cls_targets.cpu().numpy())
-                node_loss = torch.nn.CrossEntropyLoss(
-                    weight=torch.tensor(w, dtype=torch.float32).to(outputs['pair_cell_target'].device))
-            except:
-                node_loss = self.node_loss
-                # print("ERROR-Node:", cls_targets.cpu().numpy())
+            if self.class_weight_momentum > 0 and self.training:
+                self.class_freq_step += 1
+            edge_weight = self.get_balanced_weight(outputs['pair_cell_target'], self.edge_class_freq, 2)
+            node_weight = self.get_balanced_weight(cls_targets, self.node_class_freq, self.num_classes)
+            edge_loss = partial(F.cross_entropy, weight=edge_weight)
+            node_loss = partial(F.cross_entropy, weight=node_weight)
         else:
             node_loss = self.node_loss
             edge_loss = self.edge_loss
-        edge_loss.to(outputs['pair_cell_target'].device)
         losses['loss_cell'] = edge_loss(
             outputs['pair_cell_score_list'],
             outputs['pair_cell_target']) if len(outputs['pair_cell_score_list']) > 0 else 0
-        node_loss.to(outputs['pair_cell_target'].device)
         losses['loss_cls'] = node_loss(outputs['node_score_list'], cls_targets)
-        node_num = outputs['node_score_list'].size()[0]
         if self.edge_contrastive_loss_flag:
-            # 对比loss
-            mask = torch.zeros(node_num, node_num)
-            neg_pair = torch.as_tensor(outputs['pair_cell'])[outputs['pair_cell_target'] == 0].T.cpu().numpy()
-            mask[neg_pair] = 1.0
-            edge_contrastive_loss = LayoutContrastiveLoss(node_num)
-            loss_edge_con = edge_contrastive_loss(outputs['node_feat'], outputs['node_feat'], mask)
-            losses['loss_cell'] += float((losses['loss_cell'] / loss_edge_con).cpu()) * loss_edge_con
+            # 对比loss，和原来的mask[neg_pair] = 1.0一致：[2, K]的neg_pair按第0维索引，
+            # 出现在负样本pair里的节点整行都参与，在device上用index_add算出这些行
+            pair_cell = torch.as_tensor(outputs['pair_cell'], device=device)
+            neg_weight = (outputs['pair_cell_target'] == 0).float()
+            node_num = outputs['node_feat'].shape[0]
+            neg_node = torch.zeros(node_num, device=device).index_add_(0, pair_cell[:, 0], neg_weight).index_add_(
+                0, pair_cell[:, 1], neg_weight)
+            loss_edge_con = self.contrastive_loss(outputs['node_feat'], outputs['node_feat'],
+                                                  row_weight=(neg_node > 0).float())
+            losses['loss_edge_con'] = loss_edge_con
+            losses['loss_cell'] += self.get_detached_ratio(losses['loss_cell'], loss_edge_con) * loss_edge_con
         if self.node_contrastive_loss_flag:
-            # 对比loss
-            mask = (~(cls_targets.expand(node_num, node_num) == cls_targets.expand(node_num, node_num).T)).float()
-            node_contrastive_loss = LayoutContrastiveLoss(node_num)
-            loss_node_con = node_contrastive_loss(outputs['node_feat'], outputs['node_feat'], mask)
-            losses['loss_cls'] += float((losses['loss_cls'] / loss_node_con).cpu()) * loss_node_con
+            # 对比loss，类别不同的节点对
+            loss_node_con = self.contrastive_loss(outputs['node_feat'], outputs['node_feat'], labels=cls_targets)
+            losses['loss_node_con'] = loss_node_con
+            losses['loss_cls'] += self.get_detached_ratio(losses['loss_cls'], loss_node_con) * loss_node_con
         if self.loss_weight == -1:
-            loss_weight = float((losses['loss_cell'] / losses['loss_cls']).cpu())
+            loss_weight = self.get_detached_ratio(losses['loss_cell'], losses['loss_cls'])
             losses['loss'] = loss_weight * losses['loss_cls'] + losses['loss_cell']
         else:
             losses['loss'] = self.loss_weight * losses['loss_cls'] + losses['loss_cell']
@@ -2,96 +2,99 @@
 # email:weishu@datagrand.com
 # create: 2021/12/1
 import numpy as np
-import torch.nn.functional as F
-from sklearn.metrics import average_precision_score, confusion_matrix, f1_score, precision_recall_fscore_support, roc_auc_score, roc_curve
+import torch
+
+
+def get_confusion_matrix(pred_label, gt_label, num_classes):
+    '''在label所在的device上用bincount算[gt, pred]的混淆矩阵，不转成python list'''
+    index = gt_label.reshape(-1).long() * num_classes + pred_label.reshape(-1).long().to(gt_label.device)
+    return torch.bincount(index, minlength=num_classes * num_classes).reshape(num_classes, num_classes)
+
+
+def get_confusion_report(confusion_matrix):
+    '''
+    由混淆矩阵算指标，O(C^2)，和原来按list逐类统计、sklearn f1_score的结果一致：
+    accuracy是gt里出现过的类别的recall平均，macro F1在gt或pred里出现过的类别上平均，micro F1即整体准确率
+    '''
+    confusion_matrix = confusion_matrix.astype(np.float64)
+    tp = np.diag(confusion_matrix)
+    gt_num = confusion_matrix.sum(axis=1)
+    pred_num = confusion_matrix.sum(axis=0)
+    sums = int(confusion_matrix.sum())
+    correct = int(tp.sum())
+    correct_map = {class_num: (int(tp[class_num]), int(gt_num[class_num]),
+                                float(tp[class_num] / gt_num[class_num]))
+                   for class_num in np.nonzero(gt_num)[0].tolist()}
+    present = (gt_num + pred_num) > 0
+    f1 = 2 * tp[present] / (gt_num[present] + pred_num[present])
+    return {
+        'accuracy': sum([item[2] for key, item in correct_map.items()]) / len(correct_map) if len(correct_map) > 0 else 0.0,
+        'F1_MACRO': float(f1.mean()) if len(f1) > 0 else 0.0,
+        'F1_MICRO': correct / sums if sums > 0 else 0.0,
+        'sums': sums,
+        'correct': correct,
+        'accuracy_map': correct_map
+    }
 
 
 class GraphLayoutMetric(object):
+    '''
+    节点分类和pair分类各累加一个混淆矩阵，add_label只在device上做bincount，get_report才拷一次C*C的矩阵到cpu，
+    eval过程中多次get_report的开销不随样本数增长；多卡eval时调用all_reduce把各进程的混淆矩阵加起来。
+    pred_label_map可以把预测的类别映射到别的类别上再统计(比如用doclaynet的模型评估publaynet：{5: 0, 6: 0, 7: 1})
+    '''
 
     def __init__(self, num_classes, **kwargs):
-        self.pred_labels_cls, self.gt_labels_cls = [], []
-        self.pred_labels_cell, self.gt_labels_cell = [], []
         self.num_classes = num_classes
+        self.pred_label_map = kwargs.get('pred_label_map', None)
+        self.confusion_cls = None
+        self.confusion_cell = None
 
     def add_label(self, pred_label_cell, gt_label_cell, pred_label_cls, gt_label_cls):
-        self.pred_labels_cls.extend(list(map(int, pred_label_cls.cpu().numpy().tolist())))
-        self.pred_labels_cell.extend(list(map(int, pred_label_cell.cpu().numpy().tolist())))
-        self.gt_labels_cls.extend(list(map(int, gt_label_cls.cpu().numpy().tolist())))
-        self.gt_labels_cell.extend(list(map(int, gt_label_cell.cpu().numpy().tolist())))
+        if self.confusion_cls is None:
+            self.confusion_cls = torch.zeros(self.num_classes, self.num_classes, dtype=torch.long,
+                                             device=gt_label_cls.device)
+            self.confusion_cell = torch.zeros(2, 2, dtype=torch.long, device=gt_label_cls.device)
+        if self.pred_label_map:
+            label_map = torch.arange(self.num_classes, device=pred_label_cls.device)
+            for pred_label, map_label in self.pred_label_map.items():
+                label_map[int(pred_label)] = int(map_label)
+            pred_label_cls = label_map[pred_label_cls.long()]
+        self.confusion_cls += get_confusion_matrix(pred_label_cls, gt_label_cls, self.num_classes).to(
+            self.confusion_cls.device)
+        self.confusion_cell += get_confusion_matrix(pred_label_cell, gt_label_cell, 2).to(self.confusion_cell.device)
+
+    def all_reduce(self, accelerator=None):
+        '''多进程各自eval了一部分数据时，把混淆矩阵在所有进程间求和，所有进程都要调用'''
+        if accelerator is None or accelerator.num_processes <= 1 or self.confusion_cls is None:
+            return self
+        self.confusion_cls = accelerator.reduce(self.confusion_cls.to(accelerator.device), reduction='sum')
+        self.confusion_cell = accelerator.reduce(self.confusion_cell.to(accelerator.device), reduction='sum')
+        return self
 
     def get_report(self):
-        # evaluation doclaynet model for publaynet
-        # update_label = []
-        # for label in self.pred_labels_cls:
-        #     if label in [5, 6, 8, 10]:
-        #         update_label.append(0)
-        #     elif label in [7, 9]:
-        #         update_label.append(1)
-        #     else:
-        #         update_label.append(label)
-        # self.pred_labels_cls = update_label
-        # -----------------------------
-        # evaluation doclaynet model for dg_data
-        # update_label = []
-        # for label in self.pred_labels_cls:
-        #     if label in [8, 10]:
-        #         update_label.append(0)
-        #     elif label in [7, 9]:
-        #         update_label.append(1)
-        #     else:
-        #         update_label.append(label)
-        # self.pred_labels_cls = update_label
-        # --------------------------------
-        # evaluation dg_data model for publaynet
-        # update_label = []
-        # for label in self.pred_labels_cls:
-        #     if label in [5, 6]:
-        #         update_label.append(0)
-        #     else:
-        #         update_label.append(label)
-        # self.pred_labels_cls = update_label
-        sums = len(self.pred_labels_cls)
-        correct = 0
-        correct_map = {}
-        for class_num in range(self.num_classes):
-            class_num_label = np.array(self.pred_labels_cls)[np.where(np.array(self.gt_labels_cls) == class_num)]
-            total_num = len(class_num_label)
-            if total_num != 0:
-                correct_num = len(np.where(class_num_label == class_num)[0])
-                correct_map[class_num] = (correct_num, total_num, correct_num / total_num)
-                correct += correct_num
-        F1_MACRO, F1_MICRO = f1_score(self.gt_labels_cls, self.pred_labels_cls,
-                                      average='macro'), f1_score(self.gt_labels_cls,
-                                                                 self.pred_labels_cls,
-                                                                 average='micro')
+        if self.confusion_cls is None:
+            confusion_cls = np.zeros((self.num_classes, self.num_classes), dtype=np.int64)
+            confusion_cell = np.zeros((2, 2), dtype=np.int64)
+        else:
+            confusion_cls = self.confusion_cls.cpu().numpy()
+            confusion_cell = self.confusion_cell.cpu().numpy()
+        cls_report = get_confusion_report(confusion_cls)
         report = {
-            "accuracy_cls": sum([item[2] for key, item in correct_map.items()]) / len(correct_map),
-            'Node_F1_MACRO': F1_MACRO,
-            'Node_F1_MICRO': F1_MICRO,
-            "sums_cls": sums,
-            "correct_cls": correct,
-            'accuracy_map_cls': correct_map
+            "accuracy_cls": cls_report['accuracy'],
+            'Node_F1_MACRO': cls_report['F1_MACRO'],
+            'Node_F1_MICRO': cls_report['F1_MICRO'],
+            "sums_cls": cls_report['sums'],
+            "correct_cls": cls_report['correct'],
+            'accuracy_map_cls': cls_report['accuracy_map']
         }
-
-        sums = len(self.pred_labels_cell)
-        correct = sums - len(np.where(np.array(self.gt_labels_cell) + np.array(self.pred_labels_cell) == 1)[0])
-        correct_map = {}
-        for class_num in range(2):
-            class_num_label = np.array(self.pred_labels_cell)[np.where(np.array(self.gt_labels_cell) == class_num)]
-            total_num = len(class_num_label)
-            if total_num != 0:
-                correct_num = len(np.where(class_num_label == class_num)[0])
-                correct_map[class_num] = (correct_num, total_num, correct_num / total_num)
-        F1_MACRO, F1_MICRO = f1_score(self.gt_labels_cell, self.pred_labels_cell,
-                                      average='macro'), f1_score(self.gt_labels_cell,
-                                                                 self.pred_labels_cell,
-                                                                 average='micro')
+        cell_report = get_confusion_report(confusion_cell)
         report.update({
-            "accuracy_cell": sum([item[2] for key, item in correct_map.items()]) / len(correct_map) if len(correct_map)> 0 else 0.0,
-            'Pair_F1_MACRO': F1_MACRO,
-            'Pair_F1_MICRO': F1_MICRO,
-            "sums_cell": sums,
-            "correct_cell": correct,
-            'accuracy_map_cell': correct_map
+            "accuracy_cell": cell_report['accuracy'],
+            'Pair_F1_MACRO': cell_report['F1_MACRO'],
+            'Pair_F1_MICRO': cell_report['F1_MICRO'],
+            "sums_cell": cell_report['sums'],
+            "correct_cell": cell_report['correct'],
+            'accuracy_map_cell': cell_report['accuracy_map']
         })
         return report
@@ -20,3 +20,37 @@ class AverageMeter:
         self.sum += val * n
         self.count += n
         self.avg = self.sum / self.count
+
+
+class TensorAverageMeter:
+    """
+    Same interface as AverageMeter, but update() takes device tensors and accumulates them on the device,
+    values are only copied to host when val/avg are read (e.g. at print_freq), so training steps need no .item() sync
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._val = 0
+        self._sum = 0
+        self.count = 0
+
+    def update(self, val, n=1):
+        if hasattr(val, 'detach'):
+            val = val.detach()
+        self._val = val
+        self._sum = self._sum + val * n
+        self.count += n
+
+    @property
+    def val(self):
+        return float(self._val)
+
+    @property
+    def sum(self):
+        return float(self._sum)
+
+    @property
+    def avg(self):
+        return self.sum / self.count if self.count > 0 else 0
@@ -4,7 +4,10 @@
 from mydatasets.base_datasets import BaseDataset, BaseImgDataset
 
 from .gragh_net.layout_dataset import GraphLayoutDataset, GraphLayoutEntityDataset
+from .gragh_net.packed_dataset import GraphLayoutPackedDataset, GraphLayoutPackedEntityDataset, \
+    GraphLayoutPackedIterableDataset, GraphLayoutPackedEntityIterableDataset
 from .gragh_net.graph_collate import GraphCollateFn, GraphEntityCollateFn
+from .gragh_net.bucket_sampler import GraphBucketBatchSampler
 
 
 def get_dataset(dataset_args):
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# software: PyCharm
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class GraphBucketBatchSampler(Sampler):
+    '''
+    按每页的box数分桶，桶内按总box数(max_node_num)和/或总候选pair数(max_pair_num)的预算组batch，
+    每页的候选pair数按n*pair_num_per_box估计(不超过n*(n-1)/2)，pair_num_per_box为空时按全连接n*(n-1)/2算，
+    不用固定的batch_size，避免20个box和3000个box的页混在一个batch里。
+    分布式时每个进程传自己的rank，所有进程用同一个seed和epoch得到同样的batch列表，再按rank交错取，
+    相邻的batch来自同一个桶、大小接近，各进程batch数一样(不够时从头补)，这时data loader不要再交给accelerate切分。
+    '''
+
+    def __init__(self, box_num_list, max_node_num=None, max_pair_num=None, pair_num_per_box=None, bucket_num=10,
+                 max_batch_size=None, shuffle=True, drop_last=False, seed=0, num_replicas=1, rank=0, **kwargs):
+        super(GraphBucketBatchSampler, self).__init__()
+        assert max_node_num or max_pair_num, 'GraphBucketBatchSampler needs max_node_num or max_pair_num'
+        self.box_num = np.maximum(np.asarray(box_num_list, dtype=np.int64), 1)
+        self.max_node_num = max_node_num
+        self.max_pair_num = max_pair_num
+        self.pair_num_per_box = pair_num_per_box
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # 按box数的分位点分桶，桶里按box数排好序
+        order = np.argsort(self.box_num, kind='stable')
+        self.bucket_list = [bucket for bucket in np.array_split(order, min(bucket_num, len(order))) if len(bucket) > 0]
+        self.epoch = 0
+        self._batch_list = None
+
+    def set_epoch(self, epoch):
+        '''和DistributedSampler一样，每个epoch开始前调用，换一个batch顺序'''
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batch_list = None
+
+    def _pack(self, index_list):
+        '''按顺序贪心装batch，单页超过预算时自己一个batch'''
+        node_num = self.box_num[index_list]
+        pair_num = node_num * (node_num - 1) // 2
+        if self.pair_num_per_box:
+            pair_num = np.minimum(pair_num, node_num * self.pair_num_per_box)
+        batch_list, start, node_sum, pair_sum = [], 0, 0, 0
+        for i in range(len(index_list)):
+            node_sum += node_num[i]
+            pair_sum += pair_num[i]
+            if i > start and ((self.max_node_num and node_sum > self.max_node_num) or
+                              (self.max_pair_num and pair_sum > self.max_pair_num) or
+                              (self.max_batch_size and i - start >= self.max_batch_size)):
+                batch_list.append(index_list[start:i].tolist())
+                start, node_sum, pair_sum = i, node_num[i], pair_num[i]
+        if start < len(index_list):
+            batch_list.append(index_list[start:].tolist())
+        return batch_list
+
+    def _get_batch_list(self):
+        '''所有进程共用的batch列表，每个epoch生成一次'''
+        if self._batch_list is not None:
+            return self._batch_list
+        rng = np.random.default_rng([self.seed, self.epoch])
+        batch_list = []
+        for bucket in self.bucket_list:
+            batch_list.extend(self._pack(rng.permutation(bucket) if self.shuffle else bucket))
+        # batch数补齐(或drop_last时截断)到num_replicas的倍数，各进程batch数一样
+        remainder = len(batch_list) % self.num_replicas
+        if remainder > 0:
+            if self.drop_last and len(batch_list) > remainder:
+                batch_list = batch_list[:-remainder]
+            else:
+                batch_list += [batch_list[i % len(batch_list)] for i in range(self.num_replicas - remainder)]
+        # 每num_replicas个相邻batch作为一组打乱，组内分给不同的进程
+        if self.shuffle:
+            group_order = rng.permutation(len(batch_list) // self.num_replicas)
+            batch_list = [batch_list[group * self.num_replicas + i] for group in group_order
+                          for i in range(self.num_replicas)]
+        self._batch_list = batch_list
+        return batch_list
+
+    def __iter__(self):
+        batch_list = self._get_batch_list()
+        return iter(batch_list[self.rank::self.num_replicas])
+
+    def __len__(self):
+        return len(self._get_batch_list()) // self.num_replicas
@@ -4,7 +4,6 @@
 # datetime:2023/2/8 2:33 下午
 # software: PyCharm
 import torch
-import copy
 from PIL import Image
 import random
 import cv2
@@ -26,6 +25,10 @@ class GraphCollateFn(object):
         self.debug_cell = kwargs['debug_cell']
         self.aug_flag = kwargs['aug_flag']
         self.pad_flag = kwargs['pad_flag']
+        # transform只建一次，输出uint8，归一化在GPU上做
+        self.img_transform = GraphImageTransform(self.height, self.width, self.pad_flag)
+        self._rng = None
+        self._rng_worker_id = None
 
     def __call__(self, batch_data):
         images = [batch['image'] for batch in batch_data]
@@ -39,7 +42,8 @@ class GraphCollateFn(object):
         if self.aug_flag:
             cell_boxes, targets, texts = variety_cell(images, cell_boxes, targets, texts, padding_edge,
                                                       self.cut_percent, self.variety_percent, self.delete_percent,
-                                                      self.cut_ratio, self.variety_ratio, self.delete_ratio)
+                                                      self.cut_ratio, self.variety_ratio, self.delete_ratio,
+                                                      rng=self._get_rng(), encode_texts=encode_texts)
         if self.debug_cell:
             self._debug_component(images, cell_boxes)
         cell_boxes = [torch.from_numpy(np.array(cell_box)).to(torch.float32) for cell_box in cell_boxes]
@@ -53,9 +57,21 @@ class GraphCollateFn(object):
             'encode_texts': encode_texts,
         }
 
+    def _get_rng(self):
+        '''
+        每个DataLoader worker各用一个np.random.Generator，种子用torch分给worker的种子，
+        worker之间、epoch之间的增强都不一样，固定torch.manual_seed时可复现
+        '''
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else -1
+        if self._rng is None or self._rng_worker_id != worker_id:
+            self._rng = np.random.default_rng(worker_info.seed if worker_info is not None else torch.initial_seed())
+            self._rng_worker_id = worker_id
+        return self._rng
+
     def _debug_component(self, images, cell_boxes):
         for idx, image in enumerate(images):
-            image = (image.detach().cpu().numpy() + 1) * 255 / 2
+            image = image.detach().cpu().numpy()
             debug_img = cv2.UMat(image.transpose(1, 2, 0).astype(np.uint8))
             for cell_box in cell_boxes[idx]:
                 width = int(cell_box[2] - cell_box[0])
@@ -70,10 +86,7 @@ class GraphCollateFn(object):
         transform_images, transform_cell_boxes, padding_edge = [], [], []
         for i, image in enumerate(images):
             assert len(cell_boxes[i]) > 0
-            if self.pad_flag:
-                image, cell_box, padding = graph_get_pad_transform(image, cell_boxes[i], self.height, self.width)
-            else:
-                image, cell_box, padding = graph_get_resize_transform(image, cell_boxes[i], self.height, self.width)
+            image, cell_box, padding = self.img_transform(image, cell_boxes[i])
             transform_images.append(image)
             transform_cell_boxes.append(cell_box)
             padding_edge.append(padding)
@@ -89,158 +102,145 @@ class GraphEntityCollateFn(GraphCollateFn):
         return result
 
 
+class GraphImageTransform(object):
+    '''
+    图片resize到height*width(pad_flag时等比例resize后用边缘像素pad)，box同步变换，
+    输出uint8 tensor，归一化用normalize_image放到GPU上做
+    '''
+
+    def __init__(self, height, width, pad_flag=False):
+        self.height = height
+        self.width = width
+        self.pad_flag = pad_flag
+        self.resize = transforms.Resize((height, width), transforms.InterpolationMode.BICUBIC)
+        self.to_tensor = transforms.PILToTensor()
+
+    def __call__(self, image, cell_box):
+        tb_w, tb_h = image.size
+        if self.pad_flag:
+            im_scale = float(self.height) / float(tb_h)
+            if int(im_scale * tb_w) > self.width:
+                im_scale = float(self.width) / float(tb_w)
+            rew = int(tb_w * im_scale)
+            reh = int(tb_h * im_scale)
+            pdl, pdt = ((self.width - rew) // 2, (self.height - reh) // 2)
+            pdr, pdd = (self.width - rew - pdl, self.height - reh - pdt)
+            image = transforms.functional.resize(image, [reh, rew], transforms.InterpolationMode.BICUBIC)
+            image = transforms.functional.pad(image, [pdl, pdt, pdr, pdd], padding_mode='edge')
+            cell_box = np.array(cell_box) * im_scale + np.array([pdl, pdt] * 2)
+            padding = (pdl, pdt, pdr, pdd)
+        else:
+            h_scale, w_scale = self.height / tb_h, self.width / tb_w
+            image = self.resize(image)
+            cell_box = (np.array(cell_box).reshape(-1, 2) * np.array([w_scale, h_scale])).reshape(-1, 4)
+            padding = (0, 0, 0, 0)
+        return self.to_tensor(image), cell_box, padding
+
+
+def normalize_image(images):
+    '''uint8图片转成float并归一化到[-1, 1]，和ToTensor + Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))结果一致'''
+    return images.float().div(255).sub(0.5).div(0.5)
+
+
 def graph_get_pad_transform(image, cell_box, height, width):
-    tb_w, tb_h = image.size
-    img_transform = []
-    im_scale = float(height) / float(tb_h)
-    if int(im_scale * tb_w) > width:
-        im_scale = float(width) / float(tb_w)
-    rew = int(tb_w * im_scale)
-    reh = int(tb_h * im_scale)
-    pdl, pdt = ((width - rew) // 2, (height - reh) // 2)
-    pdr, pdd = (width - rew - pdl, height - reh - pdt)
-    img_transform.append(transforms.Resize((reh, rew), Image.BICUBIC))
-    img_transform.append(transforms.Pad((pdl, pdt, pdr, pdd), padding_mode='edge'))
-    img_transform.append(transforms.ToTensor())
-    img_transform.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
-    img_transformation = transforms.Compose(img_transform)
-    image = img_transformation(image)
-    cell_box = np.array(cell_box) * im_scale + np.array([pdl, pdt] * 2)
-    return image, cell_box, (pdl, pdt, pdr, pdd)
+    image, cell_box, padding = GraphImageTransform(height, width, pad_flag=True)(image, cell_box)
+    return normalize_image(image), cell_box, padding
 
 
 def graph_get_resize_transform(image, cell_box, height, width):
-    tb_w, tb_h = image.size
-    img_transform = []
-    h_scale, w_scale = height / tb_h, width / tb_w
-    img_transform.append(transforms.Resize((height, width), Image.BICUBIC))
-    img_transform.append(transforms.ToTensor())
-    img_transform.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
-    img_transformation = transforms.Compose(img_transform)
-    image = img_transformation(image)
-    cell_box = (np.array(cell_box).reshape(-1, 2) * np.array([w_scale, h_scale])).reshape(-1, 4)
-    return image, cell_box, (0, 0, 0, 0)
+    image, cell_box, padding = GraphImageTransform(height, width, pad_flag=False)(image, cell_box)
+    return normalize_image(image), cell_box, padding
 
 
 def variety_cell(images, cell_boxes, targets, texts, padding_edge, cut_percent, variety_percent, delete_percent,
-                 cut_ratio, variety_ratio, delete_ratio):
-    img_size = [
-        [valid_range[0], valid_range[1],
-         int(image.shape[1]) - valid_range[2],
-         int(image.shape[2]) - valid_range[3]]  # [l, t, r, d]
-        for image, valid_range in zip(images, padding_edge)
-    ]
-    random.seed(1)
-    cell_boxes = [list(cell_box) for cell_box in cell_boxes]
-    for i, cell_box in enumerate(cell_boxes):
-        choose_index_list = random.sample(list(range(len(cell_box))),
-                                          int((cut_percent + variety_percent) *
-                                              len(cell_box)))  # 随机选出需要做变换（包括cut和偏移）的框index
-        for choose_index in choose_index_list:
-            width = cell_box[choose_index][2] - cell_box[choose_index][0]
-            height = cell_box[choose_index][3] - cell_box[choose_index][1]
-            if random.random() < cut_percent / (cut_percent + variety_percent):  # 做cut
-                if width < 50:
-                    continue
-                cut_strategy = random.random()
-                if cut_strategy <= 1.0:  # 只cut x
-                    cut_x_ratio = random.random()
-                    cut_x_ratio = cut_x_ratio if cut_x_ratio < 0.5 else 1 - cut_x_ratio
-                    cut_box1 = copy.deepcopy(cell_box[choose_index])
-                    cut_box2 = copy.deepcopy(cell_box[choose_index])
-                    cut_box1[2] = cell_box[choose_index][0] + (
-                        1 + random.random() * random.choice([-cut_ratio, cut_ratio])) * width * cut_x_ratio
-                    cut_box2[0] = cell_box[choose_index][0] + (
-                        1 + random.random() * random.choice([-cut_ratio, cut_ratio])) * width * cut_x_ratio
-                    text1 = texts[i][choose_index][:int(cut_x_ratio * len(texts[i][choose_index]))]
-                    text2 = texts[i][choose_index][int(cut_x_ratio * len(texts[i][choose_index])):]
-                elif cut_strategy < 1.0:  # 只cut y
-                    cut_y_ratio = random.random()
-                    cut_y_ratio = cut_y_ratio if cut_y_ratio < 0.5 else 1 - cut_y_ratio
-                    cut_box1 = copy.deepcopy(cell_box[choose_index])
-                    cut_box2 = copy.deepcopy(cell_box[choose_index])
-                    cut_box1[3] = cell_box[choose_index][1] + (
-                        1 + random.random() * random.choice([-cut_ratio, cut_ratio])) * height * cut_y_ratio
-                    cut_box2[1] = cell_box[choose_index][1] + (
-                        1 + random.random() * random.choice([-cut_ratio, cut_ratio])) * height * cut_y_ratio
-                    text1 = texts[i][choose_index]
-                    text2 = texts[i][choose_index]
-                else:  # x y两者都cut
-                    cut_x_ratio = random.random()
-                    cut_x_ratio = cut_x_ratio if cut_x_ratio < 0.5 else 1 - cut_x_ratio
-                    cut_y_ratio = random.random()
-                    cut_y_ratio = cut_y_ratio if cut_y_ratio < 0.5 else 1 - cut_y_ratio
-                    cut_box1 = copy.deepcopy(cell_box[choose_index])
-                    cut_box2 = copy.deepcopy(cell_box[choose_index])
-                    cut_box1[2] = cell_box[choose_index][0] + (1 + random.random() * cut_ratio) * width * cut_x_ratio
-                    cut_box2[0] = cell_box[choose_index][0] + (1 + random.random() * cut_ratio) * width * cut_x_ratio
-                    cut_box1[3] = cell_box[choose_index][1] + (1 + random.random() * cut_ratio) * height * cut_y_ratio
-                    cut_box2[1] = cell_box[choose_index][1] + (1 + random.random() * cut_ratio) * height * cut_y_ratio
-                    text1 = texts[i][choose_index][:int(cut_x_ratio * len(texts[i][choose_index]))]
-                    text2 = texts[i][choose_index][int(cut_x_ratio * len(texts[i][choose_index])):]
-                cut_box1 = refine_box(cut_box1)
-                cut_box2 = refine_box(cut_box2)
-                cell_boxes[i][choose_index] = cut_box1
-                cell_boxes[i].append(cut_box2)
-                if targets:
-                    targets[i].append(targets[i][choose_index])
-                texts[i][choose_index] = text1
-                texts[i].append(text2)
-            else:  # 做偏移
-                variety_strategy = random.random()
-                variety_box = cell_box[choose_index]
-                if variety_strategy < 0.4:  # 左右偏移
-                    variety_x0_ratio = random.random()
-                    variety_box[0] = cell_box[choose_index][0] + width * variety_x0_ratio * random.choice(
-                        [-variety_ratio, variety_ratio])
-                    variety_x1_ratio = random.random()
-                    variety_box[2] = cell_box[choose_index][2] + width * variety_x1_ratio * random.choice(
-                        [-variety_ratio, variety_ratio])
-                elif variety_strategy < 0.8:  # 上下偏移
-                    variety_y0_ratio = random.random()
-                    variety_box[1] = cell_box[choose_index][1] + height * variety_y0_ratio * random.choice(
-                        [-variety_ratio, variety_ratio])
-                    variety_y1_ratio = random.random()
-                    variety_box[3] = cell_box[choose_index][3] + height * variety_y1_ratio * random.choice(
-                        [-variety_ratio, variety_ratio])
-                else:  # 缩小/扩大
-                    variety_expand_ratio = random.random()
-                    expand_flag = random.choice([-1, 1])
-                    variety_box[
-                        0] = cell_box[choose_index][0] + width * variety_expand_ratio * expand_flag * variety_ratio
-                    variety_box[
-                        2] = cell_box[choose_index][2] - width * variety_expand_ratio * expand_flag * variety_ratio
-                    variety_box[
-                        1] = cell_box[choose_index][1] + height * variety_expand_ratio * expand_flag * variety_ratio
-                    variety_box[
-                        3] = cell_box[choose_index][3] - height * variety_expand_ratio * expand_flag * variety_ratio
-                variety_box = refine_box(variety_box)
-                if variety_box[0] < img_size[i][0]:
-                    variety_box[0] = img_size[i][0]
-                if variety_box[1] < img_size[i][1]:
-                    variety_box[1] = img_size[i][1]
-                if variety_box[2] > img_size[i][2]:
-                    variety_box[2] = img_size[i][2]
-                if variety_box[3] > img_size[i][3]:
-                    variety_box[3] = img_size[i][3]
-                cell_boxes[i][choose_index] = variety_box
-        if random.random() < delete_percent and len(cell_box) > 5:
-            delete_num = int(random.random() * delete_ratio * len(cell_box))  # 需要删除的框数量
-            for j in range(delete_num):
-                delete_index = int(random.random() * len(cell_box))
-                cell_boxes[i].pop(delete_index)
-                texts[i].pop(delete_index)
-                if targets:
-                    targets[i].pop(delete_index)
+                 cut_ratio, variety_ratio, delete_ratio, rng=None, encode_texts=None):
+    '''
+    对每张图的box做cut/偏移/删除增强，targets、texts(以及不为空的encode_texts)按变换后的box对齐，
+    rng为np.random.Generator，不传时新建一个
+    '''
+    if rng is None:
+        rng = np.random.default_rng()
+    cell_boxes = list(cell_boxes)
+    for i, (image, valid_range) in enumerate(zip(images, padding_edge)):
+        img_range = [valid_range[0], valid_range[1],
+                     int(image.shape[2]) - valid_range[2],
+                     int(image.shape[1]) - valid_range[3]]  # [l, t, r, d]
+        cell_boxes[i], src_index, text_range = variety_cell_box(cell_boxes[i], img_range, rng, cut_percent,
+                                                                variety_percent, delete_percent, cut_ratio,
+                                                                variety_ratio, delete_ratio)
+        texts[i] = [
+            texts[i][index][int(start * len(texts[i][index])):int(end * len(texts[i][index]))]
+            for index, (start, end) in zip(src_index.tolist(), text_range.tolist())
+        ]
+        if targets:
+            targets[i] = [targets[i][index] for index in src_index.tolist()]
+        if encode_texts and len(encode_texts[i]) > 0:
+            encode_texts[i] = [encode_texts[i][index] for index in src_index.tolist()]
     return cell_boxes, targets, texts
 
 
-def refine_box(box_coord):
-    if box_coord[1] > box_coord[3]:
-        box_coord[1], box_coord[3] = box_coord[3], box_coord[1]
-    if box_coord[0] > box_coord[2]:
-        box_coord[0], box_coord[2] = box_coord[2], box_coord[0]
-    return box_coord
+def variety_cell_box(cell_box, img_range, rng, cut_percent, variety_percent, delete_percent, cut_ratio,
+                     variety_ratio, delete_ratio):
+    '''
+    单张图[N,4]的box增强，返回新的box[M,4]、每个新box对应的原box下标src_index[M]、
+    每个新box取原文本的比例范围text_range[M,2](cut的两个框分别取文本的前后两段，其余为[0, 1])
+    '''
+    cell_box = np.array(cell_box, dtype=np.float64).reshape(-1, 4)
+    box_num = len(cell_box)
+    text_range = np.tile(np.array([[0.0, 1.0]]), (box_num, 1))
+    choose_index = rng.choice(box_num, int((cut_percent + variety_percent) * box_num),
+                              replace=False)  # 随机选出需要做变换（包括cut和偏移）的框index
+    cut_flag = rng.random(len(choose_index)) < cut_percent / max(cut_percent + variety_percent, 1e-12)
+    width = cell_box[:, 2] - cell_box[:, 0]
+    height = cell_box[:, 3] - cell_box[:, 1]
+
+    # 偏移：左右偏移、上下偏移、缩小/扩大
+    variety_index = choose_index[~cut_flag]
+    if len(variety_index) > 0:
+        variety_num = len(variety_index)
+        wh = np.stack([width[variety_index], height[variety_index]] * 2, axis=1)
+        variety_strategy = rng.random(variety_num)
+        shift = rng.random((variety_num, 4)) * rng.choice([-variety_ratio, variety_ratio], (variety_num, 4))
+        shift[variety_strategy < 0.4] *= [1, 0, 1, 0]
+        shift[(variety_strategy >= 0.4) & (variety_strategy < 0.8)] *= [0, 1, 0, 1]
+        expand_flag = variety_strategy >= 0.8
+        shift[expand_flag] = (rng.random(variety_num) * rng.choice([-1, 1], variety_num) * variety_ratio)[
+            expand_flag, None] * [1, 1, -1, -1]
+        variety_box = refine_boxes(cell_box[variety_index] + shift * wh)
+        variety_box[:, :2] = np.maximum(variety_box[:, :2], img_range[:2])
+        variety_box[:, 2:] = np.minimum(variety_box[:, 2:], img_range[2:])
+        cell_box[variety_index] = variety_box
+
+    # cut：只在x方向把框切成两个，宽度小于50的不切
+    cut_index = choose_index[cut_flag]
+    cut_index = cut_index[width[cut_index] >= 50]
+    cut_num = len(cut_index)
+    cut_x_ratio = rng.random(cut_num)
+    cut_x_ratio = np.minimum(cut_x_ratio, 1 - cut_x_ratio)
+    cut_x = [
+        cell_box[cut_index, 0] + (1 + rng.random(cut_num) * rng.choice([-cut_ratio, cut_ratio], cut_num)) *
+        width[cut_index] * cut_x_ratio for _ in range(2)
+    ]
+    cut_box1, cut_box2 = cell_box[cut_index], cell_box[cut_index]
+    cut_box1[:, 2], cut_box2[:, 0] = cut_x
+    cell_box[cut_index] = refine_boxes(cut_box1)
+    text_range[cut_index, 1] = cut_x_ratio
+    cell_box = np.concatenate([cell_box, refine_boxes(cut_box2)], axis=0)
+    src_index = np.concatenate([np.arange(box_num), cut_index])
+    text_range = np.concatenate([text_range, np.stack([cut_x_ratio, np.ones(cut_num)], axis=1)], axis=0)
+
+    # 删除：不放回地随机删掉一部分框
+    if rng.random() < delete_percent and len(cell_box) > 5:
+        delete_num = int(rng.random() * delete_ratio * len(cell_box))  # 需要删除的框数量
+        keep_flag = np.ones(len(cell_box), dtype=bool)
+        keep_flag[rng.choice(len(cell_box), delete_num, replace=False)] = False
+        cell_box, src_index, text_range = cell_box[keep_flag], src_index[keep_flag], text_range[keep_flag]
+    return cell_box, src_index, text_range
+
+
+def refine_boxes(boxes):
+    '''保证[N,4]的box满足x0<=x1、y0<=y1'''
+    return np.concatenate([np.minimum(boxes[:, :2], boxes[:, 2:]), np.maximum(boxes[:, :2], boxes[:, 2:])], axis=1)
 
 
 def variety_cell_v1(cell_boxes, targets, cut_percent):
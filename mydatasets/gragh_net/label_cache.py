@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# software: PyCharm
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from base.driver import logger
+
+
+class GraphLabelCache(object):
+    '''
+    所有label只解析一次，按列存成npy(box、label id、文本字节和偏移、linking)，之后用mmap只读打开。
+    DataLoader的各个worker共享同一份page cache，不用每个epoch每个worker重新解析json，多次运行也能复用。
+    缓存目录名里带有label路径列表和每个文件大小、mtime的hash，增删label或者原地修改、替换label文件都会重新生成。
+    '''
+    column_name_list = ['valid', 'box_offsets', 'boxes', 'label_ids', 'text_offsets', 'text_bytes', 'link_offsets',
+                        'links']
+
+    def __init__(self, cache_dir, label_path_list, parse_label, cache_name='label'):
+        cache_key = hashlib.md5('\n'.join(self._get_label_stat(label_path_list)).encode('utf-8')).hexdigest()
+        self.cache_path = os.path.join(cache_dir, '{}_{}'.format(cache_name, cache_key))
+        if not os.path.exists(os.path.join(self.cache_path, 'meta.json')):
+            self._build(label_path_list, parse_label)
+        with open(os.path.join(self.cache_path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        assert meta['label_num'] == len(label_path_list), 'label cache broken:{}'.format(self.cache_path)
+        self.label_num = meta['label_num']
+        self.label_vocab = meta['label_vocab']
+        self._columns = None
+
+    @staticmethod
+    def _get_label_stat(label_path_list):
+        '''和get_file_path_index一样用stat判断文件有没有变，只stat不读文件'''
+        for label_path in label_path_list:
+            label_stat = os.stat(label_path)
+            yield '{}|{}|{}'.format(label_path, label_stat.st_size, label_stat.st_mtime_ns)
+
+    def __len__(self):
+        return self.label_num
+
+    def __getstate__(self):
+        # mmap不跟着pickle走，worker里第一次读的时候再打开
+        state = self.__dict__.copy()
+        state['_columns'] = None
+        return state
+
+    def _get_columns(self):
+        if self._columns is None:
+            self._columns = {
+                name: np.load(os.path.join(self.cache_path, name + '.npy'), mmap_mode='r')
+                for name in self.column_name_list
+            }
+        return self._columns
+
+    def get_box_num_list(self):
+        '''每个label的box数，无效的label为0'''
+        return np.diff(self._get_columns()['box_offsets'])
+
+    def __getitem__(self, index):
+        '''返回和json解析结果一样的dict，无效的label返回None'''
+        columns = self._get_columns()
+        if not columns['valid'][index]:
+            return None
+        box_start, box_end = columns['box_offsets'][index:index + 2]
+        text_offsets = columns['text_offsets'][box_start:box_end + 1]
+        text_bytes = columns['text_bytes'][text_offsets[0]:text_offsets[-1]].tobytes()
+        text_offsets = text_offsets - text_offsets[0]
+        link_start, link_end = columns['link_offsets'][index:index + 2]
+        return {
+            'cell_box': columns['boxes'][box_start:box_end].tolist(),
+            'target': [self.label_vocab[label_id] for label_id in columns['label_ids'][box_start:box_end]],
+            'text': [text_bytes[start:end].decode('utf-8') for start, end in zip(text_offsets[:-1], text_offsets[1:])],
+            'linking': [tuple(link) for link in columns['links'][link_start:link_end].tolist()],
+        }
+
+    def _build(self, label_path_list, parse_label):
+        logger.info('build label cache:{}'.format(self.cache_path))
+        valid, box_num_list, boxes, label_ids, text_len_list, text_bytes, link_num_list, links = [], [], [], [], [], [], [], []
+        label_vocab = {}
+        for label_path in label_path_list:
+            label = parse_label(label_path)
+            valid.append(label is not None)
+            if label is None:
+                box_num_list.append(0)
+                link_num_list.append(0)
+                continue
+            box_num_list.append(len(label['cell_box']))
+            boxes.extend(label['cell_box'])
+            label_ids.extend([label_vocab.setdefault(target, len(label_vocab)) for target in label['target']])
+            for text in label['text']:
+                text = text.encode('utf-8')
+                text_len_list.append(len(text))
+                text_bytes.append(text)
+            link_num_list.append(len(label.get('linking', [])))
+            links.extend(label.get('linking', []))
+        columns = {
+            'valid': np.array(valid, dtype=np.bool_),
+            'box_offsets': np.concatenate([[0], np.cumsum(box_num_list)]).astype(np.int64),
+            'boxes': np.array(boxes, dtype=np.float64).reshape(-1, 4),
+            'label_ids': np.array(label_ids, dtype=np.int32),
+            'text_offsets': np.concatenate([[0], np.cumsum(text_len_list)]).astype(np.int64),
+            'text_bytes': np.frombuffer(b''.join(text_bytes), dtype=np.uint8),
+            'link_offsets': np.concatenate([[0], np.cumsum(link_num_list)]).astype(np.int64),
+            'links': np.array(links, dtype=np.int64).reshape(-1, 2),
+        }
+        # 先写到临时目录再rename，多个进程同时生成时不会读到写了一半的缓存
+        tmp_path = '{}.tmp{}'.format(self.cache_path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        for name, column in columns.items():
+            np.save(os.path.join(tmp_path, name + '.npy'), column)
+        label_vocab = sorted(label_vocab, key=label_vocab.get)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({'label_num': len(label_path_list), 'label_vocab': label_vocab}, f)
+        try:
+            os.rename(tmp_path, self.cache_path)
+        except OSError:
+            # 其他进程已经生成好了
+            shutil.rmtree(tmp_path, ignore_errors=True)
@@ -11,8 +11,10 @@ import torch
 import copy
 from PIL import Image
 
-from base.common_util import get_file_path_list
+from base.common_util import get_file_path_list, get_file_path_index
 from base.driver import logger
+from .label_cache import GraphLabelCache
+from .text_emb_store import get_page_key, load_text_emb_store
 import random
 import cv2
 import json
@@ -21,6 +23,49 @@ import pickle
 import numpy as np
 
 
+def load_img(img_path, draft_size=None):
+    '''
+    读图并转成RGB，draft_size=(width, height)时JPEG用draft模式直接按1/2、1/4、1/8里不小于draft_size的最小尺度解码，
+    返回图片和相对原图的缩放比例(w_scale, h_scale)
+    '''
+    image = Image.open(img_path)
+    origin_width, origin_height = image.size
+    if draft_size is not None:
+        image.draft('RGB', draft_size)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    else:
+        image.load()
+    return image, (image.width / origin_width, image.height / origin_height)
+
+
+def scale_cell_box(cell_box, scale):
+    '''按load_img返回的缩放比例缩放box'''
+    if scale == (1, 1):
+        return cell_box
+    return (np.array(cell_box, dtype=np.float64).reshape(-1, 2) * np.array(scale)).reshape(-1, 4).tolist()
+
+
+def get_draft_size(draft_decode_flag=False, height=None, width=None, **kwargs):
+    '''draft_decode_flag打开时按模型输入的宽高降分辨率解码，height/width由experiment从model配置里带过来'''
+    if draft_decode_flag and height and width:
+        return width, height
+    return None
+
+
+def crop_img_by_cell_box(image, cell_box):
+    '''把图片裁剪到所有box的外接框，box坐标相应平移'''
+    cell_box = np.array(cell_box)
+    min_x = cell_box[:, [0, 2]].min()
+    min_y = cell_box[:, [1, 3]].min()
+    max_x = cell_box[:, [0, 2]].max()
+    max_y = cell_box[:, [1, 3]].max()
+    image = image.crop([min_x, min_y, max_x, max_y])
+    cell_box[:, [0, 2]] -= min_x
+    cell_box[:, [1, 3]] -= min_y
+    return image, cell_box.tolist()
+
+
 class GraphLayoutDataset(Dataset):
 
     def __init__(self, data_root, label_root, **kwargs):
@@ -28,113 +73,172 @@ class GraphLayoutDataset(Dataset):
         self.file_path_list = []
         self.label_path_list = []
         for i, data_path in enumerate(label_root):
+            # 图片目录只扫描一次，之后查找图片路径只查集合
+            img_path_index = get_file_path_index(data_root[i], ['jpg', 'png', 'jpeg'],
+                                                 kwargs.get('file_index_cache_dir'))
             label_path_list = get_file_path_list(data_path, ['json'])
             for label_path in label_path_list:
                 self.label_path_list.append(label_path)
                 img_path = label_path.replace(data_path,
                                               data_root[i]).replace('/graph_labels/',
                                                                     '/ocr_results_images/').replace('.json', '.jpg')
-                if not os.path.exists(img_path):
+                if not self._img_path_exists(img_path, data_root[i], img_path_index):
                     img_path = img_path.replace('/ocr_results_images/', '/images/')
-                if not os.path.exists(img_path):
+                if not self._img_path_exists(img_path, data_root[i], img_path_index):
                     img_path = img_path.replace('.jpg', '.png')
-                if not os.path.exists(img_path):
+                if not self._img_path_exists(img_path, data_root[i], img_path_index):
                     img_path = img_path.replace('.png', '.jpeg')
                 self.file_path_list.append(img_path)
         self.label_list = [None] * len(self.label_path_list)
+        # 有label缓存时文本编码单独记下来，和没有缓存时一样每个样本只编码一次
+        self.encode_text_list = [None] * len(self.label_path_list)
         self.crop_img_flag = kwargs['crop_img_flag']
+        self.draft_size = get_draft_size(**kwargs)
         self.encode_text_type = kwargs.get('encode_text_type', None)
+        self.text_emb_store = None
         if self.encode_text_type == 'spacy':
-            import spacy
-            self.text_emb = spacy.load('en_core_web_lg')
+            text_emb_dir = kwargs.get('text_emb_dir')
+            # 直接读mytools/precompute_text_emb.py离线算好的向量，不用加载spacy
+            self.text_emb_store = load_text_emb_store(text_emb_dir, get_page_key(self.label_path_list),
+                                                      len(self.label_path_list))
+            if self.text_emb_store is None:
+                if text_emb_dir:
+                    logger.warning('no precomputed text emb for {} in {}, use spacy'.format(label_root, text_emb_dir))
+                import spacy
+                self.text_emb = spacy.load('en_core_web_lg')
+        # 配置了label_cache_dir时label解析一次后存成mmap的列存储，各个worker共享，跨epoch和多次运行复用
+        self.label_cache = None
+        if kwargs.get('label_cache_dir'):
+            self.label_cache = GraphLabelCache(kwargs['label_cache_dir'], self.label_path_list, self._parse_label,
+                                               type(self).__name__)
 
     def __len__(self):
         return len(self.file_path_list)
 
+    def get_box_num_list(self):
+        '''
+        每个样本的box数，给GraphBucketBatchSampler分桶用，无效的label为0；
+        没有label缓存时会先把label都解析一遍，只数box，不做文本编码
+        '''
+        if self.label_cache is not None:
+            return self.label_cache.get_box_num_list()
+        box_num_list = []
+        for index in range(len(self)):
+            label = self.label_list[index]
+            if label is None:
+                label = self._parse_label(self.label_path_list[index])
+            box_num_list.append(len(label['cell_box']) if label is not None else 0)
+        return box_num_list
+
+    @staticmethod
+    def _img_path_exists(img_path, data_root, img_path_index):
+        if os.path.abspath(img_path).startswith(os.path.join(os.path.abspath(data_root), '')):
+            return os.path.abspath(img_path) in img_path_index
+        return os.path.exists(img_path)
+
     def __getitem__(self, index):
-        image = Image.open(self.file_path_list[index]).convert("RGB")
-        if self.label_list[index] is None:
-            with open(self.label_path_list[index], 'r') as f:
-                try:
-                    json_data = json.load(f)
-                except:
-                    logger.warning('bad json:{}'.format(self.label_path_list[index]))
-                    return self[index - 1]
-                cell_box, cell_lloc, cell_content, encode_text = [], [], [], []
-                for item in json_data['img_data_list']:
-                    # TODO 可以过滤一些文本框不去预测
-                    if len(item['content']) > 0 and item['text_coor'][2] > item['text_coor'][0] and item['text_coor'][3] > item['text_coor'][1]:
-                        cell_box.append(item['text_coor'])
-                        cell_lloc.append(item['label'])
-                        cell_content.append(item['content'])
-                        if self.encode_text_type == 'spacy':
-                            textout = self.text_emb(item['content']).vector
-                            encode_text.append(textout)
-                if len(cell_box) == 0:
-                    return self[index - 1]
-            if self.crop_img_flag:
-                cell_box = np.array(cell_box)
-                min_x = cell_box[:, [0, 2]].min()
-                min_y = cell_box[:, [1, 3]].min()
-                max_x = cell_box[:, [0, 2]].max()
-                max_y = cell_box[:, [1, 3]].max()
-                image = image.crop([min_x, min_y, max_x, max_y])
-                cell_box[:, [0, 2]] -= min_x
-                cell_box[:, [1, 3]] -= min_y
-                cell_box = cell_box.tolist()
-            self.label_list[index] = {
-                "cell_box": cell_box,
-                'target': cell_lloc,
-                'text': cell_content,
-                'encode_text': encode_text
-            }
+        label = self._get_label(index)
+        if label is None:
+            return self[index - 1]
+        image, scale = load_img(self.file_path_list[index], self.draft_size)
+        cell_box = scale_cell_box(label['cell_box'], scale)
+        if self.crop_img_flag:
+            image, cell_box = crop_img_by_cell_box(image, cell_box)
         return {
             "image": image,
             'image_name': self.file_path_list[index],
-            "cell_box": self.label_list[index]['cell_box'],
-            'target': self.label_list[index]['target'],
-            'text': self.label_list[index]['text'],
-            'encode_text': self.label_list[index]['encode_text']
+            "cell_box": cell_box,
+            'target': label['target'],
+            'text': label['text'],
+            'encode_text': label['encode_text']
+        }
+
+    def _get_label(self, index):
+        '''读取第index个label，没有缓存时解析后存在self.label_list里，无效的label返回None'''
+        if self.label_cache is not None:
+            label = self.label_cache[index]
+            if label is not None:
+                if self.encode_text_list[index] is None:
+                    self.encode_text_list[index] = self._encode_text(index, label['text'])
+                label['encode_text'] = self.encode_text_list[index]
+            return label
+        if self.label_list[index] is None:
+            label = self._parse_label(self.label_path_list[index])
+            if label is None:
+                return None
+            label['encode_text'] = self._encode_text(index, label['text'])
+            self.label_list[index] = label
+        return self.label_list[index]
+
+    def _encode_text(self, index, text_list):
+        if self.text_emb_store is not None:
+            text_emb = self.text_emb_store[index]
+            assert len(text_emb) == len(text_list), 'text emb mismatch:{}'.format(self.label_path_list[index])
+            return list(text_emb.astype(np.float32))
+        if self.encode_text_type == 'spacy':
+            return [self.text_emb(text).vector for text in text_list]
+        return []
+
+    def _parse_label(self, label_path):
+        with open(label_path, 'r') as f:
+            try:
+                json_data = json.load(f)
+            except:
+                logger.warning('bad json:{}'.format(label_path))
+                return None
+        cell_box, cell_lloc, cell_content = [], [], []
+        for item in json_data['img_data_list']:
+            # TODO 可以过滤一些文本框不去预测
+            if len(item['content']) > 0 and item['text_coor'][2] > item['text_coor'][0] and item['text_coor'][3] > item['text_coor'][1]:
+                cell_box.append(item['text_coor'])
+                cell_lloc.append(item['label'])
+                cell_content.append(item['content'])
+        if len(cell_box) == 0:
+            return None
+        return {
+            "cell_box": cell_box,
+            'target': cell_lloc,
+            'text': cell_content,
         }
 
 
 class GraphLayoutEntityDataset(GraphLayoutDataset):
 
     def __getitem__(self, index):
-        image = Image.open(self.file_path_list[index]).convert("RGB")
-        if self.label_list[index] is None:
-            with open(self.label_path_list[index], 'r') as f:
-                json_data = json.load(f)
-                cell_box, cell_lloc, cell_content, linking, encode_text = [], [], [], [], []
-                for item in json_data['img_data_list']:
-                    cell_box.append(item['text_coor'])
-                    cell_lloc.append(item['label'])
-                    cell_content.append(item['content'])
-                    linking.append(item['linking'])
-                    if self.encode_text_type == 'spacy':
-                        textout = self.text_emb(item['content']).vector
-                        encode_text.append(textout)
-                label_index_list = [int(label.split("_")[1]) for label in cell_lloc]
-                linking = [(label_index_list.index(link[0]), label_index_list.index(link[1]))
-                           for link_list in linking
-                           for link in link_list]
-                linking = [link if link[0] < link[1] else (link[1], link[0]) for link in linking]
-                linking = [link for link in linking if link[0] != link[1]]
-                if len(cell_box) == 0:
-                    return self[index + 1]
-                self.label_list[index] = {
-                    "cell_box": cell_box,
-                    'target': cell_lloc,
-                    'text': cell_content,
-                    'linking': linking,
-                    'encode_text': encode_text
-                }
+        label = self._get_label(index)
+        if label is None:
+            return self[index + 1]
+        image, scale = load_img(self.file_path_list[index], self.draft_size)
         return {
             "image": image,
             'image_name': self.file_path_list[index],
-            "cell_box": self.label_list[index]['cell_box'],
-            'target': self.label_list[index]['target'],
-            'text': self.label_list[index]['text'],
-            'linking': self.label_list[index]['linking'],
-            'encode_text': self.label_list[index]['encode_text']
+            "cell_box": scale_cell_box(label['cell_box'], scale),
+            'target': label['target'],
+            'text': label['text'],
+            'linking': label['linking'],
+            'encode_text': label['encode_text']
+        }
+
+    def _parse_label(self, label_path):
+        with open(label_path, 'r') as f:
+            json_data = json.load(f)
+        cell_box, cell_lloc, cell_content, linking = [], [], [], []
+        for item in json_data['img_data_list']:
+            cell_box.append(item['text_coor'])
+            cell_lloc.append(item['label'])
+            cell_content.append(item['content'])
+            linking.append(item['linking'])
+        label_index_list = [int(label.split("_")[1]) for label in cell_lloc]
+        linking = [(label_index_list.index(link[0]), label_index_list.index(link[1]))
+                   for link_list in linking
+                   for link in link_list]
+        linking = [link if link[0] < link[1] else (link[1], link[0]) for link in linking]
+        linking = [link for link in linking if link[0] != link[1]]
+        if len(cell_box) == 0:
+            return None
+        return {
+            "cell_box": cell_box,
+            'target': cell_lloc,
+            'text': cell_content,
+            'linking': linking,
         }
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# software: PyCharm
+import io
+import json
+import os
+import pickle
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+
+from base.driver import logger
+from .layout_dataset import crop_img_by_cell_box, load_img, scale_cell_box, get_draft_size
+from .text_emb_store import load_text_emb_store
+
+
+class GraphPackedWriter(object):
+    '''
+    打包格式：样本pickle后顺序追加写进shard_xxxxx.bin，单个shard超过shard_size后换下一个文件，
+    index.npy按样本顺序记录(shard下标, offset, length)，box_num.npy记录每个样本的box数，meta.json记录shard文件列表
+    '''
+
+    def __init__(self, save_dir, shard_size=1 << 30):
+        self.save_dir = save_dir
+        self.shard_size = shard_size
+        os.makedirs(save_dir, exist_ok=True)
+        self.shard_list = []
+        self.index_list = []
+        self.box_num_list = []
+        self.shard_file = None
+        self.shard_offset = 0
+
+    def write(self, sample):
+        data = pickle.dumps(sample, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.shard_file is None or self.shard_offset + len(data) > self.shard_size and self.shard_offset > 0:
+            self._open_shard()
+        self.shard_file.write(data)
+        self.index_list.append((len(self.shard_list) - 1, self.shard_offset, len(data)))
+        self.shard_offset += len(data)
+        self.box_num_list.append(len(sample['cell_box']))
+
+    def _open_shard(self):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        shard_name = 'shard_{:05d}.bin'.format(len(self.shard_list))
+        self.shard_list.append(shard_name)
+        self.shard_file = open(os.path.join(self.save_dir, shard_name), 'wb')
+        self.shard_offset = 0
+
+    def close(self, **meta):
+        if self.shard_file is not None:
+            self.shard_file.close()
+        np.save(os.path.join(self.save_dir, 'index.npy'), np.array(self.index_list, dtype=np.int64).reshape(-1, 3))
+        np.save(os.path.join(self.save_dir, 'box_num.npy'), np.array(self.box_num_list, dtype=np.int64))
+        meta.update({'shard_list': self.shard_list, 'sample_num': len(self.index_list)})
+        with open(os.path.join(self.save_dir, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+
+class GraphLayoutPackedDataset(Dataset):
+    '''
+    读mytools/pack_graph_dataset.py打包好的数据，构造时只读index，样本从mmap的shard里按offset取，
+    没有打包图片时按image_name读原图；encode_text_type为spacy时按meta.json里的page_key从text_emb_dir读离线算好的向量，
+    没有时再用spacy
+    '''
+    entity_flag = False
+
+    def __init__(self, packed_root, **kwargs):
+        super(GraphLayoutPackedDataset, self).__init__()
+        self.packed_root = packed_root if isinstance(packed_root, list) else [packed_root]
+        self.shard_path_list = []
+        # 每个shard属于第几个packed_root
+        self.shard_packed_index = []
+        index_list = []
+        meta_list = []
+        for packed_index, packed_dir in enumerate(self.packed_root):
+            with open(os.path.join(packed_dir, 'meta.json'), 'r') as f:
+                meta = json.load(f)
+            assert meta.get('entity', False) == self.entity_flag, \
+                '{} is not packed for {}'.format(packed_dir, type(self).__name__)
+            index = np.load(os.path.join(packed_dir, 'index.npy'))
+            # shard下标换成全局shard列表里的下标
+            index[:, 0] += len(self.shard_path_list)
+            index_list.append(index)
+            self.shard_path_list.extend([os.path.join(packed_dir, shard_name) for shard_name in meta['shard_list']])
+            self.shard_packed_index.extend([packed_index] * len(meta['shard_list']))
+            meta_list.append(meta)
+        self.index = np.concatenate(index_list, axis=0)
+        self.crop_img_flag = kwargs.get('crop_img_flag', False)
+        self.draft_size = get_draft_size(**kwargs)
+        self.encode_text_type = kwargs.get('encode_text_type', None)
+        self.text_emb_store_list = [None] * len(self.packed_root)
+        if self.encode_text_type == 'spacy':
+            text_emb_dir = kwargs.get('text_emb_dir')
+            self.text_emb_store_list = [load_text_emb_store(text_emb_dir, meta.get('page_key'), meta.get('page_num'))
+                                        for meta in meta_list]
+            if any(text_emb_store is None for text_emb_store in self.text_emb_store_list):
+                if text_emb_dir:
+                    logger.warning('no precomputed text emb for {} in {}, use spacy'.format(
+                        [packed_dir for packed_dir, text_emb_store in zip(self.packed_root, self.text_emb_store_list)
+                         if text_emb_store is None], text_emb_dir))
+                import spacy
+                self.text_emb = spacy.load('en_core_web_lg')
+        self._shards = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getstate__(self):
+        # mmap不跟着pickle走，worker里第一次读的时候再打开
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def get_box_num_list(self):
+        '''每个样本的box数，给GraphBucketBatchSampler分桶用，老的打包数据没有box_num.npy时逐个读样本'''
+        box_num_list = []
+        for packed_dir in self.packed_root:
+            box_num_path = os.path.join(packed_dir, 'box_num.npy')
+            if not os.path.exists(box_num_path):
+                return [len(self._read_sample(index)['cell_box']) for index in range(len(self))]
+            box_num_list.append(np.load(box_num_path))
+        return np.concatenate(box_num_list)
+
+    def _read_sample(self, index):
+        shard_index, offset, length = self.index[index]
+        if shard_index not in self._shards:
+            self._shards[shard_index] = np.memmap(self.shard_path_list[shard_index], dtype=np.uint8, mode='r')
+        return pickle.loads(self._shards[shard_index][offset:offset + length].tobytes())
+
+    def __getitem__(self, index):
+        return self._decode_sample(self._read_sample(index), self.shard_packed_index[self.index[index][0]])
+
+    def _encode_text(self, sample, packed_index):
+        text_emb_store = self.text_emb_store_list[packed_index]
+        if text_emb_store is not None and 'page_index' in sample:
+            text_emb = text_emb_store[sample['page_index']]
+            assert len(text_emb) == len(sample['text']), 'text emb mismatch:{}'.format(sample['image_name'])
+            return list(text_emb.astype(np.float32))
+        if self.encode_text_type == 'spacy':
+            if not hasattr(self, 'text_emb'):
+                # 老的打包数据没有page_index
+                import spacy
+                self.text_emb = spacy.load('en_core_web_lg')
+            return [self.text_emb(text).vector for text in sample['text']]
+        return []
+
+    def _decode_sample(self, sample, packed_index=0):
+        image, scale = load_img(io.BytesIO(sample['image']) if sample['image'] is not None else sample['image_name'],
+                                self.draft_size)
+        cell_box = scale_cell_box(sample['cell_box'], scale)
+        if self.crop_img_flag:
+            image, cell_box = crop_img_by_cell_box(image, cell_box)
+        encode_text = self._encode_text(sample, packed_index)
+        return {
+            "image": image,
+            'image_name': sample['image_name'],
+            "cell_box": cell_box,
+            'target': sample['target'],
+            'text': sample['text'],
+            'linking': sample.get('linking', []),
+            'encode_text': encode_text
+        }
+
+
+class GraphLayoutPackedEntityDataset(GraphLayoutPackedDataset):
+    '''和GraphLayoutEntityDataset对应，打包时需要用--entity按entity的规则解析label'''
+    entity_flag = True
+
+    def __init__(self, packed_root, **kwargs):
+        super(GraphLayoutPackedEntityDataset, self).__init__(packed_root, **kwargs)
+        # entity数据不裁剪图片
+        self.crop_img_flag = False
+
+
+class GraphLayoutPackedIterableDataset(GraphLayoutPackedDataset, IterableDataset):
+    '''
+    流式读打包数据，用于很大的语料：每个epoch先用seed和epoch打乱shard顺序，再把所有样本按顺序平均切给
+    每个进程(rank)的每个worker，worker顺序读自己那一段(大多在一两个shard里)，经过shuffle_buffer_size大小的
+    buffer打乱后输出。buffer里只放没解码的字节，解码失败时记数并用上一个好的样本代替(每个epoch结束时报告替换了多少个)，
+    保证每个worker输出的样本数一样，多卡时各进程step数一致。
+    DataLoader里每个worker各自组batch，为了不出现每个worker一个不满的batch，每个worker的样本数向下取整到batch_size的倍数
+    (样本数不到一个batch时不取整)，__len__是本进程实际输出的样本数，data loader的长度和实际的batch数一致；
+    worker数和batch_size由experiment建data loader时通过set_data_loader_args传进来。
+    多卡时按rank切分，data loader不要再交给accelerate；不按rank切分(比如每张卡都跑完整的eval)时shard_by_rank设为false。
+    '''
+
+    def __init__(self, packed_root, **kwargs):
+        super(GraphLayoutPackedIterableDataset, self).__init__(packed_root, **kwargs)
+        self.shuffle_buffer_size = kwargs.get('shuffle_buffer_size', 1000)
+        self.seed = kwargs.get('seed', 0)
+        self.num_replicas, self.rank = 1, 0
+        if kwargs.get('shard_by_rank', True) and torch.distributed.is_available() and torch.distributed.is_initialized():
+            self.num_replicas, self.rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+        self.epoch = 0
+        self.error_num = 0
+        self.num_workers, self.batch_size = 1, 1
+
+    def set_data_loader_args(self, num_workers, batch_size):
+        '''num_workers为0时在主进程里读，相当于1个worker'''
+        self.num_workers = max(num_workers, 1)
+        self.batch_size = batch_size
+
+    def set_epoch(self, epoch):
+        '''每个epoch开始前调用，换一个shard顺序和buffer的随机数；没调用时每次迭代自动用下一个epoch'''
+        self.epoch = epoch
+
+    def __len__(self):
+        # 本进程实际输出的样本数
+        return self._get_per_worker_num(self.num_workers) * self.num_workers
+
+    def _get_per_worker_num(self, worker_num):
+        '''每个worker输出的样本数：平均切分后向下取整到batch_size的倍数'''
+        per_worker_num = len(self.index) // (self.num_replicas * worker_num)
+        if per_worker_num >= self.batch_size:
+            per_worker_num -= per_worker_num % self.batch_size
+        return per_worker_num
+
+    def _get_worker_index(self, epoch):
+        '''本worker负责的样本在self.index里的下标，按shard里的顺序排列'''
+        worker_info = get_worker_info()
+        worker_id, worker_num = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        rng = np.random.default_rng([self.seed, epoch])
+        shard_order = rng.permutation(len(self.shard_path_list))
+        # 按打乱后的shard顺序排样本，shard内保持写入顺序
+        shard_rank = np.empty_like(shard_order)
+        shard_rank[shard_order] = np.arange(len(shard_order))
+        sample_order = np.lexsort((self.index[:, 1], shard_rank[self.index[:, 0]]))
+        global_worker_id = self.rank * worker_num + worker_id
+        # 每个worker先平均分一段，取整到batch_size倍数后多出来的样本不用
+        per_worker_num = len(sample_order) // (self.num_replicas * worker_num)
+        start = global_worker_id * per_worker_num
+        return sample_order[start:start + self._get_per_worker_num(worker_num)]
+
+    def _iter_raw_sample(self, sample_index):
+        '''按顺序读样本的字节，和所在的packed_root下标一起返回，同一个shard只打开一次'''
+        shard_index, shard_file = None, None
+        try:
+            for index in sample_index:
+                sample_shard_index, offset, length = self.index[index]
+                if sample_shard_index != shard_index:
+                    if shard_file is not None:
+                        shard_file.close()
+                    shard_index = sample_shard_index
+                    shard_file = open(self.shard_path_list[shard_index], 'rb', buffering=1 << 20)
+                shard_file.seek(offset)
+                yield self.shard_packed_index[shard_index], shard_file.read(length)
+        finally:
+            if shard_file is not None:
+                shard_file.close()
+
+    def _decode_raw_sample(self, raw_sample):
+        packed_index, data = raw_sample
+        return self._decode_sample(pickle.loads(data), packed_index)
+
+    def _iter_shuffled(self, raw_iter, rng):
+        '''buffer装满后每进来一个就随机换出一个'''
+        buffer = []
+        for raw_sample in raw_iter:
+            if len(buffer) < self.shuffle_buffer_size:
+                buffer.append(raw_sample)
+                continue
+            swap_index = rng.integers(len(buffer))
+            yield buffer[swap_index]
+            buffer[swap_index] = raw_sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info is not None else 0
+        # persistent_workers时主进程的set_epoch到不了worker，worker里每次迭代自己往后推一个epoch
+        epoch = self.epoch
+        self.epoch += 1
+        rng = np.random.default_rng([self.seed, epoch, self.rank, worker_id])
+        last_raw_sample, missing_num, replace_num = None, 0, 0
+        for raw_sample in self._iter_shuffled(self._iter_raw_sample(self._get_worker_index(epoch)), rng):
+            try:
+                sample = self._decode_raw_sample(raw_sample)
+                last_raw_sample = raw_sample
+            except Exception as e:
+                self.error_num += 1
+                replace_num += 1
+                logger.warning('skip bad packed sample ({} errors in this worker): {}'.format(self.error_num, e))
+                if last_raw_sample is None:
+                    # 还没有好的样本可以代替，等读到第一个好的样本时补上
+                    missing_num += 1
+                    continue
+                sample = self._decode_raw_sample(last_raw_sample)
+            yield sample
+            for _ in range(missing_num):
+                yield self._decode_raw_sample(last_raw_sample)
+            missing_num = 0
+        if replace_num > 0:
+            # 替换的样本是重复的训练数据，每个epoch汇总报告一次
+            logger.warning('epoch {} rank {} worker {}: replaced {} bad packed samples with the last good sample{}'.format(
+                epoch, self.rank, worker_id, replace_num - missing_num,
+                ', {} samples missing because no sample could be decoded'.format(missing_num) if missing_num else ''))
+
+
+class GraphLayoutPackedEntityIterableDataset(GraphLayoutPackedIterableDataset):
+    '''GraphLayoutPackedEntityDataset的流式版本'''
+    entity_flag = True
+
+    def __init__(self, packed_root, **kwargs):
+        super(GraphLayoutPackedEntityIterableDataset, self).__init__(packed_root, **kwargs)
+        # entity数据不裁剪图片
+        self.crop_img_flag = False
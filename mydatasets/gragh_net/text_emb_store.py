@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+# software: PyCharm
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+def get_page_key(page_key_list):
+    '''页列表(label路径)的hash，打包数据在meta.json里记下打包时的page_key'''
+    return hashlib.md5('\n'.join(page_key_list).encode('utf-8')).hexdigest()
+
+
+def get_text_emb_path(text_emb_dir, page_key):
+    '''一个text_emb_dir下可以放多份向量(比如train和val)，子目录名里带页列表的hash，和dataset的页一一对应'''
+    return os.path.join(text_emb_dir, 'text_emb_{}'.format(page_key))
+
+
+def load_text_emb_store(text_emb_dir, page_key, page_num):
+    '''text_emb_dir下有这份页列表的向量时返回GraphTextEmbStore，没有时返回None，由dataset退回到spacy'''
+    if text_emb_dir and page_key and os.path.exists(os.path.join(get_text_emb_path(text_emb_dir, page_key), 'meta.json')):
+        return GraphTextEmbStore(text_emb_dir, page_key, page_num)
+    return None
+
+
+def save_text_emb(text_emb_dir, page_key_list, text_num_list, vector_iter, dim, **meta):
+    '''
+    vector_iter按页、页内按box顺序逐个给出文本向量，float16写进mmap打开的vectors.npy，不用把所有向量放在内存里；
+    meta.json最后写，没写完的目录不会被GraphTextEmbStore读到
+    '''
+    save_dir = get_text_emb_path(text_emb_dir, get_page_key(page_key_list))
+    os.makedirs(save_dir, exist_ok=True)
+    offsets = np.concatenate([[0], np.cumsum(text_num_list)]).astype(np.int64)
+    np.save(os.path.join(save_dir, 'offsets.npy'), offsets)
+    vectors = np.lib.format.open_memmap(os.path.join(save_dir, 'vectors.npy'), mode='w+', dtype=np.float16,
+                                        shape=(int(offsets[-1]), dim))
+    text_num = 0
+    for vector in vector_iter:
+        vectors[text_num] = vector
+        text_num += 1
+    assert text_num == offsets[-1], 'got {} vectors for {} texts'.format(text_num, offsets[-1])
+    vectors.flush()
+    del vectors
+    meta.update({'page_num': len(page_key_list), 'text_num': text_num, 'dim': dim})
+    with open(os.path.join(save_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return save_dir
+
+
+class GraphTextEmbStore(object):
+    '''
+    读mytools/precompute_text_emb.py离线算好的文本向量：vectors.npy是float16的[文本总数, dim]，
+    offsets.npy记录每页文本的起止，按页下标取[该页文本数, dim]，mmap只读打开，worker间共享page cache
+    '''
+
+    def __init__(self, text_emb_dir, page_key, page_num):
+        self.emb_dir = get_text_emb_path(text_emb_dir, page_key)
+        with open(os.path.join(self.emb_dir, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        assert meta['page_num'] == page_num, 'text emb broken:{}'.format(self.emb_dir)
+        self.page_num = meta['page_num']
+        self.dim = meta['dim']
+        self._offsets = None
+        self._vectors = None
+
+    def __len__(self):
+        return self.page_num
+
+    def __getstate__(self):
+        # mmap不跟着pickle走，worker里第一次读的时候再打开
+        state = self.__dict__.copy()
+        state['_offsets'] = None
+        state['_vectors'] = None
+        return state
+
+    def __getitem__(self, index):
+        if self._vectors is None:
+            self._offsets = np.load(os.path.join(self.emb_dir, 'offsets.npy'))
+            self._vectors = np.load(os.path.join(self.emb_dir, 'vectors.npy'), mmap_mode='r')
+        return self._vectors[self._offsets[index]:self._offsets[index + 1]]
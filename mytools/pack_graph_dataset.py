@@ -0,0 +1,85 @@
+# -*- coding:utf-8 -*-
+'''
+把graph_labels的json(和图片)打包成GraphLayoutPackedDataset/GraphLayoutPackedEntityDataset读取的分片二进制格式
+python mytools/pack_graph_dataset.py --data_root /open-dataset/OD-layout/DocLayNet_core \
+    --label_root /open-dataset/OD-layout/DocLayNet_core_graph_labels/train \
+    --save_dir /open-dataset/OD-layout/DocLayNet_core_packed/train --pack_image --max_side 1024
+'''
+import os, sys
+import io
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+from PIL import Image
+from tqdm import tqdm
+
+from mydatasets.gragh_net.layout_dataset import GraphLayoutDataset, GraphLayoutEntityDataset
+from mydatasets.gragh_net.packed_dataset import GraphPackedWriter
+from mydatasets.gragh_net.text_emb_store import get_page_key
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='pack graph layout dataset')
+    parser.add_argument('--data_root', nargs='+', required=True, type=str)
+    parser.add_argument('--label_root', nargs='+', required=True, type=str)
+    parser.add_argument('--save_dir', required=True, type=str)
+    parser.add_argument('--entity', action='store_true', help='按GraphLayoutEntityDataset的规则解析label(带linking)')
+    parser.add_argument('--pack_image', action='store_true', help='把图片也打包进去，否则读的时候按原路径读图')
+    parser.add_argument('--max_side', default=0, type=int, help='打包图片时最长边超过max_side就缩小，box同比例缩放，0表示不缩放')
+    parser.add_argument('--jpeg_quality', default=95, type=int)
+    parser.add_argument('--shard_size', default=1024, type=int, help='单个shard的大小(MB)')
+    return parser.parse_args()
+
+
+def get_image_bytes(img_path, cell_box, max_side, jpeg_quality):
+    '''返回图片的字节和对应的box，不需要缩放时直接用原文件的字节'''
+    image = Image.open(img_path)
+    scale = max_side / max(image.size) if max_side > 0 else 1
+    if scale >= 1:
+        with open(img_path, 'rb') as f:
+            return f.read(), cell_box
+    image = image.convert('RGB').resize((round(image.width * scale), round(image.height * scale)), Image.BICUBIC)
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=jpeg_quality)
+    cell_box = [[coor * scale for coor in box] for box in cell_box]
+    return buffer.getvalue(), cell_box
+
+
+def main(args):
+    dataset_class = GraphLayoutEntityDataset if args.entity else GraphLayoutDataset
+    assert len(args.data_root) == len(args.label_root)
+    dataset = dataset_class(args.data_root, args.label_root, crop_img_flag=False)
+    writer = GraphPackedWriter(args.save_dir, args.shard_size << 20)
+    skip_num = 0
+    for page_index, (label_path, img_path) in enumerate(tqdm(zip(dataset.label_path_list, dataset.file_path_list),
+                                                             total=len(dataset.label_path_list))):
+        label = dataset._parse_label(label_path)
+        if label is None:
+            skip_num += 1
+            continue
+        cell_box, image = label['cell_box'], None
+        if args.pack_image:
+            image, cell_box = get_image_bytes(img_path, cell_box, args.max_side, args.jpeg_quality)
+        sample = {
+            'image_name': img_path,
+            'cell_box': cell_box,
+            'target': label['target'],
+            'text': label['text'],
+            'image': image,
+            # 在label列表里的下标，读mytools/precompute_text_emb.py算好的文本向量用
+            'page_index': page_index,
+        }
+        if args.entity:
+            sample['linking'] = label['linking']
+        writer.write(sample)
+    # page_key和page_num对应precompute_text_emb.py用同样的data_root、label_root生成的向量
+    writer.close(entity=args.entity, pack_image=args.pack_image, max_side=args.max_side,
+                 page_key=get_page_key(dataset.label_path_list), page_num=len(dataset.label_path_list))
+    print('packed {} samples into {}, skip {} empty or bad labels'.format(
+        len(writer.index_list), args.save_dir, skip_num))
+
+
+if __name__ == '__main__':
+    main(init_args())
@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+'''
+离线计算encode_text_type为spacy时的文本向量，dataset配置text_emb_dir后直接读，训练时不再加载spacy
+python mytools/precompute_text_emb.py --data_root /open-dataset/OD-layout/DocLayNet_core \
+    --label_root /open-dataset/OD-layout/DocLayNet_core_graph_labels/train \
+    --text_emb_dir /open-dataset/OD-layout/DocLayNet_core_text_emb --n_process 8
+data_root、label_root和--entity要和训练时dataset的配置一致，页的顺序和每页的文本都按dataset的解析结果来，
+train和val分别跑一次，存在同一个text_emb_dir下，dataset按自己的label列表找对应的那一份；
+打包数据按打包时的data_root、label_root跑，读的时候按meta.json里记录的page_key找
+'''
+import os, sys
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+import argparse
+from tqdm import tqdm
+
+from mydatasets.gragh_net.layout_dataset import GraphLayoutDataset, GraphLayoutEntityDataset
+from mydatasets.gragh_net.text_emb_store import save_text_emb
+
+
+def init_args():
+    parser = argparse.ArgumentParser(description='precompute spacy text embedding')
+    parser.add_argument('--data_root', nargs='+', required=True, type=str)
+    parser.add_argument('--label_root', nargs='+', required=True, type=str)
+    parser.add_argument('--text_emb_dir', required=True, type=str)
+    parser.add_argument('--entity', action='store_true', help='按GraphLayoutEntityDataset的规则解析label')
+    parser.add_argument('--model', default='en_core_web_lg', type=str)
+    parser.add_argument('--batch_size', default=1000, type=int, help='nlp.pipe的batch_size')
+    parser.add_argument('--n_process', default=1, type=int, help='nlp.pipe的进程数')
+    return parser.parse_args()
+
+
+def main(args):
+    import spacy
+    dataset_class = GraphLayoutEntityDataset if args.entity else GraphLayoutDataset
+    assert len(args.data_root) == len(args.label_root)
+    dataset = dataset_class(args.data_root, args.label_root, crop_img_flag=False)
+    text_num_list, text_list = [], []
+    for label_path in tqdm(dataset.label_path_list, desc='parse label'):
+        label = dataset._parse_label(label_path)
+        text = label['text'] if label is not None else []
+        text_num_list.append(len(text))
+        text_list.extend(text)
+    # doc.vector是词向量的平均，只需要分词，其他pipeline组件都不跑
+    nlp = spacy.load(args.model)
+    nlp.select_pipes(disable=nlp.pipe_names)
+    docs = nlp.pipe(text_list, batch_size=args.batch_size, n_process=args.n_process)
+    vector_iter = (doc.vector for doc in tqdm(docs, total=len(text_list), desc='encode text'))
+    save_dir = save_text_emb(args.text_emb_dir, dataset.label_path_list, text_num_list, vector_iter,
+                             nlp.vocab.vectors_length, model=args.model, entity=args.entity)
+    print('saved {} text vectors of {} pages into {}'.format(len(text_list), len(text_num_list), save_dir))
+
+
+if __name__ == '__main__':
+    main(init_args())
@@ -17,36 +17,36 @@ from torch_scatter import scatter
 from torch_geometric.nn.conv.gravnet_conv import GravNetConv
 from .dgcnn import build_graph
 
-def global_exchange(x: Tensor, batch: Tensor) -> Tensor:
+def global_exchange(x: Tensor, batch: Tensor, batch_size: int = None, batch_count: Tensor = None,
+                    debug: bool = False) -> Tensor:
     """
     Adds columns for the means, mins, and maxs per feature, per batch.
     Assumes x: (n_hits x n_features), batch: (n_hits),
     and that the batches are sorted!
+    batch_size/batch_count (n_hits per batch) can be computed once per forward and passed in,
+    debug turns on the checks that need a device sync.
     """
-    device = x.device
-    batch_numbers, batch_counts = torch.unique(batch, return_counts=True)
-    batch_size = batch_counts.size()[0]
     n_hits, n_features = x.size()
+    if batch_size is None:
+        batch_size = int(batch.max()) + 1
+    if batch_count is None:
+        batch_count = torch.bincount(batch, minlength=batch_size)
 
     # minmeanmax: (batch_size x 3*n_features)
-    meanminmax = torch.cat((scatter(x, batch, dim=0, reduce='mean'), scatter(x, batch, dim=0, reduce='min'), scatter(x, batch, dim=0, reduce='max')),
-                           dim=-1)
-    assert meanminmax.size() == (batch_size, 3 * n_features)
-
-    # (batch_size x 3*n_features) --> (n_hits x 3*n_features),
-    # by copying the minmeanmax per batch by the counts per batch.
-    # Not sure if for-loop can be avoided here.
-    # This assumes the batch tensor is sorted!
-    meanminmax = torch.cat(
-        [meanminmax[i_batch].unsqueeze(dim=0).expand(batch_count, 3 * n_features) for i_batch, batch_count in zip(batch_numbers, batch_counts)],
-        dim=0)
-    assert meanminmax.size() == (n_hits, 3 * n_features)
+    mean = scatter(x, batch, dim=0, dim_size=batch_size, reduce='sum') / batch_count.clamp(min=1).unsqueeze(1).to(x.dtype)
+    meanminmax = torch.cat((mean, scatter(x, batch, dim=0, dim_size=batch_size, reduce='min'),
+                            scatter(x, batch, dim=0, dim_size=batch_size, reduce='max')), dim=-1)
+
+    # (batch_size x 3*n_features) --> (n_hits x 3*n_features), gather the stats of every node's batch
+    meanminmax = meanminmax[batch]
 
     # Add as columns to feature tensor
     out = torch.cat((meanminmax, x), dim=-1)
-    assert out.size() == (n_hits, 4 * n_features)
-
-    assert all(t.device == device for t in [batch_numbers, batch_counts, meanminmax, out, x, batch])
+    if debug:
+        assert bool((batch[1:] >= batch[:-1]).all()), 'batch must be sorted'
+        assert int(batch_count.sum()) == n_hits
+        assert out.size() == (n_hits, 4 * n_features)
+        assert all(t.device == x.device for t in [batch_count, meanminmax, out, batch])
     return out
 
 
@@ -74,8 +74,9 @@ def global_exchange(x: Tensor, batch: Tensor) -> Tensor:
 
 class GravNetBlock(nn.Module):
 
-    def __init__(self, in_channels: int, out_channels: int = 96, space_dimensions: int = 4, propagate_dimensions: int = 22, k: int = 40):
+    def __init__(self, in_channels: int, out_channels: int = 96, space_dimensions: int = 4, propagate_dimensions: int = 22, k: int = 40, debug: bool = False):
         super(GravNetBlock, self).__init__()
+        self.debug = debug
         # Includes all layers up to the global_exchange
         self.gravnet_layer = GravNetConv(in_channels, out_channels, space_dimensions, propagate_dimensions, k)
         self.post_gravnet = nn.Sequential(
@@ -88,11 +89,11 @@ class GravNetBlock(nn.Module):
         )
         self.output = nn.Sequential(nn.Linear(4 * 96, 96), nn.Tanh(), nn.BatchNorm1d(96))
 
-    def forward(self, x: Tensor, batch: Tensor) -> Tensor:
+    def forward(self, x: Tensor, batch: Tensor, batch_size: int = None, batch_count: Tensor = None) -> Tensor:
         x = self.gravnet_layer(x, batch)
         x = self.post_gravnet(x)
         assert x.size(1) == 96
-        x = global_exchange(x, batch)
+        x = global_exchange(x, batch, batch_size, batch_count, self.debug)
         x = self.output(x)
         assert x.size(1) == 96
         return x
@@ -106,13 +107,15 @@ class GravnetModule(nn.Module):
         self.output_dim = output_dim
         self.n_gravnet_blocks = n_gravnet_blocks
         self.n_postgn_dense_blocks = n_postgn_dense_blocks
+        # 打开后global_exchange里做需要同步device的检查
+        self.debug = kwargs.get('gravnet_debug', False)
 
         self.batchnorm1 = nn.BatchNorm1d(self.input_dim)
         self.input = nn.Linear(4 * input_dim, 64)
 
         # Note: out_channels of the internal gravnet layer
         # not clearly specified in paper
-        self.gravnet_blocks = nn.ModuleList([GravNetBlock(64 if i == 0 else 96) for i in range(self.n_gravnet_blocks)])
+        self.gravnet_blocks = nn.ModuleList([GravNetBlock(64 if i == 0 else 96, debug=self.debug) for i in range(self.n_gravnet_blocks)])
 
         # Post-GravNet dense layers
         postgn_dense_modules = nn.ModuleList()
@@ -133,13 +136,16 @@ class GravnetModule(nn.Module):
         device = fusion_feat.device
         # print('forward called on device', device)
         x = self.batchnorm1(graphs.x)
-        x = global_exchange(x, graphs.batch)
+        # 每个图的节点数每次forward只算一次，各个block共用
+        batch_size = graphs.num_graphs
+        batch_count = torch.bincount(graphs.batch, minlength=batch_size)
+        x = global_exchange(x, graphs.batch, batch_size, batch_count, self.debug)
         x = self.input(x)
         assert x.device == device
 
         x_gravnet_per_block = []  # To store intermediate outputs
         for gravnet_block in self.gravnet_blocks:
-            x = gravnet_block(x, graphs.batch)
+            x = gravnet_block(x, graphs.batch, batch_size, batch_count)
             x_gravnet_per_block.append(x)
         x = torch.cat(x_gravnet_per_block, dim=-1)
         assert x.size() == (x.size(0), 4 * 96)
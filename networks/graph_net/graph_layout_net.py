@@ -3,21 +3,18 @@
 # author:weishu
 # datetime:2023/2/8 11:36 上午
 # software: PyCharm
-import copy
 import math
 import torch.nn.functional as F
-import random
 import torch
 import torch.nn as nn
 from torch.nn import init
-import numpy as np
 from torchvision import ops
 from torchvision.models.detection.backbone_utils import resnet_fpn_backbone
 from torchvision.models.detection import fasterrcnn_resnet50_fpn_v2, FasterRCNN_ResNet50_FPN_V2_Weights
-import itertools
 
-from .graph_net import FeatureFusionForFPN, GraphBase, _get_nearest_pair_custom, polar, to_bin, _get_nearest_pair_knn, \
-    _get_nearest_pair_beta_skeleton
+from .graph_net import FeatureFusionForFPN, GraphBase, polar_tensor, to_bin_tensor, _get_nearest_pair_beta_skeleton, \
+    _get_nearest_pair_custom_tree, _get_nearest_pair_beta_skeleton_delaunay, _get_nearest_pair_knn_batch, \
+    _get_nearest_pair_custom_batch
 
 
 class GraphLayoutNet(nn.Module):
@@ -31,8 +28,20 @@ class GraphLayoutNet(nn.Module):
         self.num_classes = kwargs['num_classes']
         self.focal_loss_flag = kwargs['focal_loss_flag']
         self.max_pair_num = kwargs['max_pair_num']
+        # 默认用配置的max_pair_num，adaptive_pair_chunk为true时才按空闲显存估算chunk大小
+        self.adaptive_pair_chunk = kwargs.get('adaptive_pair_chunk', False)
+        self.pair_chunk_memory_ratio = kwargs.get('pair_chunk_memory_ratio', 0.25)
+        # 按显存估算出的chunk大小，只在第一次forward时查一次显存
+        self.adaptive_pair_chunk_size = None
         self.k_nearest_num = kwargs['k_nearest_num']
         self.sampling_strategy = kwargs['sampling_strategy']
+        self.skeleton_beta = kwargs.get('skeleton_beta', 0.9)
+        self.skeleton_candidate_num = kwargs.get('skeleton_candidate_num', 16)
+        # 用Delaunay候选边加速BetaSkeleton，skeleton_beta<1时是近似结果，默认用精确版
+        self.skeleton_delaunay_flag = kwargs.get('skeleton_delaunay_flag', False)
+        self.max_negative_pair_num = kwargs.get('max_negative_pair_num')
+        self.sampling_seed = kwargs.get('sampling_seed')
+        self.sampling_generator = None
         self.fc_flag = kwargs['fc_flag']
         self.gnn_res_flag = kwargs['gnn_res_flag']
         self.relation_flag = kwargs['relation_flag']
@@ -102,12 +111,12 @@ class GraphLayoutNet(nn.Module):
             inter_feat = self.backbone(images)
             inter_feat = self.smooth_layer(images, inter_feat)
             feat, graphs, fusion_feat, cnn_decode_feat = self.graph(input=inter_feat,
-                                                                    cell_boxes=copy.deepcopy(cell_boxes),
+                                                                    cell_boxes=cell_boxes,
                                                                     targets=targets,
                                                                     texts=texts)
         else:
             feat, graphs, fusion_feat, cnn_decode_feat = self.graph(input=None,
-                                                                    cell_boxes=copy.deepcopy(cell_boxes),
+                                                                    cell_boxes=cell_boxes,
                                                                     targets=targets,
                                                                     texts=texts)
         # 正负样本采样
@@ -128,34 +137,9 @@ class GraphLayoutNet(nn.Module):
         else:
             node_score_list = self.cls_node(feat)
 
-        pair_cell_score_list = torch.empty(0).to(images.device)
-        if len(pair_cell) > 0:
-            # edge分类
-            for i in range(0, pair_cell.shape[0] // self.max_pair_num + 1):
-                pair_feat = torch.cat(
-                    (torch.as_tensor(feat[pair_cell[i * self.max_pair_num:(i + 1) * self.max_pair_num, 0]]),
-                     torch.as_tensor(feat[pair_cell[i * self.max_pair_num:(i + 1) * self.max_pair_num, 1]])),
-                    dim=1)
-                if self.relation_flag:
-                    pair_feat = torch.cat(
-                        [pair_feat, pair_relation_feat_list[i * self.max_pair_num:(i + 1) * self.max_pair_num]], dim=1)
-                if self.rope_flag:
-                    pair_feat = torch.cat(
-                        [pair_feat, pair_rope_feat_list[i * self.max_pair_num:(i + 1) * self.max_pair_num]], dim=1)
-                if self.polar_flag:
-                    pair_feat = torch.cat(
-                        [pair_feat, pair_polar_feat_list[i * self.max_pair_num:(i + 1) * self.max_pair_num]], dim=1)
-                if self.node_class_flag:
-                    node_class_feat = torch.cat(
-                        (F.softmax(node_score_list[pair_cell[i * self.max_pair_num:(i + 1) * self.max_pair_num, 0]],
-                                   dim=1),
-                         F.softmax(node_score_list[pair_cell[i * self.max_pair_num:(i + 1) * self.max_pair_num, 1]],
-                                   dim=1)),
-                        dim=1)
-                    pair_feat = torch.cat([pair_feat, node_class_feat], dim=1)
-                linear_cell = self.linear_cell(pair_feat)
-                cls_score_cell = self.cls_cell(linear_cell)
-                pair_cell_score_list = torch.cat([pair_cell_score_list, cls_score_cell], dim=0)
+        # edge分类
+        pair_cell_score_list = self.get_pair_cell_score(feat, pair_cell, node_score_list, pair_relation_feat_list,
+                                                        pair_rope_feat_list, pair_polar_feat_list)
         data = {
             'node_feat':
                 feat,
@@ -175,148 +159,181 @@ class GraphLayoutNet(nn.Module):
         }
         return data
 
+    def get_pair_cell_score(self, feat, pair_cell, node_score_list, pair_relation_feat_list, pair_rope_feat_list,
+                            pair_polar_feat_list):
+        '''按chunk做edge分类，分数直接写进预分配的tensor'''
+        pair_num = pair_cell.shape[0]
+        pair_cell_score_list = feat.new_empty((pair_num, self.cls_cell[0].out_features))
+        if pair_num == 0:
+            return pair_cell_score_list
+        if self.node_class_flag:
+            # 每个节点只算一次softmax，再按pair下标gather
+            node_class_prob = F.softmax(node_score_list, dim=1)
+        chunk_size = self._get_pair_chunk_size(pair_num, feat)
+        for start in range(0, pair_num, chunk_size):
+            end = min(start + chunk_size, pair_num)
+            pair_index = pair_cell[start:end]
+            pair_feat = [feat[pair_index[:, 0]], feat[pair_index[:, 1]]]
+            if self.relation_flag:
+                pair_feat.append(pair_relation_feat_list[start:end])
+            if self.rope_flag:
+                pair_feat.append(pair_rope_feat_list[start:end])
+            if self.polar_flag:
+                pair_feat.append(pair_polar_feat_list[start:end])
+            if self.node_class_flag:
+                pair_feat.extend([node_class_prob[pair_index[:, 0]], node_class_prob[pair_index[:, 1]]])
+            linear_cell = self.linear_cell(torch.cat(pair_feat, dim=1))
+            pair_cell_score_list[start:end] = self.cls_cell(linear_cell)
+        return pair_cell_score_list
+
+    def _get_pair_chunk_size(self, pair_num, feat):
+        '''默认用max_pair_num；开启adaptive_pair_chunk时在GPU上按第一次forward的空闲显存估算每个chunk的pair数并缓存'''
+        if not self.adaptive_pair_chunk or feat.device.type != 'cuda':
+            return self.max_pair_num
+        if self.adaptive_pair_chunk_size is None:
+            free_memory, _ = torch.cuda.mem_get_info(feat.device)
+            # 每个pair要存拼接后的输入特征、linear_cell的输出和分数
+            pair_bytes = (self.linear_cell[0].in_features + self.linear_cell[0].out_features +
+                          self.cls_cell[0].out_features) * feat.element_size()
+            self.adaptive_pair_chunk_size = max(int(free_memory * self.pair_chunk_memory_ratio) // pair_bytes, 1)
+        return min(self.adaptive_pair_chunk_size, pair_num)
+
     def get_sampling(self, cell_boxes, targets, graphs, cnn_decode_feat, focal_loss_flag, device, linkings):
         #预测时k最近邻/全连接，两两配对去预测关系
-        pair_cell_target = []
         if self.sampling_strategy:
-            pair_cell_list = self._get_nearest_pair(graphs, cell_boxes)
+            pair_cell = self._get_nearest_pair(graphs, cell_boxes).T
         else:
-            pair_cell_list = []
-            for cell_box in cell_boxes:
-                box_num = cell_box.shape[0]
-                pair_cell_list.append(list(itertools.combinations(range(0, box_num), r=2)))
+            pair_cell = torch.cat([
+                torch.combinations(torch.arange(start, end, device=device), r=2)
+                for start, end in zip(graphs.ptr[:-1].tolist(), graphs.ptr[1:].tolist())
+            ])
+        pair_cell_target = torch.empty(0, dtype=torch.long, device=device)
         if targets is not None:
             # 训练时正负样本均衡采样
-            train_cell_pair_list = []
-            for index, target in enumerate(targets):
-                if linkings is not None:
-                    positive_cell_pair = linkings[index]
-                    positive_cell_pair = [tuple(cell_pair) for cell_pair in positive_cell_pair]
-                else:
-                    positive_cell_pair = []
-                    for i, loc1 in enumerate(target):
-                        for j, loc2 in enumerate(target[i + 1:]):
-                            if loc1 == loc2:
-                                positive_cell_pair.append((i, j + i + 1))
-                negative_cell_pair = list(set(pair_cell_list[index]).difference(set(positive_cell_pair)))
-                assert len(set(positive_cell_pair).difference(set(pair_cell_list[index]))) == 0, "!!Lack of pair Set:{}".format(set(positive_cell_pair).difference(set(pair_cell_list[index])))
-                positive_cell_pair = list(set(pair_cell_list[index]).intersection(set(positive_cell_pair)))
-                if focal_loss_flag is False:
-                    random.shuffle(negative_cell_pair)
-                    train_cell_pair_list.append(positive_cell_pair + negative_cell_pair[:len(positive_cell_pair)])
-                    train_pair_cell_target = [1] * len(positive_cell_pair) + [0] * len(
-                        negative_cell_pair[:len(positive_cell_pair)])
-                else:
-                    train_cell_pair_list.append(positive_cell_pair + negative_cell_pair)
-                    train_pair_cell_target = [1] * len(positive_cell_pair) + [0] * len(negative_cell_pair)
-                randnum = random.randint(0, 100)
-                random.seed(randnum)
-                random.shuffle(train_cell_pair_list[-1])
-                random.seed(randnum)
-                random.shuffle(train_pair_cell_target)
-                pair_cell_target.extend(train_pair_cell_target)
-            pair_cell_list = train_cell_pair_list
+            pair_cell, pair_cell_target = self._sample_train_pair(pair_cell, targets, graphs, focal_loss_flag, linkings)
         pair_relation_feat_list, pair_rope_feat_list, pair_polar_feat_list = [], [], []
-        if sum([len(pair_cell) for pair_cell in pair_cell_list]) != 0:
+        if len(pair_cell) != 0:
             if self.relation_flag:
-                pair_relation_feat_list = self.get_relation_feature(pair_cell_list, cell_boxes, cnn_decode_feat)
+                pair_relation_feat_list = self.get_relation_feature(pair_cell, graphs, cnn_decode_feat)
             if self.rope_flag:
-                pair_rope_feat_list = self.get_rope_feature(pair_cell_list).to(cnn_decode_feat.device)
+                pair_rope_feat_list = self.get_rope_feature(pair_cell).to(cnn_decode_feat.device)
             if self.polar_flag:
-                pair_polar_feat_list = self.get_polar_feature(pair_cell_list, cell_boxes).to(cnn_decode_feat.device)
-        pair_cell = []
-        start_index = 0
-        for index, edge_index_list in enumerate(pair_cell_list):
-            edge_index_list = [(item[0] + start_index, item[1] + start_index) for item in edge_index_list]
-            pair_cell.extend(edge_index_list)
-            start_index += graphs[index].num_nodes
+                pair_polar_feat_list = self.get_polar_feature(pair_cell, graphs).to(cnn_decode_feat.device)
+        return pair_cell_target.to(device), pair_cell, pair_relation_feat_list, pair_rope_feat_list, pair_polar_feat_list
 
-        return torch.from_numpy(np.array(pair_cell_target)).to(device), np.array(
-            pair_cell), pair_relation_feat_list, pair_rope_feat_list, pair_polar_feat_list
+    def _sample_train_pair(self, pair_cell, targets, graphs, focal_loss_flag, linkings):
+        '''
+        pair_cell为全局下标[E, 2]，正样本为同一组(target相同或者linking里)的pair，
+        focal loss时保留全部负样本，否则每张图负样本数和正样本数相同，max_negative_pair_num限制每张图最多的负样本数，
+        返回采样并在每张图内打乱后的pair_cell和target
+        '''
+        pair_device = pair_cell.device
+        node_num = graphs.num_nodes
+        start_index_list = graphs.ptr[:-1].tolist()
+        pair_batch = graphs.batch[pair_cell[:, 0]]
+        if linkings is not None:
+            link_code = [(link[0] + start_index) * node_num + link[1] + start_index
+                         for start_index, linking in zip(start_index_list, linkings) for link in linking]
+            link_code = torch.unique(torch.as_tensor(link_code, dtype=torch.long).to(pair_device))
+            positive_mask = torch.isin(pair_cell[:, 0] * node_num + pair_cell[:, 1], link_code)
+            lack_pair_num = torch.bincount(graphs.batch[link_code // node_num], minlength=graphs.num_graphs)
+        else:
+            # target编码成全局唯一的组号
+            group_list = []
+            for target in targets:
+                group_map = {}
+                group_list.extend([group_map.setdefault(label, len(group_map)) + len(group_list) for label in target])
+            group = torch.as_tensor(group_list, dtype=torch.long).to(pair_device)
+            positive_mask = group[pair_cell[:, 0]] == group[pair_cell[:, 1]]
+            group_num = torch.bincount(group)
+            group_batch = torch.zeros_like(group_num).scatter_(0, group, graphs.batch)
+            lack_pair_num = torch.bincount(group_batch, group_num * (group_num - 1) // 2, minlength=graphs.num_graphs)
+        positive_num = torch.bincount(pair_batch[positive_mask], minlength=graphs.num_graphs)
+        lack_pair_num = lack_pair_num.to(positive_num.dtype) - positive_num
+        assert not lack_pair_num.any(), "!!Lack of pair Set:{}".format(lack_pair_num.tolist())
 
-    def get_relation_feature(self, pair_cell_list, cell_boxes, cnn_decode_feat):
-        pair_relation_feat_list = []
-        out_boxes = []
-        for i, pair_cell in enumerate(pair_cell_list):
-            if len(pair_cell) == 0:
-                continue
-            pair_cell = np.array(pair_cell)
-            cell_box = cell_boxes[i].cpu().numpy()
-            two_cell_box = np.concatenate([cell_box[pair_cell[:, 0]], cell_box[pair_cell[:, 1]]], axis=1)
-            out_box = np.array([
-                np.min(two_cell_box[:, [0, 2, 4, 6]], axis=1),
-                np.min(two_cell_box[:, [1, 3, 5, 7]], axis=1),
-                np.max(two_cell_box[:, [0, 2, 4, 6]], axis=1),
-                np.max(two_cell_box[:, [1, 3, 5, 7]], axis=1)
-            ]).T
-            relative_feature = np.array([(two_cell_box[:, 0]-two_cell_box[:, 4])/(two_cell_box[:, 2]-two_cell_box[:, 0]),\
-                                         (two_cell_box[:, 1] - two_cell_box[:, 5]) / (two_cell_box[:, 3] - two_cell_box[:, 1]), \
-                                         (two_cell_box[:, 4] - two_cell_box[:, 0]) / (two_cell_box[:, 6] - two_cell_box[:, 4]), \
-                                         (two_cell_box[:, 5] - two_cell_box[:, 1]) / (two_cell_box[:, 7] - two_cell_box[:, 5]), \
-                                         np.log((two_cell_box[:, 2] - two_cell_box[:, 0]) / (two_cell_box[:, 6] - two_cell_box[:, 4])), \
-                                         np.log((two_cell_box[:, 3] - two_cell_box[:, 1]) / (two_cell_box[:, 7] - two_cell_box[:, 5])), \
+        keep_num = torch.bincount(pair_batch[~positive_mask], minlength=graphs.num_graphs)
+        if focal_loss_flag is False:
+            keep_num = torch.minimum(keep_num, positive_num)
+        if self.max_negative_pair_num:
+            keep_num = keep_num.clamp(max=self.max_negative_pair_num)
+        # 按(图片, 正负)分组，组内随机排序，负样本取每张图的前keep_num个
+        generator = self._get_sampling_generator(pair_device)
+        pair_num = pair_cell.shape[0]
+        rand_index = torch.randperm(pair_num, generator=generator, device=pair_device)
+        group_key, sort_index = torch.sort((pair_batch * 2 + positive_mask.long())[rand_index], stable=True)
+        rand_index = rand_index[sort_index]
+        rank = torch.arange(pair_num, device=pair_device) - torch.searchsorted(group_key, group_key)
+        sample_index = rand_index[positive_mask[rand_index] | (rank < keep_num[pair_batch[rand_index]])]
+        # 每张图内打乱正负样本的顺序
+        sample_index = sample_index[torch.randperm(len(sample_index), generator=generator, device=pair_device)]
+        sample_index = sample_index[torch.sort(pair_batch[sample_index], stable=True)[1]]
+        return pair_cell[sample_index], positive_mask[sample_index].long()
+
+    def _get_sampling_generator(self, device):
+        '''训练采样用的随机数生成器，没有配置sampling_seed时从全局torch随机数取种子'''
+        if self.sampling_generator is None or self.sampling_generator.device != device:
+            seed = self.sampling_seed if self.sampling_seed is not None else int(torch.randint(2**62, (1,)).item())
+            self.sampling_generator = torch.Generator(device=device)
+            self.sampling_generator.manual_seed(seed)
+        return self.sampling_generator
+
+    def get_relation_feature(self, pair_cell, graphs, cnn_decode_feat):
+        '''pair_cell为全局下标[E, 2]，整个batch一次算完18维相对位置特征和并集框的roi特征'''
+        box_a = graphs.pos[pair_cell[:, 0]]
+        box_b = graphs.pos[pair_cell[:, 1]]
+        out_box = torch.cat([torch.minimum(box_a[:, :2], box_b[:, :2]), torch.maximum(box_a[:, 2:], box_b[:, 2:])], dim=1)
+        wh_a = box_a[:, 2:] - box_a[:, :2]
+        wh_b = box_b[:, 2:] - box_b[:, :2]
+        wh_out = out_box[:, 2:] - out_box[:, :2]
+        relative_feature = torch.cat([
+            (box_a[:, :2] - box_b[:, :2]) / wh_a,
+            (box_b[:, :2] - box_a[:, :2]) / wh_b,
+            torch.log(wh_a / wh_b),
 
-                                         (two_cell_box[:, 0] - out_box[:, 0]) / (two_cell_box[:, 2] - two_cell_box[:, 0]), \
-                                         (two_cell_box[:, 1] - out_box[:, 1]) / (two_cell_box[:, 3] - two_cell_box[:, 1]), \
-                                         (out_box[:, 0] - two_cell_box[:, 0]) / (out_box[:, 2] - out_box[:, 0]), \
-                                         (out_box[:, 1] - two_cell_box[:, 1]) / (out_box[:, 3] - out_box[:, 1]), \
-                                         np.log((two_cell_box[:, 2] - two_cell_box[:, 0]) / (out_box[:, 2] - out_box[:, 0])), \
-                                         np.log((two_cell_box[:, 3] - two_cell_box[:, 1]) / (out_box[:, 3] - out_box[:, 1])), \
+            (box_a[:, :2] - out_box[:, :2]) / wh_a,
+            (out_box[:, :2] - box_a[:, :2]) / wh_out,
+            torch.log(wh_a / wh_out),
 
-                                         (two_cell_box[:, 4] - out_box[:, 0]) / (two_cell_box[:, 6] - two_cell_box[:, 4]), \
-                                         (two_cell_box[:, 5] - out_box[:, 1]) / (two_cell_box[:, 7] - two_cell_box[:, 5]), \
-                                         (out_box[:, 0] - two_cell_box[:, 4]) / (out_box[:, 2] - out_box[:, 0]), \
-                                         (out_box[:, 1] - two_cell_box[:, 5]) / (out_box[:, 3] - out_box[:, 1]), \
-                                         np.log((two_cell_box[:, 6] - two_cell_box[:, 4]) / (out_box[:, 2] - out_box[:, 0])), \
-                                         np.log((two_cell_box[:, 7] - two_cell_box[:, 5]) / (out_box[:, 3] - out_box[:, 1])), \
-                                         ]).T
-            pair_relation_feat_list.extend(relative_feature)
-            out_boxes.append(torch.as_tensor(out_box).to(cnn_decode_feat.device))
-        cnn_feat = ops.roi_align(cnn_decode_feat, out_boxes, 1)
+            (box_b[:, :2] - out_box[:, :2]) / wh_b,
+            (out_box[:, :2] - box_b[:, :2]) / wh_out,
+            torch.log(wh_b / wh_out),
+        ], dim=1)
+        # roi_align的boxes为[K, 5]，第一列是所属图片的下标
+        pair_batch = graphs.batch[pair_cell[:, 0]]
+        roi_boxes = torch.cat([pair_batch.unsqueeze(1).to(out_box.dtype), out_box], dim=1).to(cnn_decode_feat.dtype)
+        cnn_feat = ops.roi_align(cnn_decode_feat, roi_boxes, 1)
         cnn_feat = cnn_feat.view(cnn_feat.size()[0], cnn_feat.size()[1])
-        pair_relation_feat_list = torch.as_tensor(np.array(pair_relation_feat_list)).to(cnn_decode_feat.device)
-        pair_relation_feat_list = torch.cat([pair_relation_feat_list, cnn_feat], dim=1)
-        return pair_relation_feat_list
+        return torch.cat([relative_feature.to(cnn_feat.dtype), cnn_feat], dim=1)
 
-    def get_rope_feature(self, pair_cell_list):
-        pair_rope_feat_list = torch.empty(0)
-        for pair_cell in pair_cell_list:
-            if len(pair_cell) == 0:
-                continue
-            pair_rope_feat_list = torch.cat(
-                [pair_rope_feat_list, self.position_emb[np.array(pair_cell)[:, 1] - np.array(pair_cell)[:, 0]]], dim=0)
-        return pair_rope_feat_list
+    def get_rope_feature(self, pair_cell):
+        return self.position_emb.to(pair_cell.device)[pair_cell[:, 1] - pair_cell[:, 0]]
 
-    def get_polar_feature(self, pair_cell_list, cell_boxes):
-        pair_polar_feat_list = torch.empty(0)
-        for i, pair_cell in enumerate(pair_cell_list):
-            if len(pair_cell) == 0:
-                continue
-            pair_cell = np.array(pair_cell)
-            cell_box = cell_boxes[i].cpu().numpy()
-            distances = []
-            angles = []
-            for pair in pair_cell:
-                dist, angle = polar(cell_box[pair[0]], cell_box[pair[1]])
-                distances.append(dist)
-                angles.append(angle)
-            # m = max(distances)
-            polar_coordinates = to_bin(distances, angles, self.num_polar_bins)
-            pair_polar_feat_list = torch.cat([pair_polar_feat_list, polar_coordinates], dim=0)
-        return pair_polar_feat_list
+    def get_polar_feature(self, pair_cell, graphs):
+        '''pair_cell为全局下标[E, 2]，一次算完整个batch的极坐标特征，距离按每张图的最大距离分桶'''
+        cell_boxes = graphs.pos
+        dist, angle = polar_tensor(cell_boxes[pair_cell[:, 0]], cell_boxes[pair_cell[:, 1]])
+        return to_bin_tensor(dist, angle, self.num_polar_bins, batch=graphs.batch[pair_cell[:, 0]])
 
     def _get_nearest_pair(self, graphs, cell_boxes):
-        pair_cell_list = []
-        for index in range(len(graphs)):
+        '''返回整个batch的候选pair，全局下标的edge_index [2, E]，和graphs在同一个device上'''
+        if self.sampling_strategy == 'KNN':
+            return _get_nearest_pair_knn_batch(graphs.pos, graphs.batch, self.k_nearest_num)
+        elif self.sampling_strategy not in ['BetaSkeleton', 'CustomTree']:
+            return _get_nearest_pair_custom_batch(graphs.pos, graphs.batch, self.rope_max_length)
+        edge_index_list = []
+        for index, start_index in enumerate(graphs.ptr[:-1].tolist()):
             # TODO GCN graph KNNGraph 跑不通
             if graphs[index].num_nodes == 1 and self.graph.graph_type == 'GCN':
-                edge_index_list = []
-            elif self.sampling_strategy == 'KNN':
-                edge_index_list = _get_nearest_pair_knn(cell_boxes[index], self.k_nearest_num)
+                continue
+            cell_boxes_array = cell_boxes[index].cpu().numpy()
+            if self.sampling_strategy == 'BetaSkeleton' and self.skeleton_delaunay_flag:
+                pair_list = _get_nearest_pair_beta_skeleton_delaunay(cell_boxes_array, self.skeleton_beta,
+                                                                     self.skeleton_candidate_num)
             elif self.sampling_strategy == 'BetaSkeleton':
-                edge_index_list = _get_nearest_pair_beta_skeleton(cell_boxes[index])
+                pair_list = _get_nearest_pair_beta_skeleton(cell_boxes_array, self.skeleton_beta)
             else:
-                cell_boxes_array = cell_boxes[index].cpu().numpy()
-                edge_index_list = _get_nearest_pair_custom(cell_boxes_array, self.rope_max_length)
-            pair_cell_list.append(edge_index_list)
-        return pair_cell_list
+                pair_list = _get_nearest_pair_custom_tree(cell_boxes_array, self.rope_max_length)
+            edge_index_list.append(torch.as_tensor(pair_list, dtype=torch.long).reshape(-1, 2).T + start_index)
+        edge_index = torch.cat(edge_index_list, dim=1) if edge_index_list else torch.empty((2, 0), dtype=torch.long)
+        return edge_index.to(graphs.batch.device)
@@ -14,8 +14,11 @@ import random
 import torch
 import torch.nn as nn
 from torch.nn import init
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 import numpy as np
+from scipy.spatial import cKDTree, Delaunay, QhullError
 from torch_geometric import transforms
+from torch_geometric.nn import knn_graph
 from torchvision import ops
 import itertools
 
@@ -97,7 +100,7 @@ class GraphBase(nn.Module):
 
     def forward(self, input=None, cell_boxes=None, targets=None, texts=None):
         #box 位置 feature
-        box_feat = self.get_box_feat(copy.deepcopy(cell_boxes))
+        box_feat = self.get_box_feat(cell_boxes)
         fusion_feat = self.box_emb(box_feat)
         cnn_decode_feat = None
         if self.cnn_emb:
@@ -108,12 +111,15 @@ class GraphBase(nn.Module):
             fusion_feat = torch.cat([fusion_feat, cnn_feat], dim=1)
         #text feature
         if self.encode_text_type == 'rnn':
-            text_feat = torch.empty(0)
-            for text in texts:
-                text_embedding_feature = self.text_emb(text)
-                textout, _ = self.rnn(torch.unsqueeze(text_embedding_feature, dim=0))
-                textout = textout[:, -1, :]  # Take the output feature at last time sequence
-                text_feat = torch.cat([text_feat, textout], dim=0)
+            # 整个batch的文本补齐后pack成一个序列batch，只跑一次rnn
+            text_index, text_length = texts
+            text_embedding_feature = self.text_emb(text_index.to(fusion_feat.device))
+            textout, _ = self.rnn(
+                pack_padded_sequence(text_embedding_feature, text_length.cpu(), batch_first=True, enforce_sorted=False))
+            textout, _ = pad_packed_sequence(textout, batch_first=True)
+            # Take the output feature at last valid time step of every text
+            text_feat = textout[torch.arange(textout.size(0), device=textout.device),
+                                text_length.to(textout.device) - 1]
             fusion_feat = torch.cat([fusion_feat, text_feat], dim=1)
         elif self.encode_text_type == 'spacy':
             text_feat = torch.cat([torch.as_tensor(np.array(text)) for text in texts]).to(fusion_feat.device)
@@ -129,37 +135,7 @@ class GraphBase(nn.Module):
         return feat, graphs, fusion_feat, cnn_decode_feat
 
     def get_box_feat(self, cell_boxes):
-        if self.norm_box_flag:
-            for cell_box in cell_boxes:
-                min_x = cell_box[:, [0, 2]].min()
-                min_y = cell_box[:, [1, 3]].min()
-                cell_box_w = cell_box[:, [0, 2]].max() - min_x
-                cell_box_h = cell_box[:, [1, 3]].max() - min_y
-                cell_box[:, [0, 2]] = (cell_box[:, [0, 2]] - min_x) / cell_box_w
-                cell_box[:, [1, 3]] = (cell_box[:, [1, 3]] - min_y) / cell_box_h
-            boxes = torch.cat(cell_boxes, dim=0)
-            box_w = boxes[:, 2] - boxes[:, 0]
-            box_h = boxes[:, 3] - boxes[:, 1]
-            ctr_x = (boxes[:, 2] + boxes[:, 0]) / 2
-            ctr_y = (boxes[:, 3] + boxes[:, 1]) / 2
-            boxes_feat = torch.stack((boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], ctr_x, ctr_y, box_w, box_h),
-                                     dim=1)
-        else:
-            boxes = torch.cat(cell_boxes, dim=0)
-            box_w = boxes[:, 2] - boxes[:, 0]
-            box_h = boxes[:, 3] - boxes[:, 1]
-            ctr_x = (boxes[:, 2] + boxes[:, 0]) / 2
-            ctr_y = (boxes[:, 3] + boxes[:, 1]) / 2
-            # rel_x = torch.log(ctr_x/self.width)
-            # rel_y = torch.log(ctr_y/self.height)
-            # rel_w = torch.log(box_w/self.width)
-            # rel_h = torch.log(box_h/self.height)
-            rel_x = ctr_x / self.width
-            rel_y = ctr_y / self.height
-            rel_w = box_w / self.width
-            rel_h = box_h / self.height
-            boxes_feat = torch.stack((rel_x, rel_y, rel_w, rel_h), dim=1)
-        return boxes_feat
+        return get_box_feat(cell_boxes, self.norm_box_flag, self.width, self.height)
 
     def _init_params(self):
         for m in self.modules():
@@ -266,6 +242,43 @@ class FeatureFusionForFPN(nn.Module):
 
 
 
+def get_box_feat(cell_boxes, norm_box_flag, width=None, height=None):
+    '''不修改cell_boxes，整个batch一起计算box特征，norm_box_flag为false时按width/height算相对坐标'''
+    boxes = torch.cat(cell_boxes, dim=0)
+    if norm_box_flag:
+        # 每张图的box按各自的最小外接框归一化，min/max用batch向量scatter得到
+        box_num = torch.as_tensor([len(cell_box) for cell_box in cell_boxes], device=boxes.device)
+        batch = torch.repeat_interleave(torch.arange(len(cell_boxes), device=boxes.device), box_num)
+        points = boxes.view(-1, 2, 2)
+        index = batch.unsqueeze(1).expand(-1, 2)
+        min_xy = points.new_zeros((len(cell_boxes), 2)).scatter_reduce(0, index, points.amin(dim=1), 'amin',
+                                                                       include_self=False)
+        max_xy = points.new_zeros((len(cell_boxes), 2)).scatter_reduce(0, index, points.amax(dim=1), 'amax',
+                                                                       include_self=False)
+        boxes = ((points - min_xy[batch].unsqueeze(1)) / (max_xy - min_xy)[batch].unsqueeze(1)).view(-1, 4)
+        box_w = boxes[:, 2] - boxes[:, 0]
+        box_h = boxes[:, 3] - boxes[:, 1]
+        ctr_x = (boxes[:, 2] + boxes[:, 0]) / 2
+        ctr_y = (boxes[:, 3] + boxes[:, 1]) / 2
+        boxes_feat = torch.stack((boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], ctr_x, ctr_y, box_w, box_h),
+                                 dim=1)
+    else:
+        box_w = boxes[:, 2] - boxes[:, 0]
+        box_h = boxes[:, 3] - boxes[:, 1]
+        ctr_x = (boxes[:, 2] + boxes[:, 0]) / 2
+        ctr_y = (boxes[:, 3] + boxes[:, 1]) / 2
+        # rel_x = torch.log(ctr_x/width)
+        # rel_y = torch.log(ctr_y/height)
+        # rel_w = torch.log(box_w/width)
+        # rel_h = torch.log(box_h/height)
+        rel_x = ctr_x / width
+        rel_y = ctr_y / height
+        rel_w = box_w / width
+        rel_h = box_h / height
+        boxes_feat = torch.stack((rel_x, rel_y, rel_w, rel_h), dim=1)
+    return boxes_feat
+
+
 def polar(rect_src: list, rect_dst: list) -> Tuple[int, int]:
     """Compute distance and angle from src to dst bounding boxes (poolar coordinates considering the src as the center)
     Args:
@@ -363,6 +376,81 @@ def to_bin(dist: int, angle: int, b=8) -> torch.Tensor:
     return torch.cat([torch.tensor(new_dist, dtype=torch.float32), torch.tensor(new_angle, dtype=torch.float32)], dim=1)
 
 
+def polar_tensor(rect_src: torch.Tensor, rect_dst: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Tensor version of "polar()", computed for all pairs at once on CPU or GPU
+    Args:
+        rect_src (Tensor) : [E, 4] source rectangle coordinates
+        rect_dst (Tensor) : [E, 4] destination rectangle coordinates
+
+    Returns:
+        tuple (Tensors): [E] distance (float) and [E] angle (long)
+    """
+    x0_s, y0_s, x1_s, y1_s = rect_src.unbind(dim=1)
+    x0_d, y0_d, x1_d, y1_d = rect_dst.unbind(dim=1)
+    # check relative position
+    left = (x1_d - x0_s) <= 0
+    bottom = (y1_s - y0_d) <= 0
+    right = (x1_s - x0_d) <= 0
+    top = (y1_d - y0_s) <= 0
+    vp_intersect = (x0_s <= x1_d) & (x0_d <= x1_s)
+    hp_intersect = (y0_s <= y1_d) & (y0_d <= y1_s)
+    rect_intersect = vp_intersect & hp_intersect
+
+    #  evaluate reciprocal position, 角度用float64算保证和math.atan2取整结果一致
+    new_ec_x = ((x1_d + x0_d) / 2 - (x1_s + x0_s) / 2).double()
+    new_ec_y = ((y1_d + y0_d) / 2 - (y1_s + y0_s) / 2).double()
+    angle = torch.remainder(torch.rad2deg(torch.atan2(new_ec_y, new_ec_x)), 360).long()
+
+    # 角点方向取两个角点间的欧式距离（取整），其余方向取边之间的距离，顺序与polar()的分支一致
+    corner_x = torch.where(left, x1_d - x0_s, x0_d - x1_s)
+    corner_y = torch.where(top, y1_d - y0_s, y0_d - y1_s)
+    corner_dist = torch.sqrt((corner_x ** 2 + corner_y ** 2).double()).floor().to(rect_src.dtype)
+    dist = torch.zeros_like(x0_s)
+    dist = torch.where(top, y0_s - y1_d, dist)
+    dist = torch.where(bottom, y0_d - y1_s, dist)
+    dist = torch.where(right, x0_d - x1_s, dist)
+    dist = torch.where(left, x0_s - x1_d, dist)
+    dist = torch.where((left | right) & (top | bottom), corner_dist, dist)
+    dist = torch.where(rect_intersect, torch.zeros_like(dist), dist)
+    return dist, angle
+
+
+def _int_to_binary(value: torch.Tensor, bit_num: int) -> torch.Tensor:
+    '''非负整数转成高位在前的二进制位 [E, bit_num]'''
+    shifts = torch.arange(bit_num - 1, -1, -1, device=value.device)
+    return ((value.unsqueeze(1) >> shifts) & 1).to(torch.float32)
+
+
+def to_bin_tensor(dist: torch.Tensor, angle: torch.Tensor, b=8, batch: torch.Tensor = None) -> torch.Tensor:
+    """ Tensor version of "to_bin()".
+
+    Args:
+        dist (Tensor): [E] distance given by "polar_tensor()"
+        angle (Tensor): [E] angle between 0 and 360 given by "polar_tensor()"
+        b (int): number of bins, MUST be power of 2
+        batch (Tensor): [E] image index of every pair. The distance bins are normalized by the max distance of
+            each image, like calling "to_bin()" image by image. None means all pairs come from one image
+
+    Returns:
+        torch.Tensor: [E, 2 * bit_num] new distance and angle (binary encoded)
+    """
+    assert b and not (b & (b - 1))
+    # to_bin()中不足sqrt(b)位时高位补0
+    bit_num = max(math.ceil(math.sqrt(b)), int(math.log2(b)))
+    if batch is None:
+        max_dist = dist.max().reshape(1)
+        batch = torch.zeros_like(dist, dtype=torch.long)
+    else:
+        max_dist = torch.full((int(batch.max()) + 1,), -math.inf, dtype=dist.dtype, device=dist.device)
+        max_dist = max_dist.scatter_reduce(0, batch, dist, reduce='amax')
+    m = max_dist.double()[batch] / b
+    dist_bin = torch.where(m > 0, dist.double() / m, torch.zeros_like(m)).long().clamp(max=b - 1)
+
+    amplitude = 360 / b
+    angle_bin = ((angle.double() - amplitude / 2) / amplitude).long()
+    return torch.cat([_int_to_binary(dist_bin, bit_num), _int_to_binary(angle_bin, bit_num)], dim=1)
+
+
 def _get_nearest_pair_custom(cell_boxes_array, rope_max_length):
     cell_boxes_num = len(cell_boxes_array)
     eye_matrix = np.eye(cell_boxes_num)
@@ -458,9 +546,110 @@ def _get_nearest_pair_custom(cell_boxes_array, rope_max_length):
     return edge_index_list
 
 
-def _get_nearest_pair_beta_skeleton(cell_boxes_array):
-    beta = 0.9
+def _get_nearest_pair_custom_tree(cell_boxes_array, rope_max_length, init_k=16):
+    '''
+    与_get_nearest_pair_custom选出的边完全一致（left/right/up/down/second-up/second-down/down_y），
+    但不再构造N×N矩阵：left/right按center_y排序后只在y方向的带状区域内找，up/down/down_y用KD-tree逐步扩大k近邻，
+    内存O(N)，时间近似O(NlogN)
+    '''
+    cell_boxes_array = np.asarray(cell_boxes_array)
+    cell_boxes_num = len(cell_boxes_array)
+    if cell_boxes_num < 2:
+        return []
+    x_min, y_min, x_max, y_max = (cell_boxes_array[:, 0], cell_boxes_array[:, 1], cell_boxes_array[:, 2],
+                                  cell_boxes_array[:, 3])
+    cell_boxes_height = y_max - y_min
+    center_y = (y_min + y_max) / 2
+    center_x = (x_min + x_max) / 2
+    y_low = y_min - cell_boxes_height * 0.3
+    y_high = y_max + cell_boxes_height * 0.3
+
+    # left/right: 候选框的center_y必须落在[y_low_i, y_high_i]内，在按center_y排好序的数组里是一段连续区间
+    order = np.argsort(center_y, kind='stable')
+    sorted_center_y = center_y[order]
+    band_start = np.searchsorted(sorted_center_y, y_low, side='left')
+    band_end = np.searchsorted(sorted_center_y, y_high, side='right')
+    band_num = np.maximum(band_end - band_start, 0)
+    rows = np.repeat(np.arange(cell_boxes_num), band_num)
+    offsets = np.arange(band_num.sum()) - np.repeat(np.cumsum(band_num) - band_num, band_num)
+    cols = order[np.repeat(band_start, band_num) + offsets]
+    hor_dis = (x_min[cols] - x_max[rows])**2 + (y_min[cols] - y_min[rows])**2
+    left_dis = np.where((rows != cols) & (x_max[cols] > x_max[rows]), hor_dis, math.inf)
+    right_dis = np.where((rows != cols) & (x_min[cols] < x_min[rows]), hor_dis, math.inf)
+    edge_index_list = [_pick_nearest_pair(rows, cols, left_dis, 1), _pick_nearest_pair(rows, cols, right_dis, 1)]
+
+    # up/down: 距离就是(x_min_i, y_max_i)到(x_min_j, y_min_j)的欧式距离，可以直接用KD-tree查询
+    ver_tree = cKDTree(np.stack([x_min, y_min], axis=1).astype(np.float64))
+    ver_query = np.stack([x_min, y_max], axis=1).astype(np.float64)
+
+    def up_dis_func(rows, cols):
+        ver_dis = (x_min[cols] - x_min[rows])**2 + (y_min[cols] - y_max[rows])**2
+        return np.where((rows != cols) & (y_max[cols] > y_max[rows]), ver_dis, math.inf)
+
+    def down_dis_func(rows, cols):
+        ver_dis = (x_min[cols] - x_min[rows])**2 + (y_min[cols] - y_max[rows])**2
+        return np.where((rows != cols) & (y_min[cols] < y_min[rows]), ver_dis, math.inf)
+
+    # down_y: 只看y方向距离，候选框的center_x必须落在[x_min_i, x_max_i]内
+    down_y_tree = cKDTree(y_min.astype(np.float64)[:, None])
+    down_y_query = y_max.astype(np.float64)[:, None]
+
+    def down_y_dis_func(rows, cols):
+        ver_y_dis = (y_min[cols] - y_max[rows])**2
+        valid = (rows != cols) & (y_max[cols] > y_max[rows]) & (center_x[cols] >= x_min[rows]) & (center_x[cols] <=
+                                                                                                  x_max[rows])
+        return np.where(valid, ver_y_dis, math.inf)
+
+    # for vertical direction, we pick up at most two nodes w.r.t each node
+    edge_index_list.append(_search_nearest_pair(ver_tree, ver_query, up_dis_func, 2, init_k))
+    edge_index_list.append(_search_nearest_pair(ver_tree, ver_query, down_dis_func, 2, init_k))
+    edge_index_list.append(_search_nearest_pair(down_y_tree, down_y_query, down_y_dis_func, 1, init_k))
 
+    # bring all selected neighbor node together
+    edge_index_array = np.concatenate(edge_index_list, axis=0)
+    edge_index_array = np.unique(np.sort(edge_index_array, axis=1), axis=0)
+    edge_index_array = edge_index_array[edge_index_array[:, 1] - edge_index_array[:, 0] < rope_max_length]
+    return [tuple(item) for item in edge_index_array.tolist()]
+
+
+def _pick_nearest_pair(rows, cols, dis, pick_num):
+    '''每个row按(距离, 下标)取前pick_num个，和np.argmin遇到相同距离取第一个下标的规则一致'''
+    order = np.lexsort((cols, dis, rows))
+    rows, cols, dis = rows[order], cols[order], dis[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows, side='left')
+    keep = (rank < pick_num) & (dis != math.inf)
+    return np.stack([rows[keep], cols[keep]], axis=1)
+
+
+def _search_nearest_pair(tree, query_points, dis_func, pick_num, init_k):
+    '''
+    KD-tree查k近邻，再用dis_func过滤并算原始精度下的距离；若第pick_num个合法近邻比第k近邻还近，则结果已确定，
+    否则把k翻倍继续查，直到k覆盖所有点
+    '''
+    point_num = tree.n
+    rows = np.arange(len(query_points))
+    k = min(max(init_k, pick_num), point_num)
+    edge_index_list = []
+    while len(rows) > 0:
+        tree_dis, cols = tree.query(query_points[rows], k=k)
+        tree_dis, cols = tree_dis.reshape(len(rows), k), cols.reshape(len(rows), k)
+        row_matrix = np.repeat(rows[:, None], k, axis=1)
+        dis = dis_func(row_matrix, cols)
+        if k >= point_num:
+            done = np.ones(len(rows), dtype=bool)
+        else:
+            pick_dis = np.sort(dis, axis=1)[:, pick_num - 1].astype(np.float64)
+            # 未查到的点距离都不小于第k近邻，留出float32的舍入误差
+            done = pick_dis * (1 + 1e-5) < tree_dis[:, -1]**2
+        edge_index_list.append(
+            _pick_nearest_pair(row_matrix[done].reshape(-1), cols[done].reshape(-1), dis[done].reshape(-1), pick_num))
+        rows = rows[~done]
+        k = min(k * 2, point_num)
+    return np.concatenate(edge_index_list, axis=0)
+
+
+def _get_nearest_pair_beta_skeleton(cell_boxes_array, beta=0.9):
+    '''检查所有点对的精确beta-skeleton，O(n^3)'''
     costheta = math.sqrt(1 - 1 / (beta ** 2)) if beta > 1 else -math.sqrt(1 - beta ** 2)
     points = cell_boxes_array[:, [0, 1]].tolist()
     # + cell_boxes_array[:, [2, 1]].tolist()
@@ -518,6 +707,72 @@ def _get_nearest_pair_beta_skeleton(cell_boxes_array):
     # cv2.imwrite(os.path.join('/home/self_2_{}'.format(os.path.basename(img_path))), pair_cell_img1)
     return graph_neighbors
 
+
+def _get_nearest_pair_beta_skeleton_delaunay(cell_boxes_array, beta=0.9, candidate_num=16):
+    '''
+    和_get_nearest_pair_beta_skeleton一样用左上角点、同样的空区域(角度)条件，但不再检查所有点对：
+    beta>=1时beta-skeleton是Delaunay的子图，只检查Delaunay边，结果和精确版一致；
+    beta<1时没有这个性质，候选边取Delaunay边+candidate_num近邻，是近似结果，可能漏掉少量边。
+    每条候选边只和落在包围圆内的点做向量化的角度判断
+    '''
+    points = np.asarray(cell_boxes_array, dtype=np.float64)[:, [0, 1]]
+    costheta = math.sqrt(1 - 1 / (beta**2)) if beta > 1 else -math.sqrt(1 - beta**2)
+    # 重合的点之间角度无定义(nan)，不会挡住任何边，先去重，最后再展开回原始下标
+    unique_points, inverse = np.unique(points, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique_num = len(unique_points)
+    candidate_pair = [np.zeros((0, 2), dtype=np.int64)]
+    if unique_num > 1:
+        try:
+            simplices = Delaunay(unique_points).simplices
+            candidate_pair.append(simplices[:, [0, 1, 1, 2, 0, 2]].reshape(-1, 2))
+        except QhullError:
+            # 点太少或者全部共线，共线时beta-skeleton只连相邻点
+            order = np.lexsort((unique_points[:, 1], unique_points[:, 0]))
+            candidate_pair.append(np.stack([order[:-1], order[1:]], axis=1))
+        if beta < 1:
+            tree = cKDTree(unique_points)
+            k = min(candidate_num + 1, unique_num)
+            _, neighbors = tree.query(unique_points, k=k)
+            candidate_pair.append(
+                np.stack([np.repeat(np.arange(unique_num), k), neighbors.reshape(-1)], axis=1))
+    candidate_pair = np.unique(np.sort(np.concatenate(candidate_pair, axis=0), axis=1), axis=0)
+    candidate_pair = candidate_pair[candidate_pair[:, 0] != candidate_pair[:, 1]]
+
+    if len(candidate_pair) > 0:
+        # 满足角度条件的点一定在这个圆内：beta<=1时是以边为直径的圆，beta>1时是两个圆的并集的外接圆
+        P, Q = unique_points[candidate_pair[:, 0]], unique_points[candidate_pair[:, 1]]
+        half_dis = np.sqrt(((P - Q)**2).sum(axis=1)) / 2
+        radius = half_dis * (beta + math.sqrt(beta**2 - 1)) if beta > 1 else half_dis
+        tree = cKDTree(unique_points)
+        neighbor_list = tree.query_ball_point((P + Q) / 2, radius * (1 + 1e-7) + 1e-7)
+        neighbor_num = np.array([len(neighbors) for neighbors in neighbor_list], dtype=np.int64)
+        edge_index = np.repeat(np.arange(len(candidate_pair)), neighbor_num)
+        R_index = np.concatenate([np.asarray(neighbors, dtype=np.int64) for neighbors in neighbor_list])
+        RP = P[edge_index] - unique_points[R_index]
+        RQ = Q[edge_index] - unique_points[R_index]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cosalpha = (RP * RQ).sum(axis=1) / np.sqrt((RP * RP).sum(axis=1) * (RQ * RQ).sum(axis=1))
+        block = (R_index != candidate_pair[edge_index, 0]) & (R_index != candidate_pair[edge_index, 1]) & (
+            cosalpha <= costheta)
+        keep = np.bincount(edge_index[block], minlength=len(candidate_pair)) == 0
+        candidate_pair = candidate_pair[keep]
+
+    graph_neighbors = []
+    if unique_num == len(points):
+        graph_neighbors = [tuple(pair) for pair in np.sort(inverse.argsort()[candidate_pair], axis=1).tolist()]
+    else:
+        members = [[] for _ in range(unique_num)]
+        for index, unique_index in enumerate(inverse.tolist()):
+            members[unique_index].append(index)
+        for member in members:
+            graph_neighbors.extend(itertools.combinations(member, 2))
+        for u, v in candidate_pair.tolist():
+            graph_neighbors.extend(
+                (i, j) if i < j else (j, i) for i, j in itertools.product(members[u], members[v]))
+    return sorted(graph_neighbors)
+
+
 def _get_nearest_pair_knn(cell_box, k_nearest_num):
     graph_transform = transforms.KNNGraph(k=k_nearest_num)
     # 尝试1
@@ -675,6 +930,78 @@ def _get_nearest_pair_knn(cell_box, k_nearest_num):
     # ) + down_index_list.tolist() + second_up_index_list.tolist() + second_down_index_list.tolist()
 
 
+def _get_nearest_pair_knn_batch(cell_boxes, batch, k_nearest_num):
+    '''
+    _get_nearest_pair_knn的批量版：整个batch拼接后的框+batch向量一次调用knn_graph，x0、y0各取k近邻，
+    结果留在框所在的device上，返回全局下标的edge_index [2, E]
+    '''
+    edge_index = torch.cat((knn_graph(cell_boxes[:, [0]], k_nearest_num, batch=batch, loop=False),
+                            knn_graph(cell_boxes[:, [1]], k_nearest_num, batch=batch, loop=False)),
+                           dim=1)
+    return _unique_edge_index(edge_index, cell_boxes.shape[0])
+
+
+def _get_nearest_pair_custom_batch(cell_boxes, batch, rope_max_length, max_chunk_elements=2**20):
+    '''
+    _get_nearest_pair_custom的批量torch版：整个batch拼接后的框+batch向量，在框所在的device上计算，
+    按行分块，每个节点只和同一张图里的节点比较，返回全局下标的edge_index [2, E]
+    '''
+    device = cell_boxes.device
+    node_num = cell_boxes.shape[0]
+    if node_num == 0:
+        return torch.empty((2, 0), dtype=torch.long, device=device)
+    graph_node_num = torch.bincount(batch)
+    graph_start = torch.cumsum(graph_node_num, dim=0) - graph_node_num
+    max_node_num = int(graph_node_num.max())
+    x_min, y_min, x_max, y_max = cell_boxes.unbind(dim=1)
+    cell_boxes_height = y_max - y_min
+    center_y = (y_min + y_max) / 2
+    center_x = (x_min + x_max) / 2
+    y_low = y_min - cell_boxes_height * 0.3
+    y_high = y_max + cell_boxes_height * 0.3
+    offsets = torch.arange(max_node_num, device=device)
+    chunk_size = max(1, max_chunk_elements // max_node_num)
+    edge_index_list = []
+    for start in range(0, node_num, chunk_size):
+        rows = torch.arange(start, min(start + chunk_size, node_num), device=device)
+        row = rows.unsqueeze(1)
+        # [chunk, max_node_num]，每行是同一张图的所有节点，超出该图节点数的部分是padding
+        cols = graph_start[batch[rows]].unsqueeze(1) + offsets
+        invalid = (offsets >= graph_node_num[batch[rows]].unsqueeze(1)) | (cols == row)
+        cols = cols.clamp(max=node_num - 1)
+        y_center_flag = (center_y[cols] < y_low[row]) | (center_y[cols] > y_high[row])
+        x_center_flag = (center_x[cols] < x_min[row]) | (center_x[cols] > x_max[row])
+        hor_dis = (x_min[cols] - x_max[row])**2 + (y_min[cols] - y_min[row])**2
+        ver_y_dis = (y_min[cols] - y_max[row])**2
+        ver_dis = (x_min[cols] - x_min[row])**2 + ver_y_dis
+        up_dis_flag = invalid | (y_max[cols] <= y_max[row])
+        dis_list = [
+            (hor_dis.masked_fill(invalid | y_center_flag | (x_max[cols] <= x_max[row]), math.inf), 1),
+            (hor_dis.masked_fill(invalid | y_center_flag | (x_min[cols] >= x_min[row]), math.inf), 1),
+            # for vertical direction, we pick up at most two nodes w.r.t each node
+            (ver_dis.masked_fill(up_dis_flag, math.inf), 2),
+            (ver_dis.masked_fill(invalid | (y_min[cols] >= y_min[row]), math.inf), 2),
+            (ver_y_dis.masked_fill(up_dis_flag | x_center_flag, math.inf), 1),
+        ]
+        for dis, pick_num in dis_list:
+            for i in range(pick_num):
+                # argmin遇到相同距离取第一个下标，和np.argmin一致
+                min_index = torch.argmin(dis, dim=1, keepdim=True)
+                found = torch.gather(dis, 1, min_index).squeeze(1) != math.inf
+                edge_index_list.append(torch.stack([rows, torch.gather(cols, 1, min_index).squeeze(1)])[:, found])
+                if i + 1 < pick_num:
+                    dis = dis.scatter(1, min_index, math.inf)
+    edge_index = _unique_edge_index(torch.cat(edge_index_list, dim=1), node_num)
+    return edge_index[:, edge_index[1] - edge_index[0] < rope_max_length]
+
+
+def _unique_edge_index(edge_index, node_num):
+    '''转成无向边(小下标在前)并去重，按(i, j)排序'''
+    edge_index = torch.sort(edge_index, dim=0)[0]
+    edge_code = torch.unique(edge_index[0] * node_num + edge_index[1])
+    return torch.stack([torch.div(edge_code, node_num, rounding_mode='floor'), edge_code % node_num])
+
+
 def check_angle(P, Q, R, costheta):
     '''判断角度条件'''
     RP = P - R
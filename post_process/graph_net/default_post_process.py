@@ -11,6 +11,8 @@ from collections import Counter
 import numpy as np
 import networkx
 import torch
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 
 class DefaultPostProcessor():
@@ -25,44 +27,93 @@ class DefaultPostProcessor():
 
     def __call__(self, result_data, cell_box, transform_cell_box=None, text=None, **kwargs):
         node_pred = result_data['node_pred']
-        pair_cell = result_data['pair_cell']
-        adj = np.zeros([len(cell_box), len(cell_box)], dtype='int')
+        node_num = len(cell_box)
         node_score_list = torch.nn.functional.softmax(result_data['node_score_list'], dim=1)
-        if len(pair_cell) > 0:
-            pair_cell_pred = list(map(int, result_data['pair_cell_pred'].cpu().numpy().tolist()))
-            pair_cell_score_list = torch.nn.functional.softmax(result_data['pair_cell_score_list'], dim=1)
-            all_cell_pairs_score = [
-                round(float(pair_cell_score_list[i][1].cpu()), 2)
-                for i, pair in enumerate(pair_cell)
-                if pair_cell_pred[i] == 1
-            ]
-            all_cell_pairs = [
-                pair for i, pair in enumerate(pair_cell)
-                if pair_cell_pred[i] == 1 and pair_cell_score_list[i][1] > self.pair_score_threshold
-            ]
+        # 每个节点预测类别的分数
+        node_score = node_score_list.gather(1, node_pred.long().unsqueeze(1)).squeeze(1)
+        edge = get_link_edge(result_data, node_pred, self.pair_score_threshold, self.delete_dif_cls)
+        group = get_connected_group(edge, node_num)
+        result_data['od_label_list'] = get_od_label_list(group, edge, cell_box, node_pred, node_score,
+                                                         self.label_priority_list)
+        return result_data
 
-            for pair in all_cell_pairs:
-                if self.delete_dif_cls:
-                    if node_pred[pair[0]] == node_pred[pair[1]]:
-                        adj[pair[0], pair[1]], adj[pair[1], pair[0]] = 1, 1
-                else:
-                    adj[pair[0], pair[1]], adj[pair[1], pair[0]] = 1, 1
-        nodenum = adj.shape[0]
-        edge_temp = np.where(adj != 0)
-        edge = list(zip(edge_temp[0], edge_temp[1]))
-        layout_graph = networkx.Graph()
-        layout_graph.add_nodes_from(list(range(nodenum)))
-        layout_graph.add_edges_from(edge)
 
-        od_label_list = []
-        for c in networkx.connected_components(layout_graph):
-            # 得到不连通的子集
-            subgraph = layout_graph.subgraph(c)
-            od_label = get_od_label(subgraph, cell_box, node_pred, node_score_list, self.label_priority_list)
-            od_label_list.append(od_label)
+def get_link_edge(result_data, node_pred, pair_score_threshold, delete_dif_cls):
+    '''在device上筛出预测为同一个区域、分数超过阈值的pair，只把筛完的[E, 2]边拷到cpu'''
+    pair_cell = torch.as_tensor(result_data['pair_cell']).reshape(-1, 2)
+    if len(pair_cell) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    pair_cell = pair_cell.to(node_pred.device)
+    pair_cell_score_list = torch.nn.functional.softmax(result_data['pair_cell_score_list'], dim=1)
+    keep = (result_data['pair_cell_pred'] == 1) & (pair_cell_score_list[:, 1] > pair_score_threshold)
+    if delete_dif_cls:
+        keep &= node_pred[pair_cell[:, 0]] == node_pred[pair_cell[:, 1]]
+    return pair_cell[keep].cpu().numpy().astype(np.int64)
 
-        result_data['od_label_list'] = od_label_list
-        return result_data
+
+def get_connected_group(edge, node_num):
+    '''
+    scipy csgraph求连通分量，分量按最小的节点下标排序编号，和networkx.connected_components从0号节点开始遍历的顺序一致
+    '''
+    if node_num == 0:
+        return np.zeros(0, dtype=np.int64)
+    adj = coo_matrix((np.ones(len(edge), dtype=np.int8), (edge[:, 0], edge[:, 1])), shape=(node_num, node_num))
+    _, group = connected_components(adj, directed=False)
+    _, first_node = np.unique(group, return_index=True)
+    group_order = np.empty(len(first_node), dtype=np.int64)
+    group_order[np.argsort(first_node)] = np.arange(len(first_node))
+    return group_order[group]
+
+
+def get_od_label_list(group, edge, cell_box, node_pred, node_score, label_priority_list):
+    '''
+    按连通分量分组统计：框取并集，label取出现最多的类别，node_score取平均，都用scatter一次算完，最后只拷一次结果到cpu
+    有多个类别一样多时，在所有并列最多的类别里按label_priority_list取优先级最高的，不在列表里的类别优先级最低。
+    原来的get_od_label只比较Counter.most_common的前两个类别，三个及以上类别并列时结果取决于节点的遍历顺序，这里不再保留
+    '''
+    group_num = int(group.max()) + 1 if len(group) > 0 else 0
+    if group_num == 0:
+        return []
+    device = node_pred.device
+    group_tensor = torch.as_tensor(group, device=device)
+    box = torch.as_tensor(np.asarray(cell_box, dtype=np.float64).reshape(-1, 4), device=device)
+    index = group_tensor.unsqueeze(1).expand(-1, 2)
+    points = torch.cat([
+        box.new_full((group_num, 2), float('inf')).scatter_reduce(0, index, box[:, :2], reduce='amin'),
+        box.new_full((group_num, 2), float('-inf')).scatter_reduce(0, index, box[:, 2:], reduce='amax')
+    ], dim=1)
+    node_label = node_pred.long()
+    class_num = max([int(node_label.max()) + 1] + [label + 1 for label in label_priority_list])
+    label_count = torch.bincount(group_tensor * class_num + node_label,
+                                 minlength=group_num * class_num).reshape(group_num, class_num)
+    # 数量最多的类别里选优先级最高的：按(数量, 优先级)排序，优先级放在小数位上
+    priority = [len(label_priority_list)] * class_num
+    for priority_index, label in reversed(list(enumerate(label_priority_list))):
+        priority[label] = priority_index
+    priority = torch.tensor(priority, dtype=torch.float64, device=device) / (len(label_priority_list) + 1)
+    label = (label_count.double() - priority).argmax(dim=1)
+    group_node_num = torch.bincount(group_tensor, minlength=group_num)
+    score = torch.zeros(group_num, dtype=torch.float64, device=device).index_add_(
+        0, group_tensor, node_score.double()) / group_node_num
+    points, label, score = points.cpu().numpy().tolist(), label.cpu().numpy().tolist(), score.cpu().numpy().tolist()
+    # 每组的节点和组内的边，subgraph用邻接表，networkx.Graph(subgraph)可以还原成图
+    node_order = np.argsort(group, kind='stable')
+    node_set_list = np.split(node_order, np.cumsum(group_node_num.cpu().numpy())[:-1])
+    adjacency = [[] for _ in range(len(group))]
+    for node_a, node_b in edge.tolist():
+        adjacency[node_a].append(node_b)
+        adjacency[node_b].append(node_a)
+    od_label_list = []
+    for group_index, node_set in enumerate(node_set_list):
+        node_set = node_set.tolist()
+        od_label_list.append({
+            'label': label[group_index],
+            'points': points[group_index],
+            'nodeSet': node_set,
+            'subgraph': {node: adjacency[node] for node in node_set},
+            "node_score": score[group_index],
+        })
+    return od_label_list
 
 
 def delete_pair(od_label, cell_box, node_pred, node_score_list, label_priority_list):
@@ -123,38 +174,3 @@ def delete_pair(od_label, cell_box, node_pred, node_score_list, label_priority_l
         })
 
     return new_od_label_list
-
-
-def get_od_label(subgraph, cell_box, node_pred, node_score_list, label_priority_list):
-    nodeSet = subgraph.nodes()
-    cell_box_list = []
-    label_list = []
-    one_node_score_list = []
-    for node in nodeSet:
-        box = cell_box[node]
-        cell_box_list.append(box)
-        label_list.append(int(node_pred[node].cpu()))
-        one_node_score_list.append(float(node_score_list[node][node_pred[node]].cpu()))
-    cell_box_array = np.array(cell_box_list)
-    label_counters = Counter(label_list)
-    # 如果有两个label的count数一样，按照预定义的优先级也决定最终label
-    if len(label_counters) > 1 and label_counters.most_common(1)[0][1] == label_counters.most_common(2)[1][1]:
-        two_label_list = [label_counters.most_common(1)[0][0], label_counters.most_common(2)[1][0]]
-        two_label_priority = [label_priority_list.index(label) for label in two_label_list]
-        label = two_label_list[two_label_priority.index(min(two_label_priority))]
-    else:
-        label = label_counters.most_common(1)[0][0]
-    points = [
-        float(min(cell_box_array[:, 0])),
-        float(min(cell_box_array[:, 1])),
-        float(max(cell_box_array[:, 2])),
-        float(max(cell_box_array[:, 3]))
-    ]
-    od_label = {
-        'label': label,
-        'points': points,
-        'nodeSet': nodeSet,
-        'subgraph': subgraph,
-        "node_score": sum(one_node_score_list) / len(one_node_score_list),
-    }
-    return od_label
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+'''
+对比get_box_feat改造前(两次deepcopy+逐图原地归一化)和改造后(不拷贝、batch scatter归一化)的
+耗时和内存分配次数/字节数
+python scripts/benchmark_box_feat.py --batch_size 8 --box_num 500 --device cuda
+'''
+import argparse
+import copy
+import os
+import sys
+import time
+
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from networks.graph_net.graph_net import get_box_feat
+
+
+def old_get_box_feat(cell_boxes):
+    # 改造前的实现，输入已经deepcopy过，原地归一化
+    for cell_box in cell_boxes:
+        min_x = cell_box[:, [0, 2]].min()
+        min_y = cell_box[:, [1, 3]].min()
+        cell_box_w = cell_box[:, [0, 2]].max() - min_x
+        cell_box_h = cell_box[:, [1, 3]].max() - min_y
+        cell_box[:, [0, 2]] = (cell_box[:, [0, 2]] - min_x) / cell_box_w
+        cell_box[:, [1, 3]] = (cell_box[:, [1, 3]] - min_y) / cell_box_h
+    boxes = torch.cat(cell_boxes, dim=0)
+    box_w = boxes[:, 2] - boxes[:, 0]
+    box_h = boxes[:, 3] - boxes[:, 1]
+    ctr_x = (boxes[:, 2] + boxes[:, 0]) / 2
+    ctr_y = (boxes[:, 3] + boxes[:, 1]) / 2
+    return torch.stack((boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3], ctr_x, ctr_y, box_w, box_h), dim=1)
+
+
+def old_forward(cell_boxes):
+    # GraphLayoutNet.forward和GraphBase.forward各deepcopy一次
+    return old_get_box_feat(copy.deepcopy(copy.deepcopy(cell_boxes)))
+
+
+def new_forward(cell_boxes):
+    return get_box_feat(cell_boxes, norm_box_flag=True)
+
+
+def make_cell_boxes(batch_size, box_num, device):
+    cell_boxes = []
+    for _ in range(batch_size):
+        xy = torch.rand(box_num, 2) * 800
+        cell_boxes.append(torch.cat([xy, xy + torch.rand(box_num, 2) * 100 + 1], dim=1).to(device))
+    return cell_boxes
+
+
+def synchronize(device):
+    if device.startswith('cuda'):
+        torch.cuda.synchronize()
+
+
+def measure(func, cell_boxes, device, repeat):
+    func(cell_boxes)
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(cell_boxes)
+    synchronize(device)
+    cost = (time.perf_counter() - start) / repeat * 1000
+
+    if device.startswith('cuda'):
+        # CUDA直接看caching allocator的统计
+        before = torch.cuda.memory_stats(device)
+        func(cell_boxes)
+        synchronize(device)
+        after = torch.cuda.memory_stats(device)
+        alloc_num = after['allocation.all.allocated'] - before['allocation.all.allocated']
+        alloc_bytes = after['allocated_bytes.all.allocated'] - before['allocated_bytes.all.allocated']
+        return cost, alloc_num, alloc_bytes
+    # CPU用profiler统计每个算子自身申请的内存
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        func(cell_boxes)
+    alloc_list = [event.self_cpu_memory_usage for event in prof.events() if event.self_cpu_memory_usage > 0]
+    return cost, len(alloc_list), sum(alloc_list)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark get_box_feat')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--box_num', type=int, default=500)
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--repeat', type=int, default=100)
+    args = parser.parse_args()
+    cell_boxes = make_cell_boxes(args.batch_size, args.box_num, args.device)
+    assert torch.allclose(old_forward(cell_boxes), new_forward(cell_boxes))
+    for name, func in [('deepcopy + inplace', old_forward), ('out-of-place scatter', new_forward)]:
+        cost, alloc_num, alloc_bytes = measure(func, cell_boxes, args.device, args.repeat)
+        print('{:<22} {:8.3f} ms/step  {:4d} allocations  {:10d} bytes'.format(name, cost, alloc_num, alloc_bytes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+'''
+对比全分辨率解码和JPEG draft降分辨率解码(draft_decode_flag)在dataset+collate resize路径上的吞吐(images/s)
+python scripts/benchmark_image_decode.py --img_dir /open-dataset/OD-layout/DocLayNet_core/PNG --num 200
+不给img_dir时生成一批2200x1700的JPEG来测
+'''
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from base.common_util import get_file_path_list
+from mydatasets.gragh_net.graph_collate import graph_get_resize_transform
+from mydatasets.gragh_net.layout_dataset import load_img, scale_cell_box
+
+
+def make_images(save_dir, num, height=2200, width=1700):
+    img_path_list = []
+    for i in range(num):
+        # 随机色块，避免纯色图片解码过快
+        image = np.random.randint(0, 255, (height // 20, width // 20, 3), dtype=np.uint8)
+        image = Image.fromarray(image).resize((width, height), Image.NEAREST)
+        img_path = os.path.join(save_dir, '{}.jpg'.format(i))
+        image.save(img_path, quality=90)
+        img_path_list.append(img_path)
+    return img_path_list
+
+
+def measure(img_path_list, draft_size, height, width):
+    cell_box = [[10, 10, 200, 40], [300, 500, 900, 560]]
+    start = time.perf_counter()
+    for img_path in img_path_list:
+        image, scale = load_img(img_path, draft_size)
+        graph_get_resize_transform(image, scale_cell_box(cell_box, scale), height, width)
+    return len(img_path_list) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark image decode')
+    parser.add_argument('--img_dir', type=str, default=None)
+    parser.add_argument('--num', type=int, default=100)
+    parser.add_argument('--height', type=int, default=400)
+    parser.add_argument('--width', type=int, default=400)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.img_dir:
+            img_path_list = get_file_path_list(args.img_dir, ['jpg', 'jpeg'])[:args.num]
+        else:
+            img_path_list = make_images(tmp_dir, args.num)
+        # 预热page cache
+        measure(img_path_list[:10], None, args.height, args.width)
+        full_speed = measure(img_path_list, None, args.height, args.width)
+        draft_speed = measure(img_path_list, (args.width, args.height), args.height, args.width)
+    print('full decode : {:8.2f} images/s'.format(full_speed))
+    print('draft decode: {:8.2f} images/s ({:.2f}x)'.format(draft_speed, draft_speed / full_speed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import unittest
+
+import torch
+import torch.nn.functional as F
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from loss.graph_layout_contrastive_loss import LayoutContrastiveLoss
+
+
+def dense_info_nce(proj_1, proj_2, mask, temperature=0.5):
+    '''原来的dense实现：完整的[N, N]相似度矩阵，分母去掉对角线'''
+    node_num = proj_1.shape[0]
+    z_i = F.normalize(proj_1, p=2, dim=1)
+    z_j = F.normalize(proj_2, p=2, dim=1)
+    similarity_matrix = F.cosine_similarity(z_i.unsqueeze(1), z_j.unsqueeze(0), dim=2)
+    nominator = torch.exp(similarity_matrix / temperature)
+    denominator = (~torch.eye(node_num, dtype=torch.bool)).to(nominator.dtype) * nominator
+    all_losses = -torch.log(nominator / torch.sum(denominator, dim=1)) * mask
+    return torch.sum(all_losses) / node_num
+
+
+class TestLayoutContrastiveLoss(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.node_num = 50
+        self.proj = torch.randn(self.node_num, 16, dtype=torch.float64)
+        self.labels = torch.randint(0, 5, (self.node_num,))
+        self.row_weight = (torch.rand(self.node_num) < 0.6).to(torch.float64)
+        self.mask = (torch.rand(self.node_num, self.node_num) < 0.3).to(torch.float64)
+        # 不能整除N的、等于N的和大于N的tile
+        self.tile_size_list = [1, 7, 16, self.node_num, 4 * self.node_num]
+
+    def _check(self, dense_mask, **kwargs):
+        proj = self.proj.clone().requires_grad_(True)
+        expected = dense_info_nce(proj, proj, dense_mask)
+        expected_grad, = torch.autograd.grad(expected, proj)
+        for tile_size in self.tile_size_list:
+            proj = self.proj.clone().requires_grad_(True)
+            # requires_grad的输入走checkpoint的分支
+            loss = LayoutContrastiveLoss(tile_size=tile_size)(proj, proj, **kwargs)
+            grad, = torch.autograd.grad(loss, proj)
+            torch.testing.assert_close(loss, expected, rtol=1e-10, atol=1e-10)
+            torch.testing.assert_close(grad, expected_grad, rtol=1e-10, atol=1e-10)
+
+    def test_labels(self):
+        dense_mask = (self.labels.unsqueeze(1) != self.labels.unsqueeze(0)).to(torch.float64)
+        self._check(dense_mask, labels=self.labels)
+
+    def test_mask(self):
+        self._check(self.mask, mask=self.mask)
+
+    def test_row_weight(self):
+        dense_mask = self.row_weight.unsqueeze(1).expand(self.node_num, self.node_num)
+        self._check(dense_mask, row_weight=self.row_weight)
+
+    def test_two_projections(self):
+        proj_1 = self.proj.clone().requires_grad_(True)
+        proj_2 = torch.randn_like(self.proj).requires_grad_(True)
+        expected = dense_info_nce(proj_1, proj_2, self.mask)
+        expected_grad = torch.autograd.grad(expected, [proj_1, proj_2])
+        for tile_size in self.tile_size_list:
+            loss = LayoutContrastiveLoss(tile_size=tile_size)(proj_1, proj_2, mask=self.mask)
+            grad = torch.autograd.grad(loss, [proj_1, proj_2])
+            torch.testing.assert_close(loss, expected, rtol=1e-10, atol=1e-10)
+            torch.testing.assert_close(grad, expected_grad, rtol=1e-10, atol=1e-10)
+
+    def test_no_grad(self):
+        expected = dense_info_nce(self.proj, self.proj, self.mask)
+        with torch.no_grad():
+            for tile_size in self.tile_size_list:
+                loss = LayoutContrastiveLoss(tile_size=tile_size)(self.proj, self.proj, mask=self.mask)
+                torch.testing.assert_close(loss, expected, rtol=1e-10, atol=1e-10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import unittest
+
+import torch
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from loss import GraphLayoutLoss
+
+
+class TestGraphLayoutLoss(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.criterion = GraphLayoutLoss('CrossEntropyLoss', num_classes=7, class_weight_flag=True,
+                                         class_weight_momentum=0.9)
+
+    def _forward(self):
+        node_num, pair_num = 20, 30
+        outputs = {
+            'pair_cell_target': torch.randint(0, 2, (pair_num,)),
+            'pair_cell_score_list': torch.randn(pair_num, 2, requires_grad=True),
+            'node_score_list': torch.randn(node_num, 7, requires_grad=True),
+        }
+        return self.criterion(outputs, torch.randint(0, 7, (node_num,)))
+
+    def test_train_forward_updates_class_freq(self):
+        self.criterion.train()
+        self._forward()
+        self.assertEqual(float(self.criterion.class_freq_step), 1)
+        self.assertGreater(float(self.criterion.node_class_freq.sum()), 0)
+
+    def test_eval_forward_keeps_class_freq(self):
+        self.criterion.train()
+        self._forward()
+        node_class_freq = self.criterion.node_class_freq.clone()
+        edge_class_freq = self.criterion.edge_class_freq.clone()
+        # experiment的evaluate没有包torch.no_grad()，只靠eval()区分
+        self.criterion.eval()
+        losses = self._forward()
+        self.assertTrue(losses['loss'].requires_grad)
+        self.assertTrue(torch.equal(self.criterion.node_class_freq, node_class_freq))
+        self.assertTrue(torch.equal(self.criterion.edge_class_freq, edge_class_freq))
+        self.assertEqual(float(self.criterion.class_freq_step), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
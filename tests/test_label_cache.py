@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from mydatasets.gragh_net.label_cache import GraphLabelCache
+
+
+def parse_label(label_path):
+    with open(label_path, 'r') as f:
+        json_data = json.load(f)
+    return {'cell_box': json_data['cell_box'], 'target': json_data['target'], 'text': json_data['text']}
+
+
+class TestGraphLabelCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.label_path_list = []
+        for i in range(3):
+            label_path = os.path.join(self.tmp_dir.name, '{}.json'.format(i))
+            self._write_label(label_path, 'text_{}'.format(i))
+            self.label_path_list.append(label_path)
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    @staticmethod
+    def _write_label(label_path, text):
+        with open(label_path, 'w') as f:
+            json.dump({'cell_box': [[0, 0, 10, 10]], 'target': ['Text'], 'text': [text]}, f)
+
+    def test_reuse_cache(self):
+        cache = GraphLabelCache(self.cache_dir, self.label_path_list, parse_label)
+        self.assertEqual(cache[1]['text'], ['text_1'])
+        self.assertEqual(GraphLabelCache(self.cache_dir, self.label_path_list, parse_label).cache_path,
+                         cache.cache_path)
+
+    def test_rebuild_after_label_changed(self):
+        cache = GraphLabelCache(self.cache_dir, self.label_path_list, parse_label)
+        self._write_label(self.label_path_list[1], 'changed text')
+        # 保证mtime变化
+        label_stat = os.stat(self.label_path_list[1])
+        os.utime(self.label_path_list[1], ns=(label_stat.st_atime_ns, label_stat.st_mtime_ns + 10 ** 9))
+        new_cache = GraphLabelCache(self.cache_dir, self.label_path_list, parse_label)
+        self.assertNotEqual(new_cache.cache_path, cache.cache_path)
+        self.assertEqual(new_cache[1]['text'], ['changed text'])
+
+
+if __name__ == '__main__':
+    unittest.main()
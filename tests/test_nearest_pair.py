@@ -0,0 +1,69 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from networks.graph_net.graph_net import _get_nearest_pair_custom, _get_nearest_pair_custom_tree, \
+    _get_nearest_pair_custom_batch
+
+
+def make_page(rng, box_num, grid_flag=False):
+    '''随机的文本框，grid_flag时坐标取整到网格上，制造很多距离相同和对齐的框'''
+    if box_num == 0:
+        return np.zeros((0, 4), dtype=np.float64)
+    xy = rng.uniform(0, 1000, (box_num, 2))
+    wh = rng.uniform(5, 120, (box_num, 2)) * np.array([1, 0.3])
+    if grid_flag:
+        xy = np.round(xy / 50) * 50
+        wh = np.round(wh / 10) * 10 + 10
+    return np.concatenate([xy, xy + wh], axis=1)
+
+
+def dense_pair(cell_boxes_array, rope_max_length):
+    '''_get_nearest_pair_custom作为基准，0个框时dense版没法算，应该没有边'''
+    if len(cell_boxes_array) == 0:
+        return set()
+    return set(_get_nearest_pair_custom(cell_boxes_array, rope_max_length))
+
+
+class TestNearestPair(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.page_list = [make_page(self.rng, box_num) for box_num in [0, 1, 2, 3, 17, 60, 150]]
+        self.page_list += [make_page(self.rng, box_num, grid_flag=True) for box_num in [1, 5, 40, 120]]
+
+    def test_custom_tree(self):
+        for rope_max_length in [5, 100000000]:
+            for cell_boxes_array in self.page_list:
+                self.assertEqual(set(_get_nearest_pair_custom_tree(cell_boxes_array, rope_max_length)),
+                                 dense_pair(cell_boxes_array, rope_max_length))
+
+    def test_custom_batch(self):
+        for rope_max_length in [5, 100000000]:
+            expected, start_index = set(), 0
+            for cell_boxes_array in self.page_list:
+                expected.update((i + start_index, j + start_index)
+                                for i, j in dense_pair(cell_boxes_array, rope_max_length))
+                start_index += len(cell_boxes_array)
+            cell_boxes = torch.as_tensor(np.concatenate(self.page_list, axis=0))
+            batch = torch.cat([torch.full((len(page),), index, dtype=torch.long)
+                               for index, page in enumerate(self.page_list)])
+            # 用很小的max_chunk_elements把行切成多块
+            for max_chunk_elements in [2**20, 500]:
+                edge_index = _get_nearest_pair_custom_batch(cell_boxes, batch, rope_max_length, max_chunk_elements)
+                self.assertEqual(set(map(tuple, edge_index.T.tolist())), expected)
+
+    def test_custom_batch_empty(self):
+        edge_index = _get_nearest_pair_custom_batch(torch.zeros((0, 4)), torch.zeros(0, dtype=torch.long), 100)
+        self.assertEqual(tuple(edge_index.shape), (2, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from networks.graph_net.graph_net import polar, to_bin, polar_tensor, to_bin_tensor
+
+
+def make_page(rng, box_num, grid_flag=False):
+    '''随机的文本框，grid_flag时坐标取整到网格上，制造很多相交、对齐和距离相同的框'''
+    xy = rng.uniform(0, 1000, (box_num, 2))
+    wh = rng.uniform(5, 120, (box_num, 2)) * np.array([1, 0.3])
+    if grid_flag:
+        xy = np.round(xy / 50) * 50
+        wh = np.round(wh / 10) * 10 + 10
+    return np.concatenate([xy, xy + wh], axis=1).astype(np.float32)
+
+
+def make_pair(rng, box_num, pair_num):
+    '''随机的有向pair，不含自己连自己'''
+    if box_num < 2 or pair_num == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    src = rng.integers(0, box_num, pair_num)
+    dst = (src + rng.integers(1, box_num, pair_num)) % box_num
+    return np.stack([src, dst], axis=1)
+
+
+class TestPolarFeature(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        # 一个框的图、有框但没有pair的图也放进同一个batch
+        page_config = [(17, 40, False), (1, 0, False), (60, 300, False), (8, 0, False), (30, 120, True),
+                       (2, 1, False), (120, 500, True)]
+        self.page_list, self.pair_list = [], []
+        for box_num, pair_num, grid_flag in page_config:
+            self.page_list.append(make_page(rng, box_num, grid_flag))
+            self.pair_list.append(make_pair(rng, box_num, pair_num))
+        # 拼成PyG那样的batch：全局下标的pair和每个框所属的图片下标
+        self.cell_boxes = torch.as_tensor(np.concatenate(self.page_list, axis=0))
+        self.batch = torch.cat([torch.full((len(page),), index, dtype=torch.long)
+                                for index, page in enumerate(self.page_list)])
+        start_index_list = np.cumsum([0] + [len(page) for page in self.page_list[:-1]])
+        self.pair_cell = torch.as_tensor(np.concatenate(
+            [pair + start_index for pair, start_index in zip(self.pair_list, start_index_list)], axis=0))
+
+    def get_reference(self, b):
+        '''原来的做法：一张图一张图地逐个pair调polar，再按图调to_bin，没有pair的图跳过'''
+        dist_list, angle_list, bin_list = [], [], []
+        for cell_box, pair_cell in zip(self.page_list, self.pair_list):
+            if len(pair_cell) == 0:
+                continue
+            distances, angles = [], []
+            for pair in pair_cell:
+                dist, angle = polar(cell_box[pair[0]], cell_box[pair[1]])
+                distances.append(dist)
+                angles.append(angle)
+            dist_list.extend(distances)
+            angle_list.extend(angles)
+            bin_list.append(to_bin(distances, angles, b))
+        return np.array(dist_list, dtype=np.float64), np.array(angle_list), torch.cat(bin_list, dim=0)
+
+    def test_polar_tensor(self):
+        expected_dist, expected_angle, _ = self.get_reference(8)
+        dist, angle = polar_tensor(self.cell_boxes[self.pair_cell[:, 0]], self.cell_boxes[self.pair_cell[:, 1]])
+        self.assertEqual(len(dist), len(self.pair_cell))
+        np.testing.assert_allclose(dist.double().numpy(), expected_dist, rtol=0, atol=1e-3)
+        np.testing.assert_array_equal(angle.numpy(), expected_angle)
+
+    def test_to_bin_tensor(self):
+        dist, angle = polar_tensor(self.cell_boxes[self.pair_cell[:, 0]], self.cell_boxes[self.pair_cell[:, 1]])
+        for b in [4, 8, 16]:
+            _, _, expected_bin = self.get_reference(b)
+            polar_bin = to_bin_tensor(dist, angle, b, batch=self.batch[self.pair_cell[:, 0]])
+            self.assertTrue(torch.equal(polar_bin, expected_bin))
+
+    def test_to_bin_tensor_single_image(self):
+        # batch为None时等价于整个输入是一张图
+        cell_box, pair_cell = self.page_list[2], self.pair_list[2]
+        distances, angles = zip(*[polar(cell_box[pair[0]], cell_box[pair[1]]) for pair in pair_cell])
+        cell_box = torch.as_tensor(cell_box)
+        pair_cell = torch.as_tensor(pair_cell)
+        dist, angle = polar_tensor(cell_box[pair_cell[:, 0]], cell_box[pair_cell[:, 1]])
+        self.assertTrue(torch.equal(to_bin_tensor(dist, angle, 8), to_bin(list(distances), list(angles), 8)))
+
+
+if __name__ == '__main__':
+    unittest.main()
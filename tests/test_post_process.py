@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import unittest
+
+import numpy as np
+import torch
+
+PROJECT_ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT_PATH)
+
+from post_process.graph_net.default_post_process import get_connected_group, get_od_label_list
+
+#'Text'0, 'Title'1, 'Header'2, 'Footer'3, 'Figure'4, 'Table'5, 'List'6
+LABEL_PRIORITY_LIST = [1, 5, 6, 4, 0, 3, 2]
+
+
+def get_group_label(node_label_list):
+    '''所有节点连成一条链，组成一个分组，返回这个分组的label'''
+    node_num = len(node_label_list)
+    edge = np.array([[i, i + 1] for i in range(node_num - 1)], dtype=np.int64).reshape(-1, 2)
+    group = get_connected_group(edge, node_num)
+    cell_box = [[i * 10, 0, i * 10 + 5, 5] for i in range(node_num)]
+    node_pred = torch.tensor(node_label_list)
+    od_label_list = get_od_label_list(group, edge, cell_box, node_pred, torch.ones(node_num), LABEL_PRIORITY_LIST)
+    assert len(od_label_list) == 1
+    return od_label_list[0]['label']
+
+
+class TestOdLabel(unittest.TestCase):
+
+    def test_majority(self):
+        self.assertEqual(get_group_label([0, 0, 1]), 0)
+        self.assertEqual(get_group_label([2, 4, 2]), 2)
+
+    def test_two_way_tie(self):
+        # Text和Title一样多，Title优先级高
+        self.assertEqual(get_group_label([0, 1]), 1)
+        self.assertEqual(get_group_label([2, 3, 3, 2]), 3)
+
+    def test_three_way_tie(self):
+        # Text、Figure、Title各一个：在所有并列的类别里取优先级最高的Title，
+        # 原来只比较most_common的前两个(Text、Figure)，会得到Figure
+        self.assertEqual(get_group_label([0, 4, 1]), 1)
+        self.assertEqual(get_group_label([0, 0, 4, 4, 5, 5, 2]), 5)
+
+    def test_label_not_in_priority_list(self):
+        # 不在优先级列表里的类别并列时优先级最低
+        self.assertEqual(get_group_label([7, 0]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()